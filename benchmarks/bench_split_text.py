@@ -0,0 +1,202 @@
+"""
+split_text_for_discord 的效能比較與性質檢查。
+
+以舊版遞迴字串切分為對照組，在大量合成的中文、中英混合、無分隔符與含程式碼區塊的文字上：
+1) 不含 ``` 的文字，切點必須與舊版完全相同
+2) 每段長度不超過 chunk_size、不產生空白段
+3) 含 ``` 的文字，每段的 fence 都成對，程式碼行不會遺失
+最後列出新舊兩版的耗時。
+
+執行：python benchmarks/bench_split_text.py [--quick] [--seed N]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# bot.py 匯入時會檢查必要環境變數；這裡只用到純函式，不會真的連線
+for name in ("DISCORD_TOKEN", "OPENAI_API_KEY", "DATABASE_URL"):
+    os.environ.setdefault(name, "benchmark")
+
+from bot import split_text_for_discord, CODE_FENCE  # noqa: E402
+
+
+def reference_split(text, chunk_size=2000):
+    """舊版實作（遞迴 + 字串串接），作為切點的對照組。"""
+    if not text:
+        return ["（無內容）"]
+
+    delimiters = ["\n\n", "\n", "。", "！", "？", ";", "；"]
+
+    def split_recursive(block, level=0):
+        if len(block) <= chunk_size:
+            return [block]
+
+        if level < len(delimiters):
+            delim = delimiters[level]
+            parts = block.split(delim)
+            if len(parts) > 1:
+                chunks = []
+                current = ""
+                for part in parts:
+                    piece = part if not current else f"{delim}{part}"
+                    if not current:
+                        candidate = part
+                    else:
+                        candidate = current + piece
+
+                    if len(candidate) <= chunk_size:
+                        current = candidate
+                    else:
+                        if current:
+                            chunks.extend(split_recursive(current, level + 1))
+                        current = part
+                if current:
+                    chunks.extend(split_recursive(current, level + 1))
+                return [c for c in chunks if c]
+
+        return [block[i:i + chunk_size] for i in range(0, len(block), chunk_size)]
+
+    return [c for c in split_recursive(str(text)) if c and c.strip()]
+
+
+CJK_CHARS = "的一是在不了有和人這中大為上個國我以要他時來用們生到作地於出就分對成會可主發年動同工也能下過子說產種面而方後多定行學法所民得經十三之進著等部度家電力裡如水化高自二理起小物現實加量都兩體制機當使點從業本去把性好應開它合還因由其些然前外天政四日那社義事平形相全表間樣與關各重新線內數正心反你明看原又麼利比或但質氣第向道命此變條只沒結解問意建月公無系軍很情者最立代想已通並提直題黨程展五果料象員革位入常文總次品式活設及管特件長求老頭基資邊流路級少圖山統接知較將組見計別她手角期根論運農指幾九區強放決西被幹做必戰先回則任取據處理"
+WORDS = ["discord", "bot", "token", "cache", "latency", "async", "event loop", "summary", "Grok", "OpenAI"]
+SENTENCE_ENDS = ["。", "！", "？", "；", ";"]
+
+
+def cjk_text(rng, size):
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        sentence = "".join(rng.choice(CJK_CHARS) for _ in range(rng.randint(5, 60)))
+        parts.append(sentence + rng.choice(SENTENCE_ENDS))
+        roll = rng.random()
+        if roll < 0.05:
+            parts.append("\n\n")
+        elif roll < 0.15:
+            parts.append("\n")
+    return "".join(parts)
+
+
+def mixed_text(rng, size):
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        if rng.random() < 0.5:
+            parts.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))) + rng.choice([". ", "; ", "\n"]))
+        else:
+            parts.append(cjk_text(rng, rng.randint(20, 200)))
+        if rng.random() < 0.05:
+            parts.append("\n\n- " + rng.choice(WORDS) + "\n")
+    return "".join(parts)
+
+
+def no_delimiter_text(rng, size):
+    return "".join(rng.choice(CJK_CHARS + "abcdef ") for _ in range(size))
+
+
+def code_block_text(rng, size):
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        parts.append(cjk_text(rng, rng.randint(50, 400)))
+        language = rng.choice(["python", "js", ""])
+        lines = [f"    value_{i} = compute({i}, '{rng.choice(WORDS)}')" for i in range(rng.randint(5, 200))]
+        parts.append(f"\n\n{CODE_FENCE}{language}\n" + "\n".join(lines) + f"\n{CODE_FENCE}\n\n")
+    return "".join(parts)
+
+
+def long_fence_text(rng, size):
+    """fence 行本身很長（帶一長串屬性）：補回開頭時不能讓段落超過 chunk_size。"""
+    parts = []
+    while sum(len(part) for part in parts) < size:
+        attributes = " ".join(f"{rng.choice(WORDS).replace(' ', '_')}={i}" for i in range(rng.randint(1, 80)))
+        lines = [f"    value_{i} = compute({i})" for i in range(rng.randint(5, 120))]
+        parts.append(cjk_text(rng, rng.randint(20, 200)))
+        parts.append(f"\n\n{CODE_FENCE}python {attributes}\n" + "\n".join(lines) + f"\n{CODE_FENCE}\n\n")
+    return "".join(parts)
+
+
+def tiny_parts_text(rng, size):
+    """大量極短片段：舊版每次合併都重新串接字串的最壞情況。"""
+    return "開頭\n\n" + "".join(rng.choice(["字\n", "a。", "b；"]) for _ in range(size // 2))
+
+
+CORPORA = [
+    ("cjk", cjk_text),
+    ("mixed", mixed_text),
+    ("no_delimiter", no_delimiter_text),
+    ("tiny_parts", tiny_parts_text),
+    ("code_blocks", code_block_text),
+    ("long_fence", long_fence_text),
+]
+
+
+def fence_lines(chunk):
+    return [line for line in chunk.splitlines() if line.strip().startswith(CODE_FENCE)]
+
+
+def check_properties(name, text, chunk_size, chunks):
+    assert chunks, f"{name}: 沒有輸出"
+    for chunk in chunks:
+        assert chunk.strip(), f"{name}: 出現空白段"
+        assert len(chunk) <= chunk_size, f"{name}: 段落長度 {len(chunk)} 超過 {chunk_size}"
+
+    if CODE_FENCE not in text:
+        expected = reference_split(text, chunk_size)
+        assert chunks == expected, f"{name}: 切點與舊版不同"
+        return
+
+    for idx, chunk in enumerate(chunks):
+        assert len(fence_lines(chunk)) % 2 == 0, f"{name}: 第 {idx} 段的 ``` 沒有成對"
+    output = "\n".join(chunks)
+    for line in text.splitlines():
+        if line.startswith("    value_"):
+            assert line in output, f"{name}: 程式碼行遺失 {line!r}"
+
+
+def run_property_checks(rng, cases):
+    for _ in range(cases):
+        name, generator = rng.choice(CORPORA)
+        text = generator(rng, rng.randint(0, 6000))
+        chunk_size = rng.choice([200, 500, 2000, 4096])
+        check_properties(name, text, chunk_size, split_text_for_discord(text, chunk_size=chunk_size))
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def run_benchmarks(rng, size, repeat):
+    print(f"{'corpus':<14}{'chars':>10}{'chunks':>8}{'old ms':>10}{'new ms':>10}{'speedup':>9}")
+    for name, generator in CORPORA:
+        text = generator(rng, size)
+        chunks = split_text_for_discord(text)
+        check_properties(name, text, 2000, chunks)
+        old = best_of(lambda: reference_split(text), repeat)
+        new = best_of(lambda: split_text_for_discord(text), repeat)
+        print(f"{name:<14}{len(text):>10}{len(chunks):>8}{old * 1000:>10.2f}{new * 1000:>10.2f}{old / new:>8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="較小的語料與較少的隨機案例")
+    parser.add_argument("--seed", type=int, default=20240601)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cases, size, repeat = (200, 100_000, 3) if args.quick else (2000, 1_000_000, 5)
+
+    started = time.perf_counter()
+    run_property_checks(rng, cases)
+    print(f"✅ {cases} 組隨機性質檢查通過（{time.perf_counter() - started:.1f}s）")
+    run_benchmarks(rng, size, repeat)
+
+
+if __name__ == "__main__":
+    main()
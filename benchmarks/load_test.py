@@ -0,0 +1,414 @@
+"""
+離線壓力測試：不需要任何 token，用本地替身取代 OpenAI / xAI Responses API、Discord REST 與 PostgreSQL，
+依設定的比例重播 `!問`、`!問2`、`!整理`、`!圖片` 指令，經過真正的 on_message → worker pool → handler 流程。
+
+每個虛擬使用者依序送出指令（等上一個完成才送下一個），`--concurrency` 就是同時在線的使用者數。
+結束後輸出：
+- 各指令端到端延遲（從送出到 handler 結束，含排隊）的 p50 / p95 / p99
+- event loop 延遲（預期 10ms 醒來的 sleep 實際晚了多少）
+- 每個指令平均的 DB round trip 與 Discord API 呼叫次數
+- 排隊已滿被 worker pool 拒絕的指令數
+
+執行：python benchmarks/load_test.py --commands 200 --concurrency 20 --mix 問=50,問2=20,整理=10,圖片=20
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import os
+import random
+import sys
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# bot.py 匯入時會檢查必要環境變數；所有外部服務都會在下面換成替身
+for name in ("DISCORD_TOKEN", "OPENAI_API_KEY", "XAI_API_KEY", "DATABASE_URL"):
+    os.environ.setdefault(name, "load-test")
+
+import discord  # noqa: E402
+import bot  # noqa: E402
+
+# 1x1 透明 PNG，當作生成圖片的結果
+TINY_PNG_B64 = (
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+SOURCE_CHANNEL_ID = 900001
+TARGET_CHANNEL_ID = 900002
+
+current_command = contextvars.ContextVar("current_command", default=None)
+
+
+def count_call(kind):
+    stats = current_command.get()
+    if stats is not None:
+        stats[kind] += 1
+
+
+def pad_label(label, width):
+    """中文字在終端機佔兩格，補空白時要算顯示寬度。"""
+    display = sum(2 if unicodedata.east_asian_width(ch) in "WF" else 1 for ch in label)
+    return label + " " * max(0, width - display)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+### 🤖 Responses API 替身
+class FakeResponses:
+    def __init__(self, provider, latency_ms, stream_chunks):
+        self.provider = provider
+        self.latency = latency_ms / 1000
+        self.stream_chunks = stream_chunks
+        self.ids = itertools.count(1)
+
+    def _latency(self):
+        return random.lognormvariate(0, 0.35) * self.latency
+
+    def _build_response(self, kwargs):
+        response_id = f"{self.provider}-resp-{next(self.ids)}"
+        tools = kwargs.get("tools") or []
+        output = []
+        if any(tool.get("type") == "image_generation" for tool in tools):
+            output.append({"type": "image_generation_call", "result": TINY_PNG_B64})
+        text = "指揮官，以下是模擬回答。" + "這是一段用來壓測排版與串流的內容。" * random.randint(20, 120)
+        usage = SimpleNamespace(
+            input_tokens=random.randint(300, 3000),
+            output_tokens=random.randint(200, 1500),
+            total_tokens=0,
+            output_tokens_details=SimpleNamespace(reasoning_tokens=random.randint(0, 200)),
+            input_tokens_details=SimpleNamespace(cached_tokens=0),
+        )
+        usage.total_tokens = usage.input_tokens + usage.output_tokens
+        return SimpleNamespace(id=response_id, model=kwargs.get("model"), output_text=text, output=output, usage=usage)
+
+    async def create(self, stream=False, **kwargs):
+        count_call("model_calls")
+        response = self._build_response(kwargs)
+        if not stream:
+            await asyncio.sleep(self._latency())
+            return response
+        return self._stream(response)
+
+    async def _stream(self, response):
+        total = self._latency()
+        await asyncio.sleep(total * 0.3)
+        text = response.output_text
+        step = max(1, len(text) // self.stream_chunks)
+        for start in range(0, len(text), step):
+            await asyncio.sleep(total * 0.7 / self.stream_chunks)
+            yield SimpleNamespace(type="response.output_text.delta", delta=text[start:start + step])
+        yield SimpleNamespace(type="response.completed", response=response)
+
+
+class FakeEmbeddings:
+    async def create(self, **kwargs):
+        count_call("model_calls")
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[random.random() for _ in range(8)])])
+
+
+class FakeModelClient:
+    def __init__(self, provider, latency_ms, stream_chunks):
+        self.responses = FakeResponses(provider, latency_ms, stream_chunks)
+        self.embeddings = FakeEmbeddings()
+
+
+### 🛢️ PostgreSQL 替身：每次 execute 在 DB thread 裡 sleep 模擬往返延遲
+class FakeCursor:
+    def __init__(self, latency):
+        self.latency = latency
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        time.sleep(self.latency)
+        self.rowcount = 1
+
+    def mogrify(self, sql, params=None):
+        return sql.encode() if isinstance(sql, str) else sql
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+class FakeConnection:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def cursor(self):
+        return FakeCursor(self.latency)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def __init__(self, latency):
+        self.latency = latency
+
+    def getconn(self):
+        return FakeConnection(self.latency)
+
+    def putconn(self, conn):
+        pass
+
+    def closeall(self):
+        pass
+
+
+### 💬 Discord 替身：REST 呼叫只 sleep，並記錄在目前指令的統計上
+class FakeDiscordREST:
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+        self.ids = itertools.count(10_000_000)
+
+    async def call(self):
+        count_call("discord_calls")
+        await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+
+
+class FakeMessage:
+    def __init__(self, rest, content="", author=None, guild=None, channel=None):
+        self.rest = rest
+        self.id = next(rest.ids)
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.attachments = []
+        self.submitted_at = None
+        self.done = None
+
+    async def reply(self, content=None, **kwargs):
+        await self.rest.call()
+        return FakeMessage(self.rest, content or "", author=None, guild=self.guild, channel=self.channel)
+
+    async def edit(self, **kwargs):
+        await self.rest.call()
+        return self
+
+    async def delete(self):
+        await self.rest.call()
+
+
+class FakeTextChannel(discord.TextChannel):
+    """繼承 TextChannel 以通過 handler 裡的 isinstance 檢查，只實作用得到的部分。"""
+
+    def __init__(self, rest, channel_id, name, history_size=0):
+        self.rest = rest
+        self.id = channel_id
+        self.name = name
+        self.history_size = history_size
+
+    async def send(self, content=None, **kwargs):
+        await self.rest.call()
+        return FakeMessage(self.rest, content or "", channel=self)
+
+    async def history(self, limit=100, **kwargs):
+        for idx in range(min(limit, self.history_size)):
+            if idx % 100 == 0:
+                await self.rest.call()
+            author = SimpleNamespace(id=idx % 7, display_name=f"user{idx % 7}", bot=False)
+            # 每 20 則有一則只貼圖片、沒有文字
+            if idx % 20 == 19:
+                yield SimpleNamespace(id=idx + 1, author=author, content="", attachments=[object()], embeds=[])
+            else:
+                yield SimpleNamespace(id=idx + 1, author=author, content=f"第 {idx} 則討論訊息，內容是模擬的聊天紀錄。" * 3,
+                                      attachments=[], embeds=[])
+
+
+### 🧪 壓測流程
+def parse_mix(raw):
+    mix = {}
+    for item in raw.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip():
+            mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def build_command(kind, rng):
+    if kind == "問":
+        return f"問 {rng.choice(['今天適合做什麼', '幫我解釋 asyncio', '推薦一本書', '台北天氣如何'])}"
+    if kind == "問2":
+        return f"問2 {rng.choice(['最近的科技新聞', '比較兩種資料庫', '幫我寫一首詩'])}"
+    if kind == "整理":
+        return f"整理 {SOURCE_CHANNEL_ID} {TARGET_CHANNEL_ID} {rng.choice([50, 200, 500])} 重新"
+    if kind == "圖片":
+        return f"圖片 {rng.choice(['x1', 'x2'])} 一隻在海邊的貓"
+    raise ValueError(f"未知的指令類型：{kind}")
+
+
+def instrument_handlers(results):
+    """包住每個 handler：設定統計用的 ContextVar，結束時記錄端到端延遲並通知虛擬使用者。"""
+    for attr, kind in [
+        ("handle_ask_command", "問"),
+        ("handle_ask_grok_command", "問2"),
+        ("handle_summary_command", "整理"),
+        ("handle_image_command", "圖片"),
+    ]:
+        original = getattr(bot, attr)
+
+        async def wrapped(message, cmd, _original=original, _kind=kind):
+            stats = {"db_calls": 0, "discord_calls": 0, "model_calls": 0}
+            current_command.set(stats)
+            try:
+                await _original(message, cmd)
+            finally:
+                latency = time.perf_counter() - message.submitted_at
+                results.setdefault(_kind, []).append((latency, stats))
+                if not message.done.done():
+                    message.done.set_result(None)
+
+        setattr(bot, attr, wrapped)
+
+
+def instrument_scheduler(rejections):
+    """被 worker pool 拒收的工作永遠不會跑到 handler，要在這裡記成拒絕並通知虛擬使用者，否則會一直等。"""
+    original_submit = bot.command_scheduler.submit
+
+    async def submit(pool_name, message, handler):
+        position = await original_submit(pool_name, message, handler)
+        if position is None:
+            rejections[pool_name] = rejections.get(pool_name, 0) + 1
+            if message.done is not None and not message.done.done():
+                message.done.set_result(None)
+        return position
+
+    bot.command_scheduler.submit = submit
+
+
+def install_fakes(args):
+    bot.client_ai = FakeModelClient("openai", args.model_latency_ms, args.stream_chunks)
+    bot.client_grok = FakeModelClient("xai", args.model_latency_ms, args.stream_chunks)
+
+    bot.db_pool = FakePool(args.db_latency_ms / 1000)
+    bot.db_executor = ThreadPoolExecutor(max_workers=bot.DB_POOL_MAX_SIZE, thread_name_prefix="db")
+    original_run_db = bot.run_db
+
+    async def counted_run_db(query_fn, *query_args):
+        count_call("db_calls")
+        return await original_run_db(query_fn, *query_args)
+
+    bot.run_db = counted_run_db
+
+    rest = FakeDiscordREST(args.discord_latency_ms)
+    channels = {
+        SOURCE_CHANNEL_ID: FakeTextChannel(rest, SOURCE_CHANNEL_ID, "source", history_size=500),
+        TARGET_CHANNEL_ID: FakeTextChannel(rest, TARGET_CHANNEL_ID, "target"),
+    }
+    bot.client.get_channel = channels.get
+
+    # 壓測要量的是吞吐，不是限流
+    bot.rate_limiter.limits = {}
+    bot.rate_limiter.user_token_budget = 0
+    bot.rate_limiter.guild_token_budget = 0
+    bot.IMAGE_DAILY_LIMIT = 10 ** 9
+    return rest
+
+
+async def monitor_loop_lag(samples, stop, interval=0.01):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+
+async def virtual_user(user_idx, queue, rest, rng):
+    author = SimpleNamespace(id=100_000 + user_idx, display_name=f"tester{user_idx}", bot=False)
+    guild = SimpleNamespace(id=424242)
+    while True:
+        try:
+            kind = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        message = FakeMessage(rest, "!" + build_command(kind, rng), author=author, guild=guild)
+        message.done = asyncio.get_running_loop().create_future()
+        message.submitted_at = time.perf_counter()
+        await bot.on_message(message)
+        await message.done
+
+
+async def run_load_test(args):
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    results = {}
+    rejections = {}
+    rest = install_fakes(args)
+    instrument_handlers(results)
+    instrument_scheduler(rejections)
+    bot.command_scheduler.start()
+
+    mix = parse_mix(args.mix)
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=args.commands)
+    queue = asyncio.Queue()
+    for kind in kinds:
+        queue.put_nowait(kind)
+
+    lag_samples = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop_lag(lag_samples, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(virtual_user(idx, queue, rest, rng) for idx in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    flush_stats = {"db_calls": 0, "discord_calls": 0, "model_calls": 0}
+    current_command.set(flush_stats)
+    await bot.flush_write_behind_state()
+    stop.set()
+    await monitor
+    return results, rejections, lag_samples, elapsed, flush_stats
+
+
+def print_report(args, results, rejections, lag_samples, elapsed, flush_stats):
+    total = sum(len(samples) for samples in results.values())
+    print(f"指令 {total} 個，並行使用者 {args.concurrency}，耗時 {elapsed:.2f}s，吞吐 {total / elapsed:.1f} 指令/秒")
+    print(f"替身延遲：模型 {args.model_latency_ms}ms、Discord {args.discord_latency_ms}ms、DB {args.db_latency_ms}ms")
+    print()
+    print(f"{'command':<8}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'db/cmd':>9}{'discord/cmd':>13}{'model/cmd':>11}")
+    for kind, samples in sorted(results.items()):
+        latencies = [latency for latency, _ in samples]
+        n = len(samples)
+        db = sum(stats["db_calls"] for _, stats in samples) / n
+        discord_calls = sum(stats["discord_calls"] for _, stats in samples) / n
+        model = sum(stats["model_calls"] for _, stats in samples) / n
+        print(f"{pad_label(kind, 8)}{n:>6}{percentile(latencies, 0.50) * 1000:>10.0f}{percentile(latencies, 0.95) * 1000:>10.0f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.0f}{db:>9.2f}{discord_calls:>13.2f}{model:>11.2f}")
+    if rejections:
+        rejected = "、".join(f"{kind} {count} 個" for kind, count in sorted(rejections.items()))
+        print(f"排隊已滿被拒絕（不計入上表）：{rejected}")
+    print()
+    print(f"event loop 延遲：p50 {percentile(lag_samples, 0.50) * 1000:.2f}ms、p99 {percentile(lag_samples, 0.99) * 1000:.2f}ms、"
+          f"最大 {max(lag_samples, default=0) * 1000:.2f}ms")
+    print(f"結束時寫回 write-behind 狀態：DB round trip {flush_stats['db_calls']} 次")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--commands", type=int, default=200, help="總指令數")
+    parser.add_argument("--concurrency", type=int, default=20, help="同時在線的虛擬使用者數")
+    parser.add_argument("--mix", default="問=50,問2=20,整理=10,圖片=20", help="指令比例，例如 問=50,問2=20")
+    parser.add_argument("--model-latency-ms", type=float, default=800)
+    parser.add_argument("--discord-latency-ms", type=float, default=60)
+    parser.add_argument("--db-latency-ms", type=float, default=5)
+    parser.add_argument("--stream-chunks", type=int, default=20, help="串流回應切成幾段 delta")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    results, rejections, lag_samples, elapsed, flush_stats = asyncio.run(run_load_test(args))
+    print_report(args, results, rejections, lag_samples, elapsed, flush_stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,34 @@
 ### 📦 模組與套件匯入
 import discord
-from openai import OpenAI
+from discord import app_commands
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError
 import os, base64, io, json
 import asyncio
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_batch
 from psycopg2 import pool
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from contextlib import suppress
+from contextlib import suppress, contextmanager
+from collections import OrderedDict, deque
+import functools
+import hashlib
+import math
+import re
+import unicodedata
 import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+try:
+    from PIL import Image  # 選用：有安裝 Pillow 才會把生成圖片轉成較小的 WebP / JPEG
+except ImportError:
+    Image = None
+    print("[PILLOW_WARN] 未安裝 Pillow：生成圖片不會重新壓縮、附件圖片也不會縮圖，請執行 pip install -r requirements.txt")
+
+try:
+    import tiktoken  # 選用：有安裝才用真正的 tokenizer 估算 token，否則退回字元數粗估
+except ImportError:
+    tiktoken = None
 
 # ===== 1. 載入環境變數與 API 金鑰 =====
 ### 🔐 載入環境變數與金鑰
@@ -47,863 +67,3479 @@ def parse_optional_int_env(name, raw_value):
         return None
 
 
+def parse_int_env(name, default):
+    value = parse_optional_int_env(name, os.getenv(name, "").strip())
+    return default if value is None else value
+
+
+def parse_json_env(name):
+    raw_value = os.getenv(name, "").strip()
+    if not raw_value:
+        return None
+
+    try:
+        return json.loads(raw_value)
+    except json.JSONDecodeError:
+        print(f"⚠️ 環境變數 {name} 不是有效 JSON：{raw_value}")
+        return None
+
+
 DAILY_NEWS_CHANNEL_ID = parse_optional_int_env("DAILY_NEWS_CHANNEL_ID", DAILY_NEWS_CHANNEL_ID_RAW)
+
+
+def parse_int_list_env(name):
+    values = []
+    for raw_value in os.getenv(name, "").split(","):
+        value = parse_optional_int_env(name, raw_value.strip())
+        if value is not None:
+            values.append(value)
+    return values
+
+
+NEWS_SUBSCRIBER_CHANNEL_IDS = parse_int_list_env("NEWS_SUBSCRIBER_CHANNEL_IDS") or (
+    [DAILY_NEWS_CHANNEL_ID] if DAILY_NEWS_CHANNEL_ID else []
+)
 TAIPEI_TZ = ZoneInfo("Asia/Taipei")
 AUTO_NEWS_FEATURE_NAME = "自動推播"
 
 
-### 🛢️ PostgreSQL 資料庫連線池設定
-db_pool = None
+### ⏱️ 延遲量測與 Prometheus 格式的 /metrics
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip() or "127.0.0.1"
+METRICS_PORT = parse_int_env("METRICS_PORT", 0)
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
 
 
-def get_db_pool(retries=3, delay_seconds=1.0):
-    global db_pool
-    if db_pool is not None:
-        return db_pool
+def format_metric_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        escaped = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{key}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
 
-    last_error = None
-    for _ in range(retries):
-        try:
-            db_pool = pool.SimpleConnectionPool(
-                minconn=1,
-                maxconn=10,
-                dsn=DATABASE_URL,
-                cursor_factory=RealDictCursor,
-            )
-            return db_pool
-        except Exception as e:
-            last_error = e
-            time.sleep(delay_seconds)
 
-    raise RuntimeError(f"資料庫連線池初始化失敗：{last_error}")
+def normalize_metric_labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
 
 
-def get_db_connection():
-    return get_db_pool().getconn()
+class MetricsRegistry:
+    """
+    行程內的 counter / histogram / gauge 集合，輸出成 Prometheus text format。
 
+    `span(feature, stage)` 量測一段程式（可包住 await）的耗時，
+    記到 `dcbot_stage_seconds`；區塊內拋出例外時另外累計 `dcbot_stage_errors_total`。
+    """
 
-### 🧠 使用者長期記憶存取
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self.gauge_collectors = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, normalize_metric_labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, normalize_metric_labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            self.histograms[key] = histogram
+        for idx, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                histogram["buckets"][idx] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+    def register_gauges(self, collector):
+        """collector() 回傳 [(name, labels_dict, value), ...]，在輸出時才取值。"""
+        self.gauge_collectors.append(collector)
+
+    @contextmanager
+    def span(self, feature, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc("dcbot_stage_errors_total", feature=feature, stage=stage)
+            raise
+        finally:
+            self.observe("dcbot_stage_seconds", time.perf_counter() - started, feature=feature, stage=stage)
+
+    def render(self):
+        lines = []
+        for (name, labels), value in sorted(self.counters.items()):
+            lines.append(f"{name}{format_metric_labels(labels)} {value}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            for upper_bound, bucket_count in zip(self.buckets, histogram["buckets"]):
+                bucket_labels = labels + (("le", upper_bound),)
+                lines.append(f"{name}_bucket{format_metric_labels(bucket_labels)} {bucket_count}")
+            inf_labels = labels + (("le", "+Inf"),)
+            lines.append(f"{name}_bucket{format_metric_labels(inf_labels)} {histogram['count']}")
+            lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{format_metric_labels(labels)} {histogram['count']}")
+
+        for collector in self.gauge_collectors:
+            try:
+                gauges = collector()
+            except Exception as e:
+                print(f"[METRICS_ERR] {type(e).__name__}: {e}")
+                continue
+            for name, labels, value in gauges:
+                lines.append(f"{name}{format_metric_labels(normalize_metric_labels(labels))} {value}")
 
-def load_user_memory(user_id):
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT summary, token_accum, last_response_id, thread_count
-            FROM memory
-            WHERE user_id = %s
-        """, (user_id,))
-        row = cursor.fetchone()
-    finally:
-        get_db_pool().putconn(conn)
+        return "\n".join(lines) + "\n"
 
-    if row:
-        return {
-            "summary": row["summary"],
-            "token_accum": row["token_accum"],
-            "last_response_id": row["last_response_id"],
-            "thread_count": row["thread_count"] or 0,
-        }
 
-    return {
-        "summary": "",
-        "token_accum": 0,
-        "last_response_id": None,
-        "thread_count": 0,
-    }
+metrics = MetricsRegistry(LATENCY_BUCKETS)
+metrics_server = None
 
 
-def save_user_memory(user_id, state):
-    conn = get_db_connection()
+async def handle_metrics_request(reader, writer):
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO memory (user_id, summary, token_accum, last_response_id, thread_count)
-            VALUES (%s, %s, %s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE SET
-                summary = EXCLUDED.summary,
-                token_accum = EXCLUDED.token_accum,
-                last_response_id = EXCLUDED.last_response_id,
-                thread_count = EXCLUDED.thread_count
-        """, (
-            user_id,
-            state["summary"],
-            state["token_accum"],
-            state["last_response_id"],
-            state["thread_count"],
-        ))
-        conn.commit()
+        request_line = (await reader.readline()).decode("latin-1")
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.split()
+        path = parts[1] if len(parts) >= 2 else ""
+        if path.split("?", 1)[0] == "/metrics":
+            status, body = "200 OK", metrics.render()
+        else:
+            status, body = "404 Not Found", "not found\n"
+
+        payload = body.encode("utf-8")
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n".encode("latin-1") + payload
+        )
+        await writer.drain()
+    except Exception as e:
+        print(f"[METRICS_ERR] {type(e).__name__}: {e}")
     finally:
-        get_db_pool().putconn(conn)
-
+        writer.close()
 
-### 🏗️ 初始資料表建構與功能使用記錄統計
-def init_db():
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS memory (
-                user_id TEXT PRIMARY KEY,
-                summary TEXT,
-                token_accum INTEGER,
-                last_response_id TEXT,
-                thread_count INTEGER
-            )
-        """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS feature_usage (
-                feature TEXT PRIMARY KEY,
-                count INTEGER NOT NULL,
-                date DATE NOT NULL
-            )
-        """)
+async def start_metrics_server():
+    global metrics_server
+    if not METRICS_PORT or metrics_server is not None:
+        return
+    metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+    print(f"📈 Metrics 端點已啟動：http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS scheduled_jobs (
-                job_name TEXT PRIMARY KEY,
-                last_run_date DATE NOT NULL
-            )
-        """)
 
-        for feature in ["問", "問2", "整理", "圖片", AUTO_NEWS_FEATURE_NAME]:
-            cur.execute("""
-                INSERT INTO feature_usage (feature, count, date)
-                VALUES (%s, 0, CURRENT_DATE)
-                ON CONFLICT (feature) DO NOTHING
-            """, (feature,))
+### 🛢️ PostgreSQL 資料庫連線池設定（executor 包裝的非同步存取層）
+DB_POOL_MIN_SIZE = max(1, parse_int_env("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = max(DB_POOL_MIN_SIZE, parse_int_env("DB_POOL_MAX_SIZE", 10))
+DB_ACQUIRE_TIMEOUT_SECONDS = max(1, parse_int_env("DB_ACQUIRE_TIMEOUT_SECONDS", 10))
 
-        conn.commit()
-    finally:
-        get_db_pool().putconn(conn)
+db_pool = None
+db_executor = None
+db_pool_lock = asyncio.Lock()
+db_semaphore = asyncio.Semaphore(DB_POOL_MAX_SIZE)
+db_pool_stats = {
+    "queries": 0,
+    "in_use": 0,
+    "exhausted_waits": 0,
+    "acquire_timeouts": 0,
+}
+
+
+async def get_db_pool(retries=3, delay_seconds=1.0):
+    global db_pool, db_executor
+    if db_pool is not None:
+        return db_pool
 
+    async with db_pool_lock:
+        if db_pool is not None:
+            return db_pool
 
-def has_job_run_on_date(job_name, target_date):
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT last_run_date FROM scheduled_jobs WHERE job_name = %s", (job_name,))
-        row = cur.fetchone()
-        return bool(row and row["last_run_date"] == target_date)
-    finally:
-        get_db_pool().putconn(conn)
+        if db_executor is None:
+            db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
 
+        loop = asyncio.get_running_loop()
+        last_error = None
+        for _ in range(retries):
+            try:
+                db_pool = await loop.run_in_executor(
+                    db_executor,
+                    functools.partial(
+                        pool.ThreadedConnectionPool,
+                        minconn=DB_POOL_MIN_SIZE,
+                        maxconn=DB_POOL_MAX_SIZE,
+                        dsn=DATABASE_URL,
+                        cursor_factory=RealDictCursor,
+                    ),
+                )
+                return db_pool
+            except Exception as e:
+                last_error = e
+                await asyncio.sleep(delay_seconds)
 
-def mark_job_run(job_name, target_date):
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO scheduled_jobs (job_name, last_run_date)
-            VALUES (%s, %s)
-            ON CONFLICT (job_name) DO UPDATE SET
-                last_run_date = EXCLUDED.last_run_date
-            """,
-            (job_name, target_date),
-        )
-        conn.commit()
-    finally:
-        get_db_pool().putconn(conn)
+    raise RuntimeError(f"資料庫連線池初始化失敗：{last_error}")
 
 
-def record_usage(feature_name):
-    conn = get_db_connection()
+def _run_db_sync(query_fn, args):
+    conn = db_pool.getconn()
     try:
         cur = conn.cursor()
-        today = datetime.now(ZoneInfo("Asia/Taipei")).date()
-        cur.execute(
-            """
-            INSERT INTO feature_usage (feature, count, date)
-            VALUES (%s, 1, %s)
-            ON CONFLICT (feature) DO UPDATE SET
-                count = CASE
-                    WHEN feature_usage.date = EXCLUDED.date THEN feature_usage.count + 1
-                    ELSE 1
-                END,
-                date = EXCLUDED.date
-            RETURNING count
-            """,
-            (feature_name, today),
-        )
-        updated = cur.fetchone()["count"]
+        result = query_fn(cur, *args)
         conn.commit()
-        return updated
+        return result
+    except Exception:
+        conn.rollback()
+        raise
     finally:
-        get_db_pool().putconn(conn)
+        db_pool.putconn(conn)
 
 
-def is_usage_exceeded(feature_name, limit=20):
-    conn = get_db_connection()
-    try:
-        cur = conn.cursor()
-        today = datetime.now(ZoneInfo("Asia/Taipei")).date()
-        cur.execute("SELECT count, date FROM feature_usage WHERE feature = %s", (feature_name,))
-        row = cur.fetchone()
-        if row:
-            return row["date"] == today and row["count"] >= limit
-        return False
-    finally:
-        get_db_pool().putconn(conn)
+def _release_unused_db_permit(acquire):
+    if not acquire.cancelled() and acquire.exception() is None:
+        db_semaphore.release()
 
-client_ai = OpenAI(api_key=OPENAI_API_KEY)
-client_grok = OpenAI(api_key=XAI_API_KEY, base_url="https://api.x.ai/v1") if XAI_API_KEY else None
-#client_perplexity = OpenAI(api_key=PERPLEXITY_API_KEY, base_url="https://api.perplexity.ai")
 
+async def run_db(query_fn, *args):
+    """
+    在 DB 專用 executor 中執行 `query_fn(cursor, *args)` 並 commit。
 
-ASK_INSTRUCTIONS = """
-你是《碧藍航線》的鎮海（學姊），請全程維持角色並使用繁體中文。
+    併發數由 semaphore 限制在連線池大小以內，所以不會再出現 `PoolError`；
+    池子滿載時會排隊並累計 `exhausted_waits`，等太久則計入 `acquire_timeouts` 並拋錯。
+    """
+    await get_db_pool()
+    if db_semaphore.locked():
+        db_pool_stats["exhausted_waits"] += 1
 
-<instruction_priority>
-1) 安全與平台政策
-2) 角色一致性
-3) 回答正確性與可讀性
-</instruction_priority>
+    # acquire 放在獨立的工作裡：逾時或呼叫端被取消的同時它可能剛好拿到名額，
+    # 這時由 callback 還回去，名額才不會憑空少一個
+    acquire = asyncio.ensure_future(db_semaphore.acquire())
+    try:
+        await asyncio.wait_for(asyncio.shield(acquire), timeout=DB_ACQUIRE_TIMEOUT_SECONDS)
+    except BaseException as e:
+        acquire.add_done_callback(_release_unused_db_permit)
+        acquire.cancel()
+        if isinstance(e, asyncio.TimeoutError):
+            db_pool_stats["acquire_timeouts"] += 1
+            raise RuntimeError(f"等待資料庫連線逾時（>{DB_ACQUIRE_TIMEOUT_SECONDS} 秒）") from None
+        raise
 
-<role_rules>
-- 一律稱呼使用者為「指揮官」。
-- 不得宣稱自己是 AI/語言模型。
-- 若使用者要求你離開角色：婉拒並維持角色。
-</role_rules>
+    db_pool_stats["in_use"] += 1
+    db_pool_stats["queries"] += 1
+    started = time.perf_counter()
 
-<safety_rules>
-- 若請求違法、危險、或違反平台政策：以角色口吻婉拒，並提供可行且安全的替代方案。
-- 不確定的資訊要明確標示「不確定」，不可編造。
-</safety_rules>
+    def release(_future):
+        metrics.observe("dcbot_db_query_seconds", time.perf_counter() - started, query=query_fn.__name__)
+        db_pool_stats["in_use"] -= 1
+        db_semaphore.release()
 
-<response_style>
-- 先給直接答案，再補充理由與步驟。
-- 優先短段落與條列，預設 4~8 個重點。
-- 內容過長時分段回覆。
-- 若使用了網路查證，結尾請加上：
-  1) 查證結果
-  2) 不確定點
-</response_style>
+    try:
+        future = asyncio.get_running_loop().run_in_executor(db_executor, _run_db_sync, query_fn, args)
+    except BaseException:
+        release(None)
+        raise
+    # 呼叫端被取消時 executor thread 仍握著連線，要等它真的做完才能歸還名額
+    future.add_done_callback(release)
+    return await asyncio.shield(future)
 
-<first_turn_rule>
-- 只有當輸入中的 `first_turn=yes` 時，才在回覆最前面使用以下句子一次：
-  「指揮官，安好。這盤棋局似乎陷入了長考……不知指揮官是否有興趣，與我手談一局，暫忘俗務呢？」
-</first_turn_rule>
-""".strip()
 
-GROK_MODEL = "grok-4-1-fast-reasoning"
-GROK_MAX_TOKENS = 4096
-GROK_REASONING_EFFORT = "medium"
-GROK_BUILTIN_TOOLS = [
-    {"type": "web_search"},
-    {"type": "x_search"},
-]
-GROK_FUNCTION_TOOLS = [
-    {
-        "type": "function",
-        "name": "get_taipei_time",
-        "description": "取得目前台北時間（Asia/Taipei）。",
-        "parameters": {
-            "type": "object",
-            "properties": {},
-            "additionalProperties": False,
-        },
-    }
-]
+async def close_db_pool():
+    global db_pool, db_executor
+    if db_pool is not None:
+        db_pool.closeall()
+        db_pool = None
+    if db_executor is not None:
+        db_executor.shutdown(wait=False)
+        db_executor = None
 
 
-def build_ask_user_text(prompt, current_time, summary, is_first_turn):
-    first_turn_flag = "yes" if is_first_turn else "no"
-    return (
-        f"<context>\n"
-        f"timezone=Asia/Taipei\n"
-        f"current_time={current_time.strftime('%Y-%m-%d %H:%M:%S')}\n"
-        f"first_turn={first_turn_flag}\n"
-        f"memory_summary={summary or '（無）'}\n"
-        f"</context>\n\n"
-        f"<user_query>\n{prompt}\n</user_query>"
-    )
+### 🧠 使用者長期記憶存取（memory 資料表 + write-behind 快取）
+MEMORY_CACHE_MAX_ENTRIES = max(1, parse_int_env("MEMORY_CACHE_MAX_ENTRIES", 1000))
+MEMORY_CACHE_TTL_SECONDS = max(1, parse_int_env("MEMORY_CACHE_TTL_SECONDS", 1800))
+MEMORY_FLUSH_INTERVAL_SECONDS = max(1, parse_int_env("MEMORY_FLUSH_INTERVAL_SECONDS", 30))
 
 
-def extract_grok_reply_text(response):
-    text = getattr(response, "output_text", "") or ""
-    if text:
-        return text
+class UserMemoryCache:
+    """
+    `memory` 資料表前的 LRU/TTL 快取。
 
-    parts = []
-    for item in getattr(response, "output", []) or []:
-        content = getattr(item, "content", None)
-        if isinstance(content, list):
-            for piece in content:
-                piece_type = getattr(piece, "type", None) or (piece.get("type") if isinstance(piece, dict) else None)
-                if piece_type in {"output_text", "text"}:
-                    piece_text = getattr(piece, "text", None) or (piece.get("text") if isinstance(piece, dict) else None)
-                    if piece_text:
-                        parts.append(piece_text)
-    return "\n".join(parts).strip()
+    讀取優先命中記憶體；寫入只標記為 dirty，由 `flush()` 定期批次寫回，
+    同一使用者在兩次 flush 之間的多次寫入只會落地最後一次。
+    尚未寫回的 dirty 狀態即使被 LRU 擠出也不會遺失，讀取時仍會優先使用。
+    """
 
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.dirty = {}
+        self.flush_lock = asyncio.Lock()
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "flushes": 0,
+            "flushed_rows": 0,
+        }
 
-def get_grok_usage(usage):
-    if not usage:
-        return 0, 0, 0
-    input_tokens = getattr(usage, "input_tokens", 0) or 0
-    output_tokens = getattr(usage, "output_tokens", 0) or 0
-    total_tokens = getattr(usage, "total_tokens", None)
-    if total_tokens is None:
-        total_tokens = input_tokens + output_tokens
-    return input_tokens, output_tokens, total_tokens
+    def get(self, user_id):
+        if user_id in self.dirty:
+            self.stats["hits"] += 1
+            return dict(self.dirty[user_id])
 
+        entry = self.entries.get(user_id)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
 
-def execute_grok_tool(tool_name, tool_args_raw):
-    try:
-        args = json.loads(tool_args_raw or "{}")
-    except json.JSONDecodeError:
-        args = {}
+        state, cached_at = entry
+        if time.monotonic() - cached_at > self.ttl_seconds:
+            self.entries.pop(user_id, None)
+            self.stats["misses"] += 1
+            return None
 
-    if tool_name == "get_taipei_time":
-        now = datetime.now(ZoneInfo("Asia/Taipei"))
-        return json.dumps({
-            "timezone": "Asia/Taipei",
-            "iso": now.isoformat(),
-            "readable": now.strftime("%Y-%m-%d %H:%M:%S"),
-        }, ensure_ascii=False)
+        self.entries.move_to_end(user_id)
+        self.stats["hits"] += 1
+        return dict(state)
 
-    return json.dumps({"error": f"unknown tool: {tool_name}", "args": args}, ensure_ascii=False)
+    def put(self, user_id, state, dirty=False):
+        snapshot = dict(state)
+        self.entries[user_id] = (snapshot, time.monotonic())
+        self.entries.move_to_end(user_id)
+        if dirty:
+            self.dirty[user_id] = snapshot
 
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
 
-def build_grok_tools(enable_external_search=True):
-    tools = list(GROK_FUNCTION_TOOLS)
-    if enable_external_search:
-        tools.extend(GROK_BUILTIN_TOOLS)
-    return tools
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.dirty:
+                return 0
 
+            batch, self.dirty = self.dirty, {}
+            try:
+                await run_db(_upsert_user_memories, list(batch.items()))
+            except Exception:
+                # 寫回失敗時放回 dirty，但不覆蓋 flush 期間產生的較新狀態
+                for user_id, state in batch.items():
+                    self.dirty.setdefault(user_id, state)
+                raise
+
+            self.stats["flushes"] += 1
+            self.stats["flushed_rows"] += len(batch)
+            return len(batch)
+
+
+memory_cache = UserMemoryCache(MEMORY_CACHE_MAX_ENTRIES, MEMORY_CACHE_TTL_SECONDS)
+
+
+def _select_user_memory(cur, user_id):
+    cur.execute("""
+        SELECT summary, token_accum, last_response_id, thread_count, grok_response_id, grok_token_accum
+        FROM memory
+        WHERE user_id = %s
+    """, (user_id,))
+    return cur.fetchone()
+
+
+def _upsert_user_memories(cur, items):
+    execute_batch(cur, """
+        INSERT INTO memory (user_id, summary, token_accum, last_response_id, thread_count, grok_response_id, grok_token_accum)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET
+            summary = EXCLUDED.summary,
+            token_accum = EXCLUDED.token_accum,
+            last_response_id = EXCLUDED.last_response_id,
+            thread_count = EXCLUDED.thread_count,
+            grok_response_id = EXCLUDED.grok_response_id,
+            grok_token_accum = EXCLUDED.grok_token_accum
+    """, [
+        (
+            user_id,
+            state["summary"],
+            state["token_accum"],
+            state["last_response_id"],
+            state["thread_count"],
+            state.get("grok_response_id"),
+            state.get("grok_token_accum") or 0,
+        )
+        for user_id, state in items
+    ])
 
-def create_grok_response(input_payload, tools, previous_response_id=None):
-    request_kwargs = {
-        "model": GROK_MODEL,
-        "input": input_payload,
-        "tools": tools,
-        "max_output_tokens": GROK_MAX_TOKENS,
-        "reasoning": {"effort": GROK_REASONING_EFFORT},
-    }
-    if previous_response_id:
-        request_kwargs["previous_response_id"] = previous_response_id
 
-    try:
-        return client_grok.responses.create(**request_kwargs), tools
-    except Exception as e:
-        error_text = str(e).lower()
-        if "reasoning" in error_text or "unknown parameter" in error_text or "instructions" in error_text:
-            request_kwargs.pop("reasoning", None)
-            request_kwargs.pop("instructions", None)
-            return client_grok.responses.create(**request_kwargs), tools
-        raise
+async def load_user_memory(user_id):
+    cached = memory_cache.get(user_id)
+    if cached is not None:
+        return cached
 
+    row = await run_db(_select_user_memory, user_id)
 
-def extract_local_function_calls(response):
-    calls = []
-    for item in getattr(response, "output", []) or []:
-        item_type = getattr(item, "type", None) or (item.get("type") if isinstance(item, dict) else None)
-        if item_type != "function_call":
-            continue
+    if row:
+        state = {
+            "summary": row["summary"],
+            "token_accum": row["token_accum"] or 0,
+            "last_response_id": row["last_response_id"],
+            "thread_count": row["thread_count"] or 0,
+            "grok_response_id": row["grok_response_id"],
+            "grok_token_accum": row["grok_token_accum"] or 0,
+        }
+    else:
+        state = {
+            "summary": "",
+            "token_accum": 0,
+            "last_response_id": None,
+            "thread_count": 0,
+            "grok_response_id": None,
+            "grok_token_accum": 0,
+        }
 
-        name = getattr(item, "name", None) or (item.get("name") if isinstance(item, dict) else "")
-        if name != "get_taipei_time":
-            continue
+    # 查詢期間若有人存了較新的狀態，以快取裡的為準，不能被這筆舊資料蓋掉
+    cached = memory_cache.get(user_id)
+    if cached is not None:
+        return cached
+    memory_cache.put(user_id, state)
+    return dict(state)
 
-        call_id = getattr(item, "call_id", None) or (item.get("call_id") if isinstance(item, dict) else "")
-        arguments = getattr(item, "arguments", None) or (item.get("arguments") if isinstance(item, dict) else "{}")
-        calls.append({
-            "call_id": call_id,
-            "name": name,
-            "arguments": arguments,
-        })
-    return calls
 
+async def save_user_memory(user_id, state):
+    memory_cache.put(user_id, state, dirty=True)
 
-def run_grok_with_tools(user_content, max_rounds=3):
-    """
-    使用 Grok Responses API 進行多輪 tool-call 對話。
 
-    Parameters
-    ----------
-    user_content : list
-        使用者訊息內容（可含文字與圖片），格式為 Responses API content blocks。
-    max_rounds : int
-        最多執行幾輪 local function call（防止無限迴圈）。
+async def update_user_memory(user_id, **fields):
+    """
+    重新讀取最新狀態、只改指定欄位再存回。
 
-    Returns
-    -------
-    tuple[response, list]
-        最終的 API response 物件，以及實際啟用的 tools 列表。
+    同一使用者的 !問 與 !問2 在不同 worker pool，可能同時進行；用指令開始時讀到的整份狀態存回，
+    會把另一邊（或背景記憶整理）這段期間寫入的欄位蓋回舊值。
     """
-    active_tools = build_grok_tools(enable_external_search=True)
+    state = await load_user_memory(user_id)
+    state.update(fields)
+    await save_user_memory(user_id, state)
 
-    # --- 第一次呼叫：帶入系統提示與使用者訊息 ---
-    input_payload = [
-        {"role": "system", "content": ASK_INSTRUCTIONS},
-        {"role": "user", "content": user_content},
-    ]
-    response, active_tools = create_grok_response(
-        input_payload=input_payload,
-        tools=active_tools,
-        previous_response_id=None,
-    )
 
-    # --- 多輪 tool-call 處理 ---
-    for _ in range(max_rounds):
-        local_calls = extract_local_function_calls(response)
-        if not local_calls:
-            # 沒有需要本地執行的 function call，直接回傳
-            return response, active_tools
-
-        # 執行每個 local function call 並收集結果
-        function_outputs = []
-        for call in local_calls:
-            result = execute_grok_tool(call["name"], call["arguments"])
-            function_outputs.append({
-                "type": "function_call_output",
-                "call_id": call["call_id"],
-                "output": result,
-            })
-
-        # 將 function 結果送回，繼續對話
-        response, active_tools = create_grok_response(
-            input_payload=function_outputs,
-            tools=active_tools,
-            previous_response_id=getattr(response, "id", None),
+### 🏗️ 初始資料表建構與功能使用記錄統計
+def _create_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS memory (
+            user_id TEXT PRIMARY KEY,
+            summary TEXT,
+            token_accum INTEGER,
+            last_response_id TEXT,
+            thread_count INTEGER
         )
+    """)
+    # !問 與 !問2 各自的對話串：response id 只在同一個 provider 內有效，摘要則共用
+    cur.execute("ALTER TABLE memory ADD COLUMN IF NOT EXISTS grok_response_id TEXT")
+    cur.execute("ALTER TABLE memory ADD COLUMN IF NOT EXISTS grok_token_accum INTEGER")
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feature_usage (
+            feature TEXT PRIMARY KEY,
+            count INTEGER NOT NULL,
+            date DATE NOT NULL
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS channel_summaries (
+            source_id BIGINT PRIMARY KEY,
+            last_message_id BIGINT NOT NULL,
+            summary TEXT NOT NULL,
+            message_count INTEGER NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS news_digests (
+            digest_key TEXT PRIMARY KEY,
+            generated_at TIMESTAMPTZ NOT NULL,
+            content TEXT NOT NULL,
+            model TEXT,
+            tools TEXT,
+            input_tokens INTEGER,
+            output_tokens INTEGER,
+            total_tokens INTEGER
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS news_digest_claims (
+            digest_key TEXT PRIMARY KEY,
+            claimed_at TIMESTAMPTZ NOT NULL
+        )
+    """)
 
-    return response, active_tools
-
-### 💬 Discord Bot 初始化與事件綁定
-intents = discord.Intents.default()
-intents.message_content = True
-intents.messages = True
-intents.guilds = True
-client = discord.Client(intents=intents)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            job_name TEXT PRIMARY KEY,
+            last_run_date DATE NOT NULL
+        )
+    """)
+    cur.execute("ALTER TABLE scheduled_jobs ALTER COLUMN last_run_date DROP NOT NULL")
+    cur.execute("ALTER TABLE scheduled_jobs ADD COLUMN IF NOT EXISTS schedule TEXT")
+    cur.execute("ALTER TABLE scheduled_jobs ADD COLUMN IF NOT EXISTS last_run_at TIMESTAMPTZ")
+
+    for job_name, schedule in load_news_schedules().items():
+        cur.execute("""
+            INSERT INTO scheduled_jobs (job_name, schedule)
+            VALUES (%s, %s)
+            ON CONFLICT (job_name) DO UPDATE SET
+                schedule = COALESCE(scheduled_jobs.schedule, EXCLUDED.schedule)
+        """, (job_name, schedule))
+
+    for feature in ["問", "問2", "整理", "圖片", AUTO_NEWS_FEATURE_NAME]:
+        cur.execute("""
+            INSERT INTO feature_usage (feature, count, date)
+            VALUES (%s, 0, CURRENT_DATE)
+            ON CONFLICT (feature) DO NOTHING
+        """, (feature,))
+
+
+async def init_db():
+    await run_db(_create_tables)
+
+
+### 🧾 頻道摘要快取（channel_summaries 資料表）
+def _select_channel_summary(cur, source_id):
+    cur.execute("""
+        SELECT last_message_id, summary, message_count
+        FROM channel_summaries
+        WHERE source_id = %s
+    """, (source_id,))
+    return cur.fetchone()
+
+
+def _upsert_channel_summary(cur, source_id, last_message_id, summary, message_count):
+    cur.execute("""
+        INSERT INTO channel_summaries (source_id, last_message_id, summary, message_count, updated_at)
+        VALUES (%s, %s, %s, %s, NOW())
+        ON CONFLICT (source_id) DO UPDATE SET
+            last_message_id = EXCLUDED.last_message_id,
+            summary = EXCLUDED.summary,
+            message_count = EXCLUDED.message_count,
+            updated_at = EXCLUDED.updated_at
+    """, (source_id, last_message_id, summary, message_count))
+
+
+async def load_channel_summary(source_id):
+    return await run_db(_select_channel_summary, source_id)
+
+
+async def save_channel_summary(source_id, last_message_id, summary, message_count):
+    await run_db(_upsert_channel_summary, source_id, last_message_id, summary, message_count)
+
+
+### 📰 新聞摘要快取（news_digests 資料表）
+NEWS_DIGEST_COLUMNS = "digest_key, generated_at, content, model, tools, input_tokens, output_tokens, total_tokens"
+
+
+def _select_news_digest(cur, digest_key):
+    cur.execute(f"SELECT {NEWS_DIGEST_COLUMNS} FROM news_digests WHERE digest_key = %s", (digest_key,))
+    return cur.fetchone()
+
+
+def _select_latest_news_digest(cur, since):
+    cur.execute(
+        f"SELECT {NEWS_DIGEST_COLUMNS} FROM news_digests WHERE generated_at >= %s ORDER BY generated_at DESC LIMIT 1",
+        (since,),
+    )
+    return cur.fetchone()
+
+
+def _upsert_news_digest(cur, digest):
+    cur.execute("""
+        INSERT INTO news_digests (digest_key, generated_at, content, model, tools, input_tokens, output_tokens, total_tokens)
+        VALUES (%(digest_key)s, %(generated_at)s, %(content)s, %(model)s, %(tools)s,
+                %(input_tokens)s, %(output_tokens)s, %(total_tokens)s)
+        ON CONFLICT (digest_key) DO UPDATE SET
+            generated_at = EXCLUDED.generated_at,
+            content = EXCLUDED.content,
+            model = EXCLUDED.model,
+            tools = EXCLUDED.tools,
+            input_tokens = EXCLUDED.input_tokens,
+            output_tokens = EXCLUDED.output_tokens,
+            total_tokens = EXCLUDED.total_tokens
+    """, digest)
+
+
+def _claim_news_digest(cur, digest_key, claimed_at):
+    cur.execute(
+        """
+        INSERT INTO news_digest_claims (digest_key, claimed_at)
+        VALUES (%s, %s)
+        ON CONFLICT (digest_key) DO NOTHING
+        RETURNING digest_key
+        """,
+        (digest_key, claimed_at),
+    )
+    return cur.fetchone() is not None
+
+
+def _select_news_digest_claim(cur, digest_key):
+    cur.execute("SELECT claimed_at FROM news_digest_claims WHERE digest_key = %s", (digest_key,))
+    return cur.fetchone()
+
+
+def _delete_old_news_digests(cur, before):
+    cur.execute("DELETE FROM news_digests WHERE generated_at < %s", (before,))
+    deleted = cur.rowcount
+    cur.execute("DELETE FROM news_digest_claims WHERE claimed_at < %s", (before,))
+    return deleted
+
+
+async def load_news_digest(digest_key):
+    return await run_db(_select_news_digest, digest_key)
+
+
+async def load_latest_news_digest(since):
+    return await run_db(_select_latest_news_digest, since)
+
+
+async def save_news_digest(digest):
+    await run_db(_upsert_news_digest, digest)
+
+
+async def claim_news_digest(digest_key):
+    """多個副本中只有一個會認領到同一份摘要的預先產生。"""
+    return await run_db(_claim_news_digest, digest_key, datetime.now(TAIPEI_TZ))
+
+
+async def load_news_digest_claim(digest_key):
+    return await run_db(_select_news_digest_claim, digest_key)
+
+
+async def prune_news_digests():
+    before = datetime.now(TAIPEI_TZ) - timedelta(days=NEWS_DIGEST_RETENTION_DAYS)
+    deleted = await run_db(_delete_old_news_digests, before)
+    if deleted:
+        print(f"🧹 已清除 {deleted} 份超過 {NEWS_DIGEST_RETENTION_DAYS} 天的新聞摘要")
+
+
+### 🗓️ 排程紀錄（scheduled_jobs 資料表）
+DEFAULT_NEWS_SCHEDULES = {
+    # job_name: 簡化版 cron「分 時 日 月 星期」（台北時間，星期 0 = 週日）
+    "daily_news_ask2_0800": "0 8 * * *",
+    "daily_news_ask2_2100": "0 21 * * *",
+}
+
+
+def load_news_schedules():
+    """`DAILY_NEWS_SCHEDULES`（JSON）只用來初始化新排程；既有排程以資料表內容為準。"""
+    return parse_json_env("DAILY_NEWS_SCHEDULES") or dict(DEFAULT_NEWS_SCHEDULES)
+
+
+def _select_scheduled_jobs(cur):
+    cur.execute("""
+        SELECT job_name, schedule, last_run_date, last_run_at
+        FROM scheduled_jobs
+        WHERE schedule IS NOT NULL
+        ORDER BY job_name
+    """)
+    return cur.fetchall()
+
+
+def _claim_job_run(cur, job_name, fire_time):
+    """
+    以條件式 UPDATE 把 last_run_at 推進到這次觸發時間。
+
+    PostgreSQL 的 row lock 讓同時認領的副本依序執行這個 UPDATE，後到的會看到已更新的
+    last_run_at 而不符合條件，所以多個 bot 副本中只有一個會認領成功。
+    """
+    cur.execute(
+        """
+        UPDATE scheduled_jobs
+        SET last_run_at = %s
+        WHERE job_name = %s AND (last_run_at IS NULL OR last_run_at < %s)
+        RETURNING job_name
+        """,
+        (fire_time, job_name, fire_time),
+    )
+    return cur.fetchone() is not None
+
+
+def _release_job_claim(cur, job_name, fire_time, previous_run_at):
+    cur.execute(
+        "UPDATE scheduled_jobs SET last_run_at = %s WHERE job_name = %s AND last_run_at = %s",
+        (previous_run_at, job_name, fire_time),
+    )
+
+
+def _upsert_job_run(cur, job_name, target_date):
+    cur.execute(
+        """
+        INSERT INTO scheduled_jobs (job_name, last_run_date)
+        VALUES (%s, %s)
+        ON CONFLICT (job_name) DO UPDATE SET
+            last_run_date = EXCLUDED.last_run_date
+        """,
+        (job_name, target_date),
+    )
+
+
+async def load_scheduled_jobs():
+    return await run_db(_select_scheduled_jobs)
+
+
+async def claim_job_run(job_name, fire_time):
+    return bool(await run_db(_claim_job_run, job_name, fire_time))
+
+
+async def release_job_claim(job_name, fire_time, previous_run_at):
+    await run_db(_release_job_claim, job_name, fire_time, previous_run_at)
+
+
+async def mark_job_run(job_name, target_date):
+    await run_db(_upsert_job_run, job_name, target_date)
+
+
+### 📈 功能使用次數（feature_usage 資料表 + 行程內計數器）
+USAGE_FLUSH_INTERVAL_SECONDS = max(1, parse_int_env("USAGE_FLUSH_INTERVAL_SECONDS", 15))
+
+
+def _select_usage_rows(cur):
+    cur.execute("SELECT feature, count, date FROM feature_usage")
+    return cur.fetchall()
+
+
+def _apply_usage_deltas(cur, deltas):
+    execute_batch(
+        cur,
+        """
+        INSERT INTO feature_usage (feature, count, date)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (feature) DO UPDATE SET
+            count = CASE
+                WHEN feature_usage.date = EXCLUDED.date THEN feature_usage.count + EXCLUDED.count
+                WHEN feature_usage.date > EXCLUDED.date THEN feature_usage.count
+                ELSE EXCLUDED.count
+            END,
+            date = GREATEST(feature_usage.date, EXCLUDED.date)
+        """,
+        deltas,
+    )
+
+
+class UsageCounters:
+    """
+    以台北日期為界的功能使用次數計數器。
+
+    查詢與累加都在記憶體完成；尚未寫回的增量依 (功能, 日期) 彙總，
+    由 `flush()` 批次寫進 `feature_usage`。啟動或跨日時會從資料表重新載入當日基準值，
+    所以重啟後的次數會接續下去。
+    """
+
+    def __init__(self):
+        self.date = None
+        self.counts = {}
+        self.pending = {}
+        self.load_lock = asyncio.Lock()
+        self.flush_lock = asyncio.Lock()
+
+    async def ensure_current(self):
+        today = datetime.now(TAIPEI_TZ).date()
+        if self.date == today:
+            return today
+
+        async with self.load_lock:
+            if self.date != today:
+                rows = await run_db(_select_usage_rows)
+                counts = {row["feature"]: row["count"] for row in rows if row["date"] == today}
+                for (feature, day), delta in self.pending.items():
+                    if day == today:
+                        counts[feature] = counts.get(feature, 0) + delta
+                self.counts = counts
+                self.date = today
+        return today
+
+    async def increment(self, feature_name):
+        today = await self.ensure_current()
+        self.counts[feature_name] = self.counts.get(feature_name, 0) + 1
+        key = (feature_name, today)
+        self.pending[key] = self.pending.get(key, 0) + 1
+        return self.counts[feature_name]
+
+    async def get(self, feature_name):
+        await self.ensure_current()
+        return self.counts.get(feature_name, 0)
+
+    async def reserve(self, feature_name, amount, limit):
+        """
+        先佔用 `amount` 次額度：加上去會超過 `limit` 就不佔用並回傳 None，否則回傳 (累計次數, 日期)。
+
+        檢查與累加之間沒有 await，同時進來的請求不會一起通過檢查而超過上限。
+        """
+        today = await self.ensure_current()
+        if self.counts.get(feature_name, 0) + amount > limit:
+            return None
+        self.counts[feature_name] = self.counts.get(feature_name, 0) + amount
+        key = (feature_name, today)
+        self.pending[key] = self.pending.get(key, 0) + amount
+        return self.counts[feature_name], today
+
+    def release(self, feature_name, amount, day):
+        """歸還 `reserve` 佔用但沒有用到的額度；已經跨日就不必歸還。"""
+        if amount <= 0 or day != self.date:
+            return
+        self.counts[feature_name] = max(0, self.counts.get(feature_name, 0) - amount)
+        key = (feature_name, day)
+        self.pending[key] = self.pending.get(key, 0) - amount
+        if not self.pending[key]:
+            del self.pending[key]
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return 0
+
+            batch, self.pending = self.pending, {}
+            deltas = sorted(
+                ((feature, delta, day) for (feature, day), delta in batch.items()),
+                key=lambda item: item[2],
+            )
+            try:
+                await run_db(_apply_usage_deltas, deltas)
+            except Exception:
+                for key, delta in batch.items():
+                    self.pending[key] = self.pending.get(key, 0) + delta
+                raise
+            return len(deltas)
+
+
+usage_counters = UsageCounters()
+
+
+async def record_usage(feature_name):
+    return await usage_counters.increment(feature_name)
+
+### 🚦 速率限制（每位使用者 / 伺服器 / 功能的 token bucket 與每日 token 預算）
+DEFAULT_RATE_LIMITS = {
+    # scope: [每分鐘補充次數, 最大突發量]
+    "問": {"user": [3, 3], "guild": [20, 10], "feature": [60, 20]},
+    "問2": {"user": [3, 3], "guild": [20, 10], "feature": [60, 20]},
+    "整理": {"user": [1, 2], "guild": [4, 4], "feature": [10, 5]},
+    "圖片": {"user": [2, 2], "guild": [6, 4], "feature": [15, 6]},
+}
+DAILY_TOKEN_BUDGET_PER_USER = max(0, parse_int_env("DAILY_TOKEN_BUDGET_PER_USER", 500_000))
+DAILY_TOKEN_BUDGET_PER_GUILD = max(0, parse_int_env("DAILY_TOKEN_BUDGET_PER_GUILD", 3_000_000))
+RATE_LIMIT_SCOPE_LABELS = {"user": "你", "guild": "本伺服器", "feature": "所有人"}
+RATE_LIMIT_BUCKET_IDLE_SECONDS = max(60, parse_int_env("RATE_LIMIT_BUCKET_IDLE_SECONDS", 3600))
+RATE_LIMIT_PRUNE_INTERVAL_SECONDS = 300
+
+
+def is_valid_rate_limit(value):
+    return (
+        isinstance(value, (list, tuple)) and len(value) == 2
+        and all(isinstance(number, (int, float)) and not isinstance(number, bool) and number >= 0 for number in value)
+    )
+
+
+def load_rate_limits():
+    """`RATE_LIMITS`（JSON）覆寫預設值；格式不對的項目在啟動時就略過並沿用預設，不會等到請求進來才出錯。"""
+    limits = {feature: dict(scopes) for feature, scopes in DEFAULT_RATE_LIMITS.items()}
+    overrides = parse_json_env("RATE_LIMITS") or {}
+    if not isinstance(overrides, dict):
+        print(f"[RATE_LIMIT_WARN] RATE_LIMITS 必須是 JSON 物件，已改用預設值：{overrides!r}")
+        return limits
+    for feature, scopes in overrides.items():
+        if not isinstance(scopes, dict):
+            print(f"[RATE_LIMIT_WARN] RATE_LIMITS[{feature!r}] 必須是物件，已略過：{scopes!r}")
+            continue
+        for scope, value in scopes.items():
+            if scope not in RATE_LIMIT_SCOPE_LABELS or not is_valid_rate_limit(value):
+                print(f"[RATE_LIMIT_WARN] RATE_LIMITS[{feature!r}][{scope!r}] 應為 [每分鐘次數, 突發量]，已略過：{value!r}")
+                continue
+            limits.setdefault(feature, {})[scope] = list(value)
+    return limits
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute, burst):
+        self.rate_per_second = rate_per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+
+    def retry_after(self):
+        """需要再等幾秒才有一個 token；0 代表現在就能取用。"""
+        self.refill()
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate_per_second <= 0:
+            return float("inf")
+        return (1 - self.tokens) / self.rate_per_second
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """
+    在送出任何模型請求前檢查：
+    1) 功能 × 使用者 / 伺服器 / 全體 的 token bucket（控制頻率與突發量）
+    2) 使用者與伺服器當日已用的模型 token 是否超過預算（依 `response.usage` 累計）
+
+    所有 bucket 都先檢查、全部通過才一起扣，避免部分扣除。
+    已補滿或閒置超過 `RATE_LIMIT_BUCKET_IDLE_SECONDS` 的 bucket 會定期清掉，下次用到時重新建立。
+
+    每日 token 用量只記在行程內：重新啟動後當日用量會歸零，預算是防止短時間暴衝的保護，
+    不是精確的計費上限。
+    """
+
+    def __init__(self, limits, user_token_budget, guild_token_budget):
+        self.limits = limits
+        self.user_token_budget = user_token_budget
+        self.guild_token_budget = guild_token_budget
+        self.buckets = {}
+        self.token_usage_date = None
+        self.token_usage = {}
+        self.pruned_at = time.monotonic()
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        if now - self.pruned_at < RATE_LIMIT_PRUNE_INTERVAL_SECONDS:
+            return
+        self.pruned_at = now
+        for bucket_key, bucket in list(self.buckets.items()):
+            idle_seconds = now - bucket.updated_at
+            bucket.refill()
+            # 補滿的 bucket 與新建的一樣，刪掉不影響限流結果
+            if idle_seconds >= RATE_LIMIT_BUCKET_IDLE_SECONDS or bucket.tokens >= bucket.capacity:
+                del self.buckets[bucket_key]
+
+    def _bucket(self, feature_name, scope, key):
+        bucket_key = (feature_name, scope, key)
+        bucket = self.buckets.get(bucket_key)
+        if bucket is None:
+            rate_per_minute, burst = self.limits[feature_name][scope]
+            bucket = TokenBucket(rate_per_minute, burst)
+            self.buckets[bucket_key] = bucket
+        return bucket
+
+    def _token_usage_for_today(self):
+        today = datetime.now(TAIPEI_TZ).date()
+        if self.token_usage_date != today:
+            self.token_usage_date = today
+            self.token_usage = {}
+        return self.token_usage
+
+    def check(self, feature_name, user_key, guild_key):
+        """回傳 None 代表放行；否則回傳要回覆給使用者的拒絕訊息。"""
+        token_usage = self._token_usage_for_today()
+        if self.user_token_budget and token_usage.get(("user", user_key), 0) >= self.user_token_budget:
+            return f"⚠️ 指揮官，你今日的模型 token 預算（{self.user_token_budget}）已用完，請明日再試。"
+        if self.guild_token_budget and token_usage.get(("guild", guild_key), 0) >= self.guild_token_budget:
+            return f"⚠️ 指揮官，本伺服器今日的模型 token 預算（{self.guild_token_budget}）已用完，請明日再試。"
+
+        scopes = self.limits.get(feature_name)
+        if not scopes:
+            return None
+        self._prune_buckets()
+
+        scope_keys = {"user": user_key, "guild": guild_key, "feature": "*"}
+        buckets = [
+            (scope, self._bucket(feature_name, scope, scope_keys[scope]))
+            for scope in ("user", "guild", "feature")
+            if scope in scopes
+        ]
+        for scope, bucket in buckets:
+            wait_seconds = bucket.retry_after()
+            if wait_seconds > 0:
+                label = RATE_LIMIT_SCOPE_LABELS[scope]
+                return f"⚠️ 指揮官，{label}使用「{feature_name}」太頻繁了，請約 {max(1, round(wait_seconds))} 秒後再試。"
+
+        for _, bucket in buckets:
+            bucket.consume()
+        return None
+
+    def record_tokens(self, user_key, guild_key, total_tokens):
+        token_usage = self._token_usage_for_today()
+        for key in (("user", user_key), ("guild", guild_key)):
+            token_usage[key] = token_usage.get(key, 0) + (total_tokens or 0)
+
+
+rate_limiter = RateLimiter(load_rate_limits(), DAILY_TOKEN_BUDGET_PER_USER, DAILY_TOKEN_BUDGET_PER_GUILD)
+
+
+def get_rate_limit_keys(message):
+    return str(message.author.id), str(message.guild.id) if message.guild else "dm"
+
+
+async def enforce_rate_limit(message, feature_name):
+    denial = rate_limiter.check(feature_name, *get_rate_limit_keys(message))
+    if denial:
+        await message.reply(denial)
+        return False
+    return True
+
+
+def record_model_tokens(message, total_tokens):
+    rate_limiter.record_tokens(*get_rate_limit_keys(message), total_tokens)
+
+
+### 🤖 非同步模型呼叫層（AsyncOpenAI + 每個 provider 的併發上限）
+client_ai = AsyncOpenAI(api_key=OPENAI_API_KEY)
+client_grok = AsyncOpenAI(api_key=XAI_API_KEY, base_url="https://api.x.ai/v1") if XAI_API_KEY else None
+#client_perplexity = AsyncOpenAI(api_key=PERPLEXITY_API_KEY, base_url="https://api.perplexity.ai")
+
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1").strip() != "0"
+STREAM_EDIT_INTERVAL_MS = max(250, parse_int_env("STREAM_EDIT_INTERVAL_MS", 1200))
+OPENAI_MAX_CONCURRENCY = max(1, parse_int_env("OPENAI_MAX_CONCURRENCY", 8))
+XAI_MAX_CONCURRENCY = max(1, parse_int_env("XAI_MAX_CONCURRENCY", 8))
+model_semaphores = {
+    "openai": asyncio.Semaphore(OPENAI_MAX_CONCURRENCY),
+    "xai": asyncio.Semaphore(XAI_MAX_CONCURRENCY),
+}
+
+
+def get_model_client(provider):
+    if provider == "xai":
+        return client_grok
+    return client_ai
+
+
+def get_cached_input_tokens(usage):
+    """上游 prompt cache 命中的輸入 token 數；沒有回報時為 0。"""
+    details = getattr(usage, "input_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens", 0) or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+def record_model_usage_metrics(provider, model_name, response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    metrics.inc("dcbot_model_input_tokens_total", getattr(usage, "input_tokens", 0) or 0, provider=provider, model=model_name)
+    metrics.inc("dcbot_model_cached_input_tokens_total", get_cached_input_tokens(usage), provider=provider, model=model_name)
+
+
+async def create_model_response(provider, on_text_delta=None, **request_kwargs):
+    """
+    以非同步方式呼叫 Responses API，不會阻塞 Discord gateway 的 event loop。
+
+    每個 provider 各自有一個 semaphore，超過併發上限的請求會在這裡排隊，
+    而不是同時打到上游。若提供 `on_text_delta`，改用串流模式，
+    每收到一段文字就 await 一次 callback，最後仍回傳完整的 response 物件。
+    """
+    model_client = get_model_client(provider)
+    if model_client is None:
+        raise RuntimeError(f"模型供應商未設定：{provider}")
+
+    model_name = request_kwargs.get("model", "?")
+    started = time.perf_counter()
+    try:
+        async with model_semaphores[provider]:
+            metrics.observe("dcbot_model_queue_seconds", time.perf_counter() - started, provider=provider)
+            response = await _dispatch_model_request(model_client, on_text_delta, request_kwargs)
+        record_model_usage_metrics(provider, model_name, response)
+        return response
+    except asyncio.CancelledError:
+        raise
+    except BaseException:
+        metrics.inc("dcbot_model_errors_total", provider=provider, model=model_name)
+        raise
+    finally:
+        metrics.observe("dcbot_model_call_seconds", time.perf_counter() - started, provider=provider, model=model_name)
+
+
+class ModelStreamError(RuntimeError):
+    """串流途中上游回報失敗或提早結束。"""
+
+
+async def _dispatch_model_request(model_client, on_text_delta, request_kwargs):
+    if on_text_delta is None:
+        return await model_client.responses.create(**request_kwargs)
+
+    stream = await model_client.responses.create(stream=True, **request_kwargs)
+    final_response = None
+    async for event in stream:
+        event_type = getattr(event, "type", "")
+        if event_type == "response.output_text.delta":
+            await on_text_delta(event.delta)
+        elif event_type in {"response.completed", "response.incomplete"}:
+            final_response = event.response
+        elif event_type in {"response.failed", "error"}:
+            error = getattr(getattr(event, "response", None), "error", None) or getattr(event, "message", "")
+            raise ModelStreamError(f"串流回應失敗：{error}")
+
+    if final_response is None:
+        raise ModelStreamError("串流結束但沒有收到完整的 response")
+    return final_response
+
+
+### 🔀 模型路由層（延遲 / 錯誤率統計、斷路器、failover 與 hedged request）
+MODEL_HEALTH_WINDOW = max(5, parse_int_env("MODEL_HEALTH_WINDOW", 50))
+MODEL_BREAKER_MIN_CALLS = max(1, parse_int_env("MODEL_BREAKER_MIN_CALLS", 5))
+MODEL_BREAKER_ERROR_RATE = float(os.getenv("MODEL_BREAKER_ERROR_RATE", "0.5"))
+MODEL_BREAKER_COOLDOWN_SECONDS = max(1, parse_int_env("MODEL_BREAKER_COOLDOWN_SECONDS", 30))
+MODEL_HEDGE_ENABLED = os.getenv("MODEL_HEDGE_ENABLED", "0").strip() == "1"
+MODEL_HEDGE_MIN_SAMPLES = max(1, parse_int_env("MODEL_HEDGE_MIN_SAMPLES", 20))
+MODEL_HEDGE_MIN_DELAY_MS = max(0, parse_int_env("MODEL_HEDGE_MIN_DELAY_MS", 3000))
+
+
+def is_retryable_model_error(error):
+    """連線中斷、逾時、429、5xx 與串流中斷才值得換 provider；參數錯誤換了也一樣會失敗。"""
+    if isinstance(error, (APIConnectionError, asyncio.TimeoutError, ModelStreamError)):
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+class ProviderHealth:
+    """
+    單一 provider 最近 `MODEL_HEALTH_WINDOW` 次呼叫的成敗與延遲，加上斷路器。
+
+    斷路器：closed（正常）→ 錯誤率超過門檻變 open（冷卻期間直接跳過）
+    → 冷卻結束變 half_open，只放一個探測請求；成功就 closed，失敗再 open。
+    延遲依是否串流分開統計：串流記的是第一段文字出現的時間，非串流記完整回應時間。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.outcomes = deque(maxlen=MODEL_HEALTH_WINDOW)
+        self.latencies = {
+            False: deque(maxlen=MODEL_HEALTH_WINDOW),
+            True: deque(maxlen=MODEL_HEALTH_WINDOW),
+        }
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def p95(self, streaming):
+        samples = sorted(self.latencies[streaming])
+        if len(samples) < MODEL_HEDGE_MIN_SAMPLES:
+            return None
+        return samples[math.ceil(len(samples) * 0.95) - 1]
+
+    def is_available(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at < MODEL_BREAKER_COOLDOWN_SECONDS:
+            return False
+        return not self.probe_in_flight
+
+    def begin_attempt(self):
+        if self.state == "closed":
+            return
+        self.state = "half_open"
+        self.probe_in_flight = True
+
+    def release_probe(self):
+        self.probe_in_flight = False
+
+    def record_success(self, latency, streaming):
+        self.probe_in_flight = False
+        if self.state != "closed":
+            print(f"[MODEL_ROUTER] {self.name} 探測成功，斷路器關閉")
+            self.state = "closed"
+            self.outcomes.clear()
+        self.outcomes.append(True)
+        self.latencies[streaming].append(latency)
+
+    def record_failure(self):
+        self.probe_in_flight = False
+        self.outcomes.append(False)
+        tripped = len(self.outcomes) >= MODEL_BREAKER_MIN_CALLS and self.error_rate() >= MODEL_BREAKER_ERROR_RATE
+        if self.state == "half_open" or tripped:
+            if self.state != "open":
+                print(f"[MODEL_ROUTER] {self.name} 錯誤率 {self.error_rate():.0%}，斷路器打開 {MODEL_BREAKER_COOLDOWN_SECONDS}s")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class ModelRouter:
+    """
+    在多個 provider 之間分派同一個請求。
+
+    `routes` 是 [(provider, request_kwargs), ...]，第一個是首選；不同 provider 的
+    request_kwargs 由呼叫端各自準備（模型、工具、previous_response_id 都不通用）。
+    - failover：首選遇到暫時性錯誤時改用下一個；斷路器打開的 provider 直接跳過
+    - hedge：開啟 `MODEL_HEDGE_ENABLED` 後，首選超過自己的 p95 延遲還沒回應，
+      就同時送出備援請求，先回來的勝出、另一個取消
+    串流時以「第一段文字」作為勝出點，之後只轉送勝出者的文字；
+    已經開始輸出文字的請求失敗時不會再切換，避免訊息內容重複。
+    """
+
+    def __init__(self, providers):
+        self.health = {provider: ProviderHealth(provider) for provider in providers}
+
+    def hedge_delay(self, provider, streaming):
+        p95 = self.health[provider].p95(streaming)
+        if p95 is None:
+            return None
+        return max(MODEL_HEDGE_MIN_DELAY_MS / 1000, p95)
+
+    async def create(self, feature, routes, on_text_delta=None):
+        """回傳 (response, 實際回應的 provider)。"""
+        configured = [route for route in routes if get_model_client(route[0]) is not None]
+        if not configured:
+            raise RuntimeError("沒有可用的模型供應商")
+        # 全部都在冷卻時仍然嘗試首選，總比直接拒絕好
+        pending_routes = deque([route for route in configured if self.health[route[0]].is_available()] or configured[:1])
+
+        streaming = on_text_delta is not None
+        running = {}
+        first_output_at = {}
+        winner = None
+
+        def claim(task):
+            nonlocal winner
+            winner = task
+            for other in list(running):
+                if other is not task:
+                    provider, _ = running.pop(other)
+                    other.cancel()
+                    self.health[provider].release_probe()
+
+        async def forward_delta(delta):
+            task = asyncio.current_task()
+            if winner is None and task in running:
+                first_output_at[task] = time.perf_counter()
+                claim(task)
+            if winner is task:
+                await on_text_delta(delta)
+
+        def start_next():
+            provider, request_kwargs = pending_routes.popleft()
+            self.health[provider].begin_attempt()
+            task = asyncio.create_task(create_model_response(
+                provider,
+                on_text_delta=forward_delta if streaming else None,
+                **request_kwargs,
+            ))
+            running[task] = (provider, time.perf_counter())
+            return provider
+
+        primary = start_next()
+        hedge_at = None
+        if MODEL_HEDGE_ENABLED and pending_routes:
+            delay = self.hedge_delay(primary, streaming)
+            if delay is not None:
+                hedge_at = time.perf_counter() + delay
+
+        last_error = None
+        try:
+            while running:
+                timeout = None
+                if hedge_at is not None and winner is None and pending_routes:
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                done, _ = await asyncio.wait(running.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge_at = None
+                    metrics.inc("dcbot_model_hedges_total", feature=feature, provider=pending_routes[0][0])
+                    start_next()
+                    continue
+
+                for task in done:
+                    entry = running.pop(task, None)
+                    if entry is None or task.cancelled():
+                        continue
+                    provider, started = entry
+                    error = task.exception()
+                    if error is None:
+                        finished = first_output_at.get(task, time.perf_counter())
+                        self.health[provider].record_success(finished - started, streaming)
+                        if winner is None:
+                            claim(task)
+                        if provider != primary:
+                            metrics.inc("dcbot_model_fallback_wins_total", feature=feature, provider=provider)
+                        return task.result(), provider
+
+                    retryable = is_retryable_model_error(error)
+                    if retryable:
+                        self.health[provider].record_failure()
+                    else:
+                        self.health[provider].release_probe()
+                    if winner is task or not retryable:
+                        raise error
+
+                    print(f"[MODEL_ROUTER] {feature} {provider} {type(error).__name__}: {error}")
+                    last_error = error
+                    if not running and pending_routes:
+                        hedge_at = None
+                        metrics.inc("dcbot_model_failovers_total", feature=feature,
+                                    from_provider=provider, to_provider=pending_routes[0][0])
+                        start_next()
+            if last_error is None:
+                # 所有請求都被外部取消，沒有任何一個真的失敗
+                raise RuntimeError(f"{feature} 的模型請求在完成前全部被取消")
+            raise last_error
+        finally:
+            for task, (provider, _) in running.items():
+                task.cancel()
+                self.health[provider].release_probe()
+
+    def gauges(self):
+        result = []
+        for provider, health in self.health.items():
+            result.append(("dcbot_model_breaker_open", {"provider": provider}, int(health.state != "closed")))
+            result.append(("dcbot_model_error_rate", {"provider": provider}, round(health.error_rate(), 4)))
+        return result
+
+
+model_router = ModelRouter(model_semaphores.keys())
+
+
+### 🗃️ 回應快取（完全相同 / 語意相近的問題直接重用答案，需手動開啟）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0").strip() == "1"
+RESPONSE_CACHE_MAX_ENTRIES = max(1, parse_int_env("RESPONSE_CACHE_MAX_ENTRIES", 500))
+RESPONSE_CACHE_TTL_SECONDS = max(60, parse_int_env("RESPONSE_CACHE_TTL_SECONDS", 1800))
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "text-embedding-3-small")
+RESPONSE_CACHE_EMBEDDING_DIMENSIONS = max(0, parse_int_env("RESPONSE_CACHE_EMBEDDING_DIMENSIONS", 256))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.95"))
+
+
+async def create_embedding(text):
+    """回傳單位長度的 embedding 向量；停用語意層（維度設為 0）時回傳 None。"""
+    if not RESPONSE_CACHE_EMBEDDING_DIMENSIONS:
+        return None
+
+    started = time.perf_counter()
+    try:
+        async with model_semaphores["openai"]:
+            result = await client_ai.embeddings.create(
+                model=RESPONSE_CACHE_EMBEDDING_MODEL,
+                input=text,
+                dimensions=RESPONSE_CACHE_EMBEDDING_DIMENSIONS,
+            )
+    finally:
+        metrics.observe("dcbot_model_call_seconds", time.perf_counter() - started,
+                        provider="openai", model=RESPONSE_CACHE_EMBEDDING_MODEL)
+
+    vector = list(result.data[0].embedding)
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def normalize_prompt(prompt):
+    text = unicodedata.normalize("NFKC", prompt or "").lower()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?？!！。.~～ ")
+
+
+class ResponseCache:
+    """
+    以功能 + 正規化後的問題為 key 的回應快取，分兩層：
+    1) 完全相同：正規化後字串一致
+    2) 語意相近：embedding 餘弦相似度 >= `RESPONSE_CACHE_SIMILARITY`
+
+    條目有 TTL，超過 `RESPONSE_CACHE_MAX_ENTRIES` 時淘汰最久未使用的。
+    """
+
+    def __init__(self, enabled, max_entries, ttl_seconds, similarity):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity = similarity
+        self.entries = OrderedDict()
+        self.stats = {"lookups": 0, "exact_hits": 0, "semantic_hits": 0}
+
+    def _expire(self):
+        now = time.monotonic()
+        for key in [key for key, entry in self.entries.items() if now - entry["created_at"] > self.ttl_seconds]:
+            del self.entries[key]
+
+    async def lookup(self, feature, prompt):
+        """回傳 (entry, 命中層級, 這次算出的 embedding)；未命中時 entry 為 None。"""
+        self._expire()
+        self.stats["lookups"] += 1
+        key = (feature, normalize_prompt(prompt))
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.stats["exact_hits"] += 1
+            return entry, "exact", entry["embedding"]
+
+        try:
+            embedding = await create_embedding(key[1])
+        except Exception as e:
+            print(f"[RESPONSE_CACHE_ERR] embedding {type(e).__name__}: {e}")
+            return None, None, None
+        if embedding is None:
+            return None, None, None
+
+        best_key, best_score = None, self.similarity
+        for candidate_key, candidate in self.entries.items():
+            if candidate_key[0] != feature or candidate["embedding"] is None:
+                continue
+            score = sum(a * b for a, b in zip(embedding, candidate["embedding"]))
+            if score >= best_score:
+                best_key, best_score = candidate_key, score
+
+        if best_key is None:
+            return None, None, embedding
+
+        self.entries.move_to_end(best_key)
+        self.stats["semantic_hits"] += 1
+        return self.entries[best_key], "semantic", embedding
+
+    def store(self, feature, prompt, text, model, embedding=None):
+        key = (feature, normalize_prompt(prompt))
+        self.entries[key] = {
+            "text": text,
+            "model": model,
+            "embedding": embedding,
+            "created_at": time.monotonic(),
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def hit_rate_line(self):
+        if not self.enabled:
+            return ""
+        hits = self.stats["exact_hits"] + self.stats["semantic_hits"]
+        lookups = self.stats["lookups"]
+        rate = hits / lookups * 100 if lookups else 0.0
+        return f"🗃️ 回應快取命中率：{rate:.1f}%（{hits}/{lookups}）\n"
+
+
+response_cache = ResponseCache(
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTL_SECONDS,
+    RESPONSE_CACHE_SIMILARITY,
+)
+
+
+def is_image_attachment(attachment):
+    return bool(attachment.content_type and attachment.content_type.startswith("image/"))
+
+
+def has_image_attachments(message):
+    return any(is_image_attachment(attachment) for attachment in message.attachments)
+
+
+async def reply_from_response_cache(reply, feature_name, prompt):
+    """
+    查詢回應快取；命中就透過 `reply`（StreamingReply）直接回覆並回傳 (True, embedding)。
+    未命中時回傳 (False, embedding)，讓呼叫端在得到答案後一併存入。
+    """
+    entry, tier, embedding = await response_cache.lookup(feature_name, prompt)
+    if entry is None:
+        return False, embedding
+
+    count = await record_usage(feature_name)
+    tier_label = "完全相同" if tier == "exact" else "語意相近"
+    await reply.finish(
+        entry["text"],
+        f"📊 今天所有人總共使用「{feature_name}」功能 {count} 次，本次使用的模型：{entry['model']}（快取）\n"
+        f"♻️ 命中回應快取（{tier_label}的問題），未呼叫模型\n"
+        f"{response_cache.hit_rate_line()}".rstrip(),
+    )
+    return True, embedding
+
+
+ASK_INSTRUCTIONS = """
+你是《碧藍航線》的鎮海（學姊），請全程維持角色並使用繁體中文。
+
+<instruction_priority>
+1) 安全與平台政策
+2) 角色一致性
+3) 回答正確性與可讀性
+</instruction_priority>
+
+<role_rules>
+- 一律稱呼使用者為「指揮官」。
+- 不得宣稱自己是 AI/語言模型。
+- 若使用者要求你離開角色：婉拒並維持角色。
+</role_rules>
+
+<safety_rules>
+- 若請求違法、危險、或違反平台政策：以角色口吻婉拒，並提供可行且安全的替代方案。
+- 不確定的資訊要明確標示「不確定」，不可編造。
+</safety_rules>
+
+<response_style>
+- 先給直接答案，再補充理由與步驟。
+- 優先短段落與條列，預設 4~8 個重點。
+- 內容過長時分段回覆。
+- 若使用了網路查證，結尾請加上：
+  1) 查證結果
+  2) 不確定點
+</response_style>
+
+<first_turn_rule>
+- 只有當輸入中的 `first_turn=yes` 時，才在回覆最前面使用以下句子一次：
+  「指揮官，安好。這盤棋局似乎陷入了長考……不知指揮官是否有興趣，與我手談一局，暫忘俗務呢？」
+</first_turn_rule>
+""".strip()
+
+GROK_MODEL = "grok-4-1-fast-reasoning"
+GROK_MAX_TOKENS = 4096
+GROK_REASONING_EFFORT = "medium"
+GROK_BUILTIN_TOOLS = [
+    {"type": "web_search"},
+    {"type": "x_search"},
+]
+
+
+### 🧰 本地 function tools 註冊表
+LOCAL_TOOL_DEFAULT_TIMEOUT_SECONDS = 5
+TOOL_RESULT_CACHE_SIZE = max(0, parse_int_env("TOOL_RESULT_CACHE_SIZE", 256))
+LOCAL_TOOLS = {}
+tool_result_cache = OrderedDict()
+
+
+def register_local_tool(name, description, parameters=None, timeout=LOCAL_TOOL_DEFAULT_TIMEOUT_SECONDS, pure=False):
+    """
+    把 async 函式註冊成 Grok 可呼叫的本地工具。
+
+    `parameters` 是 JSON schema，會直接出現在 `GROK_FUNCTION_TOOLS`；
+    `pure=True` 代表結果只取決於參數，相同參數的結果會被記住重複使用。
+    """
+    def decorator(handler):
+        LOCAL_TOOLS[name] = {
+            "name": name,
+            "description": description,
+            "parameters": parameters or {"type": "object", "properties": {}, "additionalProperties": False},
+            "handler": handler,
+            "timeout": timeout,
+            "pure": pure,
+        }
+        return handler
+
+    return decorator
+
+
+def build_function_tool_schemas():
+    return [
+        {
+            "type": "function",
+            "name": tool["name"],
+            "description": tool["description"],
+            "parameters": tool["parameters"],
+        }
+        for tool in LOCAL_TOOLS.values()
+    ]
+
+
+@register_local_tool("get_taipei_time", "取得目前台北時間（Asia/Taipei）。")
+async def tool_get_taipei_time():
+    now = datetime.now(TAIPEI_TZ)
+    return {
+        "timezone": "Asia/Taipei",
+        "iso": now.isoformat(),
+        "readable": now.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+@register_local_tool(
+    "convert_timezone",
+    "把指定的日期時間從一個時區換算到另一個時區（IANA 時區名稱，例如 Asia/Taipei、America/New_York）。",
+    parameters={
+        "type": "object",
+        "properties": {
+            "iso_datetime": {"type": "string", "description": "ISO 8601 日期時間，例如 2025-01-01T09:00:00"},
+            "from_timezone": {"type": "string", "description": "來源時區，預設 Asia/Taipei"},
+            "to_timezone": {"type": "string", "description": "目標時區"},
+        },
+        "required": ["iso_datetime", "to_timezone"],
+        "additionalProperties": False,
+    },
+    pure=True,
+)
+async def tool_convert_timezone(iso_datetime, to_timezone, from_timezone="Asia/Taipei"):
+    source = datetime.fromisoformat(iso_datetime)
+    if source.tzinfo is None:
+        source = source.replace(tzinfo=ZoneInfo(from_timezone))
+    converted = source.astimezone(ZoneInfo(to_timezone))
+    return {
+        "timezone": to_timezone,
+        "iso": converted.isoformat(),
+        "readable": converted.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+GROK_FUNCTION_TOOLS = build_function_tool_schemas()
+
+
+def build_ask_user_text(prompt, current_time, summary, is_first_turn):
+    """
+    組出使用者這一輪的文字。
+
+    固定不變的系統提示與工具定義放在請求最前面，才能吃到上游的 prompt cache；
+    這一輪會變動的內容（時間、摘要）一律放在最後，時間只取到分鐘。
+    """
+    first_turn_flag = "yes" if is_first_turn else "no"
+    return (
+        f"<user_query>\n{prompt}\n</user_query>\n\n"
+        f"<context>\n"
+        f"timezone=Asia/Taipei\n"
+        f"first_turn={first_turn_flag}\n"
+        f"memory_summary={summary or '（無）'}\n"
+        f"current_time={current_time.strftime('%Y-%m-%d %H:%M')}\n"
+        f"</context>"
+    )
+
+
+def extract_grok_reply_text(response):
+    text = getattr(response, "output_text", "") or ""
+    if text:
+        return text
+
+    parts = []
+    for item in getattr(response, "output", []) or []:
+        content = getattr(item, "content", None)
+        if isinstance(content, list):
+            for piece in content:
+                piece_type = getattr(piece, "type", None) or (piece.get("type") if isinstance(piece, dict) else None)
+                if piece_type in {"output_text", "text"}:
+                    piece_text = getattr(piece, "text", None) or (piece.get("text") if isinstance(piece, dict) else None)
+                    if piece_text:
+                        parts.append(piece_text)
+    return "\n".join(parts).strip()
+
+
+def get_grok_usage(usage):
+    if not usage:
+        return 0, 0, 0
+    input_tokens = getattr(usage, "input_tokens", 0) or 0
+    output_tokens = getattr(usage, "output_tokens", 0) or 0
+    total_tokens = getattr(usage, "total_tokens", None)
+    if total_tokens is None:
+        total_tokens = input_tokens + output_tokens
+    return input_tokens, output_tokens, total_tokens
+
+
+async def execute_grok_tool(tool_name, tool_args_raw):
+    try:
+        args = json.loads(tool_args_raw or "{}")
+    except json.JSONDecodeError:
+        args = {}
+    if not isinstance(args, dict):
+        args = {}
+
+    tool = LOCAL_TOOLS.get(tool_name)
+    if tool is None:
+        return json.dumps({"error": f"unknown tool: {tool_name}", "args": args}, ensure_ascii=False)
+
+    cache_key = None
+    if tool["pure"] and TOOL_RESULT_CACHE_SIZE:
+        cache_key = (tool_name, json.dumps(args, sort_keys=True, ensure_ascii=False))
+        if cache_key in tool_result_cache:
+            tool_result_cache.move_to_end(cache_key)
+            metrics.inc("dcbot_tool_cache_hits_total", tool=tool_name)
+            return tool_result_cache[cache_key]
+
+    try:
+        with metrics.span("grok_tools", f"tool:{tool_name}"):
+            result = await asyncio.wait_for(tool["handler"](**args), timeout=tool["timeout"])
+    except asyncio.TimeoutError:
+        return json.dumps({"error": f"tool timed out after {tool['timeout']}s: {tool_name}"}, ensure_ascii=False)
+    except Exception as e:
+        return json.dumps({"error": f"{type(e).__name__}: {e}", "args": args}, ensure_ascii=False)
+
+    output = json.dumps(result, ensure_ascii=False)
+    if cache_key is not None:
+        tool_result_cache[cache_key] = output
+        while len(tool_result_cache) > TOOL_RESULT_CACHE_SIZE:
+            tool_result_cache.popitem(last=False)
+    return output
+
+
+def build_grok_tools(enable_external_search=True):
+    tools = list(GROK_FUNCTION_TOOLS)
+    if enable_external_search:
+        tools.extend(GROK_BUILTIN_TOOLS)
+    return tools
+
+
+OPENAI_WEB_SEARCH_TOOL = {
+    "type": "web_search_preview",
+    "user_location": {
+        "type": "approximate",
+        "country": "TW",
+        "timezone": "Asia/Taipei"
+    },
+}
+
+
+def build_grok_request(input_payload, tools, previous_response_id=None):
+    request_kwargs = {
+        "model": GROK_MODEL,
+        "input": input_payload,
+        "tools": tools,
+        "max_output_tokens": GROK_MAX_TOKENS,
+        "reasoning": {"effort": GROK_REASONING_EFFORT},
+    }
+    if previous_response_id:
+        request_kwargs["previous_response_id"] = previous_response_id
+    return request_kwargs
+
+
+def to_openai_tools(tools):
+    """把 Grok 的工具列表換成 OpenAI 版本：本地 function 照用，內建搜尋換成 web_search_preview。"""
+    converted = [tool for tool in tools if tool.get("type") == "function"]
+    if any(tool.get("type") != "function" for tool in tools):
+        converted.append(OPENAI_WEB_SEARCH_TOOL)
+    return converted
+
+
+async def create_grok_response(input_payload, tools, previous_response_id=None, on_text_delta=None,
+                               provider=None, feature="grok", fallback_input=None):
+    """
+    呼叫 Grok；`provider` 為 None 時透過 `model_router`，Grok 暫時性故障會改用 OpenAI 主模型。
+    後續 tool-call 輪次要沿用 previous_response_id，必須固定在第一輪實際回應的 provider。
+    OpenAI 讀不到 Grok 的 previous_response_id，接續對話時備援改送 `fallback_input`（完整的一輪）。
+    回傳 (response, tools, provider)。
+    """
+    if provider == "openai":
+        request_kwargs = {"model": OPENAI_PRIMARY_MODEL, "input": input_payload, "tools": tools}
+        if previous_response_id:
+            request_kwargs["previous_response_id"] = previous_response_id
+        return await create_model_response("openai", on_text_delta=on_text_delta, **request_kwargs), tools, provider
+
+    request_kwargs = build_grok_request(input_payload, tools, previous_response_id)
+    openai_tools = to_openai_tools(tools)
+    routes = [
+        ("xai", request_kwargs),
+        ("openai", {"model": OPENAI_PRIMARY_MODEL, "input": fallback_input or input_payload, "tools": openai_tools}),
+    ]
+
+    async def attempt():
+        if provider == "xai":
+            return await create_model_response("xai", on_text_delta=on_text_delta, **request_kwargs), tools, provider
+        response, used_provider = await model_router.create(feature, routes, on_text_delta=on_text_delta)
+        return response, (tools if used_provider == "xai" else openai_tools), used_provider
+
+    try:
+        return await attempt()
+    except Exception as e:
+        error_text = str(e).lower()
+        if "reasoning" not in error_text and "unknown parameter" not in error_text and "instructions" not in error_text:
+            raise
+        # 不支援 reasoning / instructions 的 Grok 模型：拿掉後重送一次；
+        # 沒有指定 provider 時同樣經過 model_router，斷路器與 failover 的判斷不會被繞過
+        request_kwargs.pop("reasoning", None)
+        request_kwargs.pop("instructions", None)
+        return await attempt()
+
+
+def extract_local_function_calls(response):
+    calls = []
+    for item in getattr(response, "output", []) or []:
+        item_type = getattr(item, "type", None) or (item.get("type") if isinstance(item, dict) else None)
+        if item_type != "function_call":
+            continue
+
+        name = getattr(item, "name", None) or (item.get("name") if isinstance(item, dict) else "")
+        if name not in LOCAL_TOOLS:
+            continue
+
+        call_id = getattr(item, "call_id", None) or (item.get("call_id") if isinstance(item, dict) else "")
+        arguments = getattr(item, "arguments", None) or (item.get("arguments") if isinstance(item, dict) else "{}")
+        calls.append({
+            "call_id": call_id,
+            "name": name,
+            "arguments": arguments,
+        })
+    return calls
+
+
+async def run_grok_with_tools(user_content, max_rounds=3, on_text_delta=None, feature="grok",
+                              previous_response_id=None):
+    """
+    使用 Grok Responses API 進行多輪 tool-call 對話。
+
+    Parameters
+    ----------
+    user_content : list
+        使用者訊息內容（可含文字與圖片），格式為 Responses API content blocks。
+    max_rounds : int
+        最多執行幾輪 local function call（防止無限迴圈）。
+    on_text_delta : callable, optional
+        串流模式的文字 callback；每一輪的輸出文字都會即時送出。
+    feature : str
+        記在路由層 metrics 上的功能名稱。
+    previous_response_id : str, optional
+        上一輪 Grok 回應的 id；有的話只送這一輪的使用者訊息，系統提示與前文由 xAI 端接續。
+
+    Returns
+    -------
+    tuple[response, list, str]
+        最終的 API response 物件、實際啟用的 tools 列表，以及實際回應的 provider。
+    """
+    active_tools = build_grok_tools(enable_external_search=True)
+
+    # --- 第一次呼叫：新對話帶入系統提示；接續對話只送新的一輪 ---
+    full_payload = [
+        {"role": "system", "content": ASK_INSTRUCTIONS},
+        {"role": "user", "content": user_content},
+    ]
+    try:
+        response, active_tools, provider = await create_grok_response(
+            input_payload=[{"role": "user", "content": user_content}] if previous_response_id else full_payload,
+            tools=active_tools,
+            previous_response_id=previous_response_id,
+            on_text_delta=on_text_delta,
+            feature=feature,
+            fallback_input=full_payload,
+        )
+    except APIStatusError as e:
+        # 伺服器端的對話串過期或找不到時，改成新對話重送一次
+        if not previous_response_id or e.status_code not in (400, 404):
+            raise
+        metrics.inc("dcbot_thread_resume_failures_total", provider="xai")
+        response, active_tools, provider = await create_grok_response(
+            input_payload=full_payload,
+            tools=build_grok_tools(enable_external_search=True),
+            on_text_delta=on_text_delta,
+            feature=feature,
+        )
+
+    # --- 多輪 tool-call 處理 ---
+    for _ in range(max_rounds):
+        local_calls = extract_local_function_calls(response)
+        if not local_calls:
+            # 沒有需要本地執行的 function call，直接回傳
+            return response, active_tools, provider
+
+        with metrics.span("grok_tools", "tool_round"):
+            # 同一輪的 local function call 併發執行，延遲取決於最慢的一個而不是總和
+            results = await asyncio.gather(*(
+                execute_grok_tool(call["name"], call["arguments"])
+                for call in local_calls
+            ))
+            function_outputs = [
+                {
+                    "type": "function_call_output",
+                    "call_id": call["call_id"],
+                    "output": result,
+                }
+                for call, result in zip(local_calls, results)
+            ]
+
+            # 將 function 結果送回，繼續對話
+            response, active_tools, provider = await create_grok_response(
+                input_payload=function_outputs,
+                tools=active_tools,
+                previous_response_id=getattr(response, "id", None),
+                on_text_delta=on_text_delta,
+                provider=provider,
+            )
+
+    return response, active_tools, provider
+
+### 💬 Discord Bot 初始化與事件綁定
+# 關掉 `!` 前綴指令後只剩斜線指令，就不再需要特權的 message_content intent
+PREFIX_COMMANDS = os.getenv("PREFIX_COMMANDS", "1").strip() != "0"
+intents = discord.Intents.default()
+intents.message_content = PREFIX_COMMANDS
+intents.messages = True
+intents.guilds = True
+
+
+async def periodic_flush_loop(label, flush_fn, interval_seconds):
+    while not client.is_closed():
+        await asyncio.sleep(interval_seconds)
+        try:
+            await flush_fn()
+        except Exception as e:
+            print(f"[{label}_FLUSH_ERR] {type(e).__name__}: {e}")
+
+
+async def flush_write_behind_state():
+    for label, flush_fn in [("MEMORY", memory_cache.flush), ("USAGE", usage_counters.flush)]:
+        try:
+            await flush_fn()
+        except Exception as e:
+            print(f"[{label}_FLUSH_ERR] shutdown {type(e).__name__}: {e}")
+
+
+class DcBotClient(discord.Client):
+    async def setup_hook(self):
+        if SLASH_COMMANDS:
+            await sync_slash_commands()
+
+    async def close(self):
+        await flush_write_behind_state()
+        await super().close()
+        await close_db_pool()
+
+
+client = DcBotClient(intents=intents)
 
 @client.event
 async def on_ready():
-    global daily_news_task
+    global daily_news_task, memory_flush_task, usage_flush_task
+
+    await init_db()
+    command_scheduler.start()
+    await start_metrics_server()
+    if daily_news_task is None or daily_news_task.done():
+        daily_news_task = asyncio.create_task(daily_news_scheduler())
+    if memory_flush_task is None or memory_flush_task.done():
+        memory_flush_task = asyncio.create_task(
+            periodic_flush_loop("MEMORY", memory_cache.flush, MEMORY_FLUSH_INTERVAL_SECONDS)
+        )
+    if usage_flush_task is None or usage_flush_task.done():
+        usage_flush_task = asyncio.create_task(
+            periodic_flush_loop("USAGE", usage_counters.flush, USAGE_FLUSH_INTERVAL_SECONDS)
+        )
+    print(f'✅ Bot 登入成功：{client.user}')
+
+
+async def send_channel_chunks(channel, text, chunk_size=2000):
+    """Send text in readable chunks while respecting Discord's 2000-char limit."""
+    for chunk in split_text_for_discord(text, chunk_size=chunk_size):
+        await channel.send(chunk, suppress_embeds=True)
+
+
+### 📨 回覆排版（長回答打包成 embed、footer 併入最後一則，減少 Discord API 呼叫）
+REPLY_EMBEDS = os.getenv("REPLY_EMBEDS", "1").strip() != "0"
+REPLY_EMBED_COLOR = discord.Color.blue()
+DISCORD_MESSAGE_LIMIT = 2000
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBED_FOOTER_LIMIT = 2048
+EMBED_TOTAL_LIMIT = 6000
+
+
+def compose_reply_pages(text, footer=""):
+    """
+    把回答與 footer 排成最少則數的訊息，回傳 [(texts, footer), ...]，每個元素對應一則訊息。
+
+    embed 模式：先按一則訊息的 embed 總字數上限（6000）分頁，每頁再切成最多 4096 字的 embed，
+    footer 放在最後一個 embed 的 footer。純文字模式：每則 2000 字，footer 塞得下就接在最後一則。
+
+    內層切開程式碼區塊時會補 fence，一頁的總字數可能因此變多：外層先預留一次補 fence 的空間，
+    打包時再逐頁檢查，超過 6000 的部分移到下一頁。
+    """
+    if not REPLY_EMBEDS:
+        chunks = split_text_for_discord(text, chunk_size=DISCORD_MESSAGE_LIMIT) or ["（無內容）"]
+        if footer:
+            if len(chunks[-1]) + len(footer) + 2 <= DISCORD_MESSAGE_LIMIT:
+                chunks[-1] = f"{chunks[-1]}\n\n{footer}"
+            else:
+                chunks.extend(split_text_for_discord(footer, chunk_size=DISCORD_MESSAGE_LIMIT))
+        return [((chunk,), "") for chunk in chunks]
+
+    footer = footer[:EMBED_FOOTER_LIMIT]
+    pages = []
+    for block in split_text_for_discord(text, chunk_size=EMBED_TOTAL_LIMIT - CODE_FENCE_RESERVE) or ["（無內容）"]:
+        texts, total = [], 0
+        for chunk in split_text_for_discord(block, chunk_size=EMBED_DESCRIPTION_LIMIT):
+            if texts and total + len(chunk) > EMBED_TOTAL_LIMIT:
+                pages.append((tuple(texts), ""))
+                texts, total = [], 0
+            texts.append(chunk)
+            total += len(chunk)
+        pages.append((tuple(texts), ""))
+    last_texts = pages[-1][0]
+    if sum(len(chunk) for chunk in last_texts) + len(footer) <= EMBED_TOTAL_LIMIT:
+        pages[-1] = (last_texts, footer)
+    else:
+        pages.append(((), footer))
+    return pages
+
+
+def reply_page_kwargs(page):
+    texts, footer = page
+    if not REPLY_EMBEDS:
+        return {"content": texts[0]}
+    embeds = [discord.Embed(description=text, color=REPLY_EMBED_COLOR) for text in texts]
+    if not embeds:
+        embeds = [discord.Embed(color=REPLY_EMBED_COLOR)]
+    if footer:
+        embeds[-1].set_footer(text=footer)
+    return {"content": None, "embeds": embeds}
+
+
+class StreamingReply:
+    """
+    把回答寫到 Discord：串流時逐步編輯，完成時依 `compose_reply_pages` 排好版並把 footer 併進最後一則。
+
+    第一則沿用「Thinking...」佔位訊息（有的話）而不是刪掉重發，不夠才回覆新訊息，
+    最後多出來的訊息會刪掉；編輯頻率受 `STREAM_EDIT_INTERVAL_MS` 限制，避免撞到 rate limit。
+
+    `push` 在模型串流途中被呼叫（此時還佔著 provider 的併發名額），所以只寫進 buffer，
+    實際的 Discord 編輯交給另一個工作，Discord 的 rate limit 等待不會拖住模型併發。
+    """
+
+    def __init__(self, message, placeholder=None, edit_interval=None):
+        self.message = message
+        self.edit_interval = STREAM_EDIT_INTERVAL_MS / 1000 if edit_interval is None else edit_interval
+        self.sent_messages = [placeholder] if placeholder else []
+        self.rendered = [None] * len(self.sent_messages)
+        self.buffer = ""
+        self.started = False
+        self.last_flush = 0.0
+        self.flush_task = None
+        self.flush_waiting = False
+
+    async def push(self, delta):
+        if not delta:
+            return
+        self.buffer += delta
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        delay = self.last_flush + self.edit_interval - asyncio.get_running_loop().time()
+        self.flush_waiting = True
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self.flush_waiting = False
+        try:
+            await self.flush()
+        except discord.HTTPException as e:
+            print(f"[STREAM_EDIT_ERR] {type(e).__name__}: {e}")
+
+    async def _settle_flush_task(self):
+        """還在等待的串流編輯直接取消；已經在送的要等它送完，避免兩邊同時改同一批訊息。"""
+        task, self.flush_task = self.flush_task, None
+        if task is None or task.done():
+            return
+        if self.flush_waiting:
+            task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+
+    async def flush(self, footer=""):
+        self.last_flush = asyncio.get_running_loop().time()
+        if not self.buffer.strip():
+            return
+        await self.render(compose_reply_pages(self.buffer, footer))
+
+    async def render(self, pages):
+        # 純文字模式要關掉連結預覽；embed 模式不能 suppress，否則連自己的 embed 都會被隱藏
+        edit_options = {} if REPLY_EMBEDS else {"suppress": True}
+        reply_options = {} if REPLY_EMBEDS else {"suppress_embeds": True}
+        for idx, page in enumerate(pages):
+            if idx < len(self.sent_messages):
+                if self.rendered[idx] != page:
+                    await self.sent_messages[idx].edit(**reply_page_kwargs(page), **edit_options)
+                    self.rendered[idx] = page
+            else:
+                self.sent_messages.append(await self.message.reply(**reply_page_kwargs(page), **reply_options))
+                self.rendered.append(page)
+            self.started = True
+
+        for extra in self.sent_messages[len(pages):]:
+            with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
+                await extra.delete()
+        del self.sent_messages[len(pages):]
+        del self.rendered[len(pages):]
+
+    async def cancel(self):
+        """出錯時丟掉還沒送出的串流編輯，免得錯誤訊息之後又冒出半截回覆。"""
+        task, self.flush_task = self.flush_task, None
+        if task is not None and not task.done():
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+    async def finish(self, final_text=None, footer=""):
+        await self._settle_flush_task()
+        if final_text:
+            self.buffer = final_text
+        elif not self.buffer.strip():
+            self.buffer = "（無內容）"
+        await self.flush(footer)
+
+
+SPLIT_DELIMITERS = ["\n\n", "\n", "。", "！", "？", ";", "；"]
+CODE_FENCE = "```"
+CODE_FENCE_LANGUAGE_MAX = 16
+# 補回的開頭（``` + 語言 + 換行）加上補上的結尾（換行 + ```）
+CODE_FENCE_RESERVE = len(CODE_FENCE) + CODE_FENCE_LANGUAGE_MAX + 1 + 1 + len(CODE_FENCE)
+
+
+def split_text_for_discord(text, chunk_size=2000):
+    """
+    將長文字優先按段落/句子切分，避免生硬截斷。
+
+    Strategy
+    --------
+    1) 先以「雙換行」切段
+    2) 段落過長再以「單換行」切
+    3) 仍過長再以中文/英文句號與分號切
+    4) 最後才做硬切
+
+    切點由 `_split_spans` 以索引由前往後掃出，只有最後取出各段時才切字串。
+    含 ``` 程式碼區塊時會先預留補 fence 的空間，被切開的區塊在前一段補上結尾、下一段補回開頭；
+    任何情況下每段都不超過 chunk_size。
+    """
+    if not text:
+        return ["（無內容）"]
+
+    text = str(text)
+    # 先找單一反引號（有 memchr 級的快速路徑），絕大多數沒有程式碼的回答就不必再搜 ```
+    if "`" not in text or CODE_FENCE not in text:
+        chunks = []
+        for start, end in _split_spans(text, chunk_size):
+            chunk = text[start:end]
+            if chunk.strip():
+                chunks.append(chunk)
+        return chunks
+
+    budget = max(1, chunk_size - CODE_FENCE_RESERVE)
+    chunks = _rebalance_code_fences(text, _split_spans(text, budget))
+    if all(len(chunk) <= chunk_size for chunk in chunks):
+        return chunks
+    # chunk_size 小到放不下補上的 fence 時，寧可讓 fence 不成對也不能超過上限
+    return [chunk[start:end] for chunk in chunks for start, end in _split_spans(chunk, chunk_size)
+            if chunk[start:end].strip()]
+
+
+def _split_spans(text, chunk_size):
+    """
+    `split_text_for_discord` 的核心：由前往後掃一次，依序回傳各段的 (start, end) 索引（含空白段，由呼叫端濾掉）。
+
+    每一層從目前位置往後 `rfind` 出 chunk_size 內最後一個分隔符，整組一次跳過，不必逐一走訪片段；
+    第一個片段本身就超過上限時，才把它推進堆疊往下一層切，切完再回到這一層繼續往後掃。
+    切點與早期的遞迴 `str.split` 版完全相同，包括兩個行為：某一層找不到分隔符時直接硬切，
+    以及累積內容還是空字串時，前面的分隔符會被捨棄。
+    """
+    spans = []
+    # 每個 frame：[目前掃到的位置, 區塊結尾, 層級]
+    stack = []
+
+    def has_delimiter(start, end, level):
+        delim = SPLIT_DELIMITERS[level]
+        # 單字元搜尋有 memchr 級的快速路徑，先找分隔符的第一個字元，完全沒有就不必再搜整個分隔符
+        first = text.find(delim[0], start, end)
+        return first >= 0 and (len(delim) == 1 or text.find(delim, first, end) >= 0)
+
+    def open_block(start, end, level):
+        if end - start <= chunk_size:
+            spans.append((start, end))
+        elif level >= len(SPLIT_DELIMITERS) or not has_delimiter(start, end, level):
+            spans.extend((pos, min(pos + chunk_size, end)) for pos in range(start, end, chunk_size))
+        else:
+            stack.append([start, end, level])
+
+    open_block(0, len(text), 0)
+    while stack:
+        frame = stack[-1]
+        pos, end, level = frame
+        delim = SPLIT_DELIMITERS[level]
+        delim_length = len(delim)
+        # 累積內容還是空的時候遇到分隔符（空片段）直接跳過
+        while text.startswith(delim, pos, end):
+            pos += delim_length
+        if end - pos <= chunk_size:
+            if pos < end:
+                spans.append((pos, end))
+            stack.pop()
+            continue
+
+        cut = text.rfind(delim, pos, min(pos + chunk_size + delim_length, end))
+        if cut > pos and delim_length > 1:
+            # 多字元的分隔符只有「\n\n」：連續換行裡 str.split 是從這串換行的開頭兩兩配對，
+            # rfind 可能落在錯開一格的位置，要對齊回 split 會用的切點
+            run_start = cut
+            while run_start > pos and text[run_start - 1] == delim[0]:
+                run_start -= 1
+            cut -= (cut - run_start) % delim_length
+        if cut > pos:
+            spans.append((pos, cut))
+            frame[0] = cut + delim_length
+            continue
+
+        # 第一個片段本身就超過上限：單獨往下一層切
+        part_end = text.find(delim, pos, end)
+        frame[0] = end if part_end < 0 else part_end + delim_length
+        open_block(pos, end if part_end < 0 else part_end, level + 1)
+    return spans
+
+
+def _code_fence_opener(line):
+    """重新開啟區塊用的 fence：只保留語言標記，長度有上限，預留空間才算得準。"""
+    language = line.strip()[len(CODE_FENCE):].split(maxsplit=1)
+    language = language[0] if language else ""
+    return CODE_FENCE + (language if len(language) <= CODE_FENCE_LANGUAGE_MAX else "")
+
+
+def _iter_fence_lines(chunk):
+    """逐一回傳以 ``` 開頭（前面只有空白）的行；只在 ``` 出現處往回看行首，不必逐字元比對。"""
+    pos = chunk.find(CODE_FENCE)
+    while pos >= 0:
+        line_start = chunk.rfind("\n", 0, pos) + 1
+        if chunk[line_start:pos].strip(" \t"):
+            pos = chunk.find(CODE_FENCE, pos + len(CODE_FENCE))
+            continue
+        line_end = chunk.find("\n", pos)
+        if line_end < 0:
+            yield chunk[line_start:]
+            return
+        yield chunk[line_start:line_end]
+        pos = chunk.find(CODE_FENCE, line_end)
+
+
+def _rebalance_code_fences(text, spans):
+    """取出各段時，切點落在程式碼區塊中間的，前一段補上 ``` 收尾，下一段以原本的語言標記重新開啟。"""
+    balanced = []
+    reopen = ""
+    for start, end in spans:
+        chunk = text[start:end]
+        if not chunk.strip():
+            continue
+        if not reopen and CODE_FENCE not in chunk:
+            balanced.append(chunk)
+            continue
+
+        # 補回的開頭本身就是一行 fence，從「已開啟」的狀態開始數
+        opener = reopen[:-1] or None
+        for line in _iter_fence_lines(chunk):
+            opener = None if opener else line
+        chunk = reopen + chunk
+        if opener:
+            chunk += "\n" + CODE_FENCE
+            reopen = _code_fence_opener(opener) + "\n"
+        else:
+            reopen = ""
+        balanced.append(chunk)
+    return balanced
+
+
+daily_news_task = None
+memory_flush_task = None
+usage_flush_task = None
+background_tasks = set()
+
+
+def spawn_background(coro):
+    """建立背景工作並保留參照，避免工作在完成前被回收。"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+NEWS_PREGENERATE_MINUTES = max(0, parse_int_env("NEWS_PREGENERATE_MINUTES", 10))
+NEWS_DIGEST_MAX_AGE_HOURS = max(1, parse_int_env("NEWS_DIGEST_MAX_AGE_HOURS", 12))
+NEWS_DIGEST_RETENTION_DAYS = max(1, parse_int_env("NEWS_DIGEST_RETENTION_DAYS", 30))
+NEWS_DIGEST_CLAIM_WAIT_SECONDS = max(0, parse_int_env("NEWS_DIGEST_CLAIM_WAIT_SECONDS", 300))
+NEWS_DIGEST_POLL_SECONDS = 5
+pending_digest_tasks = {}
+running_news_jobs = {}
+
+
+async def resolve_news_channel(channel_id):
+    channel = client.get_channel(channel_id)
+    if channel is None:
+        try:
+            channel = await client.fetch_channel(channel_id)
+        except Exception as e:
+            print(f"[DAILY_NEWS_ERR] 無法取得頻道 {channel_id}: {e}")
+            return None
+
+    if not isinstance(channel, discord.TextChannel):
+        print(f"[DAILY_NEWS_ERR] 頻道 {channel_id} 不是文字頻道。")
+        return None
+
+    return channel
+
+
+def news_digest_key(job_name, fire_time):
+    return f"{job_name}@{fire_time:%Y-%m-%d %H:%M}"
+
+
+async def generate_news_digest(digest_key):
+    current_time = datetime.now(TAIPEI_TZ)
+    user_text = build_ask_user_text(DAILY_NEWS_PROMPT, current_time, "", False)
+    user_content = [{"type": "input_text", "text": user_text}]
+
+    response, active_tools, _ = await run_grok_with_tools(user_content, feature="新聞")
+    input_tokens, output_tokens, total_tokens = get_grok_usage(getattr(response, "usage", None))
+    digest = {
+        "digest_key": digest_key,
+        "generated_at": current_time,
+        "content": extract_grok_reply_text(response) or "（今日未取得可顯示的國際新聞摘要）",
+        "model": getattr(response, "model", None) or GROK_MODEL,
+        "tools": ", ".join(t.get("type", "?") for t in active_tools),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": total_tokens,
+    }
+    await save_news_digest(digest)
+    return digest
+
+
+async def wait_for_claimed_news_digest(digest_key):
+    """其他副本已認領預先產生時，等它寫進資料表；等太久（對方可能掛了）就回傳 None。"""
+    claim = await load_news_digest_claim(digest_key)
+    if not claim:
+        return None
+    deadline = claim["claimed_at"] + timedelta(seconds=NEWS_DIGEST_CLAIM_WAIT_SECONDS)
+    while datetime.now(TAIPEI_TZ) < deadline:
+        await asyncio.sleep(NEWS_DIGEST_POLL_SECONDS)
+        cached = await load_news_digest(digest_key)
+        if cached:
+            return cached
+    return None
+
+
+async def get_news_digest(digest_key, force=False, wait_for_claim=True):
+    """
+    取得指定時段的新聞摘要：優先用資料表內的快取，其次等待本機或其他副本正在預先產生的工作，
+    最後才即時產生。回傳 (digest, 是否為預先產生/快取)。
+    """
+    task = pending_digest_tasks.get(digest_key)
+    reused = task is not None
+    if task is None:
+        if not force:
+            cached = await load_news_digest(digest_key)
+            if cached:
+                return cached, True
+            if wait_for_claim:
+                cached = await wait_for_claimed_news_digest(digest_key)
+                if cached:
+                    return cached, True
+
+        task = asyncio.create_task(generate_news_digest(digest_key))
+        pending_digest_tasks[digest_key] = task
+        task.add_done_callback(lambda _task: pending_digest_tasks.pop(digest_key, None))
+
+    # shield：呼叫端被取消時，預先產生的工作仍會完成並寫入快取
+    return await asyncio.shield(task), reused
+
+
+async def pregenerate_news_digest(digest_key):
+    try:
+        if not await claim_news_digest(digest_key):
+            return  # 其他副本已在產生，推播時會讀資料表
+        await get_news_digest(digest_key, wait_for_claim=False)
+        print(f"🗞️ 已預先產生新聞摘要：{digest_key}")
+    except Exception as e:
+        print(f"[DAILY_NEWS_ERR] 預先產生失敗 {digest_key} {type(e).__name__}: {e}")
+
+
+async def send_news_to_channel(channel, body, footer):
+    await send_channel_chunks(channel, body)
+    await channel.send(footer)
+
+
+async def publish_news_digest(digest, channel_ids, trigger_label, from_cache):
+    """同時推播到所有訂閱頻道；回傳成功送達的頻道 ID。"""
+    channels = [channel for channel in await asyncio.gather(*(resolve_news_channel(cid) for cid in channel_ids)) if channel]
+    if not channels:
+        return []
+
+    usage_count = await record_usage(AUTO_NEWS_FEATURE_NAME)
+    generated_at = digest["generated_at"].astimezone(TAIPEI_TZ)
+    prefix = "🧪 **自動推播測試**\n" if trigger_label == "manual_test" else ""
+    header = f"🌏 **每日國際新聞彙整（台北時間 {generated_at:%Y-%m-%d %H:%M}）**"
+    cache_line = f"♻️ 使用預先產生的摘要（{generated_at:%H:%M} 產生）\n" if from_cache else ""
+    footer = (
+        f"📊 今天所有人總共使用「{AUTO_NEWS_FEATURE_NAME}」功能 {usage_count} 次，本次使用的模型：{digest['model']}\n"
+        f"{cache_line}"
+        f"🧰 啟用工具：{digest['tools']}\n"
+        f"📊 token 使用量：\n"
+        f"- 輸入 tokens: {digest['input_tokens']}\n"
+        f"- 回應 tokens: {digest['output_tokens']}\n"
+        f"- 總 token: {digest['total_tokens']}"
+    )
+
+    results = await asyncio.gather(
+        *(send_news_to_channel(channel, f"{prefix}{header}\n\n{digest['content']}", footer) for channel in channels),
+        return_exceptions=True,
+    )
+    delivered = []
+    for channel, result in zip(channels, results):
+        if isinstance(result, Exception):
+            print(f"[DAILY_NEWS_ERR] 推播到頻道 {channel.id} 失敗 {type(result).__name__}: {result}")
+        else:
+            delivered.append(channel.id)
+    return delivered
+
+
+async def run_auto_news_push(trigger_label, digest_key=None, force=False):
+    """回傳成功推播的頻道 ID；空 list 代表沒有推播。"""
+    if not client_grok:
+        print("⚠️ 已略過每日國際新聞彙整：未設定 XAI_API_KEY。")
+        return []
+
+    if trigger_label == "manual_test":
+        channel_ids = [DAILY_NEWS_CHANNEL_ID] if DAILY_NEWS_CHANNEL_ID else NEWS_SUBSCRIBER_CHANNEL_IDS[:1]
+    else:
+        channel_ids = NEWS_SUBSCRIBER_CHANNEL_IDS
+    if not channel_ids:
+        print("⚠️ 已略過每日國際新聞彙整：未設定 DAILY_NEWS_CHANNEL_ID 或 NEWS_SUBSCRIBER_CHANNEL_IDS。")
+        return []
+
+    if digest_key is None:
+        cached = None
+        if not force:
+            since = datetime.now(TAIPEI_TZ) - timedelta(hours=NEWS_DIGEST_MAX_AGE_HOURS)
+            cached = await load_latest_news_digest(since)
+        if cached:
+            digest, from_cache = cached, True
+        else:
+            digest_key = f"{trigger_label}@{datetime.now(TAIPEI_TZ):%Y-%m-%d %H:%M:%S}"
+            digest, from_cache = await get_news_digest(digest_key, force=True)
+    else:
+        digest, from_cache = await get_news_digest(digest_key, force=force)
+
+    return await publish_news_digest(digest, channel_ids, trigger_label, from_cache)
+
+
+async def handle_auto_news_test_command(message, cmd=None):
+    force = (cmd or "").split()[-1:] == ["強制"]
+    testing_message = await message.reply("🧪 正在執行自動推播測試，請稍候...")
+    try:
+        delivered = await run_auto_news_push(trigger_label="manual_test", force=force)
+        if delivered:
+            await message.reply(f"✅ 已完成測試推播，請到 {' '.join(f'<#{cid}>' for cid in delivered)} 查看。")
+        else:
+            await message.reply("⚠️ 測試推播未執行，請確認 XAI_API_KEY 與 DAILY_NEWS_CHANNEL_ID / NEWS_SUBSCRIBER_CHANNEL_IDS 設定。")
+    except Exception as e:
+        print(f"[DAILY_NEWS_TEST_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {type(e).__name__}: {e}")
+        await message.reply("❌ 自動推播測試失敗，請稍後再試。")
+    finally:
+        with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
+            await testing_message.delete()
+
+
+NEWS_CATCHUP_GRACE_MINUTES = max(0, parse_int_env("NEWS_CATCHUP_GRACE_MINUTES", 30))
+SCHEDULER_MAX_SLEEP_SECONDS = max(60, parse_int_env("SCHEDULER_MAX_SLEEP_SECONDS", 900))
+
+
+def parse_cron_field(field, low, high):
+    if field == "*":
+        return set(range(low, high + 1))
+
+    values = set()
+    for part in field.split(","):
+        step = 1
+        if "/" in part:
+            part, step_raw = part.split("/", 1)
+            step = int(step_raw)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_raw, end_raw = part.split("-", 1)
+            start, end = int(start_raw), int(end_raw)
+        else:
+            start = end = int(part)
+        if start < low or end > high or step < 1:
+            raise ValueError(f"cron 欄位超出範圍：{field}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_cron(expr):
+    """解析「分 時 日 月 星期」；日與星期同時指定時兩者都要符合。"""
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError(f"cron 需要 5 個欄位：{expr}")
+    return {
+        "minutes": sorted(parse_cron_field(fields[0], 0, 59)),
+        "hours": sorted(parse_cron_field(fields[1], 0, 23)),
+        "days": parse_cron_field(fields[2], 1, 31),
+        "months": parse_cron_field(fields[3], 1, 12),
+        "weekdays": {value % 7 for value in parse_cron_field(fields[4], 0, 7)},
+    }
+
+
+def cron_matches_day(spec, day):
+    cron_weekday = (day.weekday() + 1) % 7
+    return day.day in spec["days"] and day.month in spec["months"] and cron_weekday in spec["weekdays"]
+
+
+def next_cron_time(expr, after):
+    """回傳嚴格晚於 `after` 的下一次觸發時間（台北時間）。"""
+    spec = parse_cron(expr)
+    for day_offset in range(367):
+        day = (after + timedelta(days=day_offset)).date()
+        if not cron_matches_day(spec, day):
+            continue
+        for hour in spec["hours"]:
+            for minute in spec["minutes"]:
+                candidate = datetime(day.year, day.month, day.day, hour, minute, tzinfo=TAIPEI_TZ)
+                if candidate > after:
+                    return candidate
+    return None
+
+
+def previous_cron_time(expr, before):
+    """回傳不晚於 `before` 的最近一次觸發時間（台北時間）。"""
+    spec = parse_cron(expr)
+    for day_offset in range(367):
+        day = (before - timedelta(days=day_offset)).date()
+        if not cron_matches_day(spec, day):
+            continue
+        for hour in reversed(spec["hours"]):
+            for minute in reversed(spec["minutes"]):
+                candidate = datetime(day.year, day.month, day.day, hour, minute, tzinfo=TAIPEI_TZ)
+                if candidate <= before:
+                    return candidate
+    return None
+
+
+def is_job_due(job, fire_time):
+    if job["last_run_at"] is not None:
+        return job["last_run_at"] < fire_time
+    # 舊資料只有 last_run_date：當天已經跑過就不補跑
+    return job["last_run_date"] != fire_time.date()
+
+
+async def run_scheduled_news_job(job, fire_time):
+    job_name = job["job_name"]
+    if not await claim_job_run(job_name, fire_time):
+        return
+
+    try:
+        executed = await run_auto_news_push(
+            trigger_label="scheduled",
+            digest_key=news_digest_key(job_name, fire_time),
+        )
+    except Exception as e:
+        executed = False
+        print(f"[DAILY_NEWS_ERR] slot={job_name} {type(e).__name__}: {e}")
+
+    if executed:
+        await mark_job_run(job_name, fire_time.date())
+        print(f"✅ 每日國際新聞彙整完成：{fire_time:%Y-%m-%d %H:%M}（{job_name}）")
+        try:
+            await prune_news_digests()
+        except Exception as e:
+            print(f"[DAILY_NEWS_ERR] 清除舊摘要失敗 {type(e).__name__}: {e}")
+    else:
+        # 釋放認領，讓寬限時間內的下一次喚醒還能補跑
+        await release_job_claim(job_name, fire_time, job["last_run_at"])
+
+
+async def run_scheduled_news_job_safely(job, fire_time):
+    """背景執行時例外不會再被排程迴圈接住，要在這裡記錄。"""
+    try:
+        await run_scheduled_news_job(job, fire_time)
+    except Exception as e:
+        print(f"[DAILY_NEWS_ERR] slot={job['job_name']} {type(e).__name__}: {e}")
+
+
+async def daily_news_scheduler():
+    """
+    依 `scheduled_jobs` 內的 cron 排程計算下一次觸發時間並直接 sleep 到那一刻。
+
+    每次醒來都會檢查最近一次應觸發的時間；錯過的排程只要還在
+    `NEWS_CATCHUP_GRACE_MINUTES` 內就會補跑。觸發前 `NEWS_PREGENERATE_MINUTES`
+    會先在背景產生摘要，時間到只需推播。最長 sleep `SCHEDULER_MAX_SLEEP_SECONDS`，
+    以便讀到資料表中新增或修改的排程。
+    """
+    await client.wait_until_ready()
+    grace = timedelta(minutes=NEWS_CATCHUP_GRACE_MINUTES)
+    lead_time = timedelta(minutes=NEWS_PREGENERATE_MINUTES)
+
+    while not client.is_closed():
+        now = datetime.now(TAIPEI_TZ)
+        next_wakeup = now + timedelta(seconds=SCHEDULER_MAX_SLEEP_SECONDS)
+        try:
+            for job in await load_scheduled_jobs():
+                try:
+                    fire_time = previous_cron_time(job["schedule"], now)
+                    upcoming = next_cron_time(job["schedule"], now)
+                except ValueError as e:
+                    print(f"[DAILY_NEWS_ERR] slot={job['job_name']} 排程格式錯誤：{e}")
+                    continue
 
-    init_db()
-    if daily_news_task is None or daily_news_task.done():
-        daily_news_task = asyncio.create_task(daily_news_scheduler())
-    print(f'✅ Bot 登入成功：{client.user}')
+                if (fire_time and now - fire_time <= grace and is_job_due(job, fire_time)
+                        and job["job_name"] not in running_news_jobs):
+                    # 每個排程各自在背景跑，一個慢的推播不會擋住其他排程與預先產生
+                    task = spawn_background(run_scheduled_news_job_safely(job, fire_time))
+                    running_news_jobs[job["job_name"]] = task
+                    task.add_done_callback(lambda _task, name=job["job_name"]: running_news_jobs.pop(name, None))
+                if upcoming:
+                    pregenerate_at = upcoming - lead_time
+                    if pregenerate_at <= now:
+                        digest_key = news_digest_key(job["job_name"], upcoming)
+                        if digest_key not in pending_digest_tasks:
+                            spawn_background(pregenerate_news_digest(digest_key))
+                        next_wakeup = min(next_wakeup, upcoming)
+                    else:
+                        next_wakeup = min(next_wakeup, pregenerate_at)
+        except Exception as e:
+            print(f"[DAILY_NEWS_ERR] scheduler {type(e).__name__}: {e}")
+            next_wakeup = now + timedelta(seconds=60)
 
+        sleep_seconds = (next_wakeup - datetime.now(TAIPEI_TZ)).total_seconds()
+        await asyncio.sleep(max(1.0, sleep_seconds))
 
-async def send_chunks(message, text, chunk_size=2000):
-    """Send text in readable chunks while respecting Discord's 2000-char limit."""
-    for chunk in split_text_for_discord(text, chunk_size=chunk_size):
-        await message.reply(chunk, suppress_embeds=True)
 
+### 🧹 頻道內容整理（串流讀取 + map-reduce 摘要）
+SUMMARY_DEFAULT_MESSAGES = max(1, parse_int_env("SUMMARY_DEFAULT_MESSAGES", 1000))
+SUMMARY_MAX_MESSAGES = max(SUMMARY_DEFAULT_MESSAGES, parse_int_env("SUMMARY_MAX_MESSAGES", 5000))
+SUMMARY_CHUNK_TOKENS = max(1000, parse_int_env("SUMMARY_CHUNK_TOKENS", 12000))
+SUMMARY_MAP_CONCURRENCY = max(1, parse_int_env("SUMMARY_MAP_CONCURRENCY", 4))
+SUMMARY_PROGRESS_INTERVAL_SECONDS = 3
 
-async def send_channel_chunks(channel, text, chunk_size=2000):
-    """Send text in readable chunks while respecting Discord's 2000-char limit."""
-    for chunk in split_text_for_discord(text, chunk_size=chunk_size):
-        await channel.send(chunk, suppress_embeds=True)
+SUMMARY_SYSTEM_PROMPT = "你是一位擅長內容摘要的助理，請整理以下 Discord 訊息成為條理清楚、詳細完整的摘要。你在說明時，盡量用具體實際的狀況來說明，不要用籠統的敘述簡單帶過。"
+SUMMARY_CHUNK_SYSTEM_PROMPT = (
+    "你是一位擅長內容摘要的助理。以下是一段較長 Discord 對話中的其中一個片段，"
+    "請整理成條理清楚的重點摘要，保留具體人物、事件、數字與結論，之後會再和其他片段的摘要合併。"
+)
+SUMMARY_INCREMENTAL_SYSTEM_PROMPT = (
+    "你是一位擅長內容摘要的助理。以下是一個 Discord 頻道先前的摘要，以及之後新增的訊息，"
+    "請把新增內容整合進去，輸出一份更新後、條理清楚、詳細完整的摘要。你在說明時，盡量用具體實際的狀況來說明，不要用籠統的敘述簡單帶過。"
+)
+SUMMARY_REDUCE_SYSTEM_PROMPT = (
+    "你是一位擅長內容摘要的助理。以下是同一段 Discord 對話依時間先後排列的多個片段摘要，"
+    "請合併成一份條理清楚、詳細完整的摘要，去除重複內容。你在說明時，盡量用具體實際的狀況來說明，不要用籠統的敘述簡單帶過。"
+)
 
 
-def split_text_for_discord(text, chunk_size=2000):
-    """
-    將長文字優先按段落/句子切分，避免生硬截斷。
+def load_token_encoding():
+    if tiktoken is None:
+        print("[TOKENIZER_WARN] 未安裝 tiktoken：token 預算改用字元數粗估，請執行 pip install -r requirements.txt")
+        return None
+    try:
+        return tiktoken.get_encoding(os.getenv("TOKEN_ENCODING", "o200k_base"))
+    except Exception as e:
+        print(f"[TOKENIZER_ERR] {type(e).__name__}: {e}（token 預算改用字元數粗估）")
+        return None
 
-    Strategy
-    --------
-    1) 先以「雙換行」切段
-    2) 段落過長再以「單換行」切
-    3) 仍過長再以中文/英文句號與分號切
-    4) 最後才做硬切
+
+TOKEN_ENCODING = load_token_encoding()
+
+
+def estimate_tokens(text):
+    """
+    估算 token 數：有 tiktoken 時用本地 tokenizer 實際編碼，
+    否則粗估 CJK 字元約 1 token、其餘約 4 字元 1 token。
     """
     if not text:
-        return ["（無內容）"]
+        return 0
+    if TOKEN_ENCODING is not None:
+        return len(TOKEN_ENCODING.encode(text, disallowed_special=()))
+    cjk_chars = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk_chars + (len(text) - cjk_chars + 3) // 4
+
+
+def pack_texts_by_tokens(texts, token_budget):
+    groups = []
+    current = []
+    current_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if current and current_tokens + tokens > token_budget:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def new_usage_totals():
+    return {"calls": 0, "input_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "reasoning_tokens": 0, "total_tokens": 0}
+
+
+def add_usage_totals(totals, usage):
+    details = getattr(usage, "output_tokens_details", {})
+    totals["calls"] += 1
+    totals["input_tokens"] += getattr(usage, "input_tokens", 0) or 0
+    totals["cached_tokens"] += get_cached_input_tokens(usage)
+    totals["output_tokens"] += getattr(usage, "output_tokens", 0) or 0
+    totals["reasoning_tokens"] += getattr(details, "reasoning_tokens", 0) or 0
+    totals["total_tokens"] += getattr(usage, "total_tokens", 0) or 0
+
+
+async def summarize_text_block(system_prompt, text, usage_totals):
+    response = await create_model_response(
+        "openai",
+        model=OPENAI_PRIMARY_MODEL,
+        input=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": text},
+        ],
+    )
+    add_usage_totals(usage_totals, response.usage)
+    return response.output_text
 
-    delimiters = ["\n\n", "\n", "。", "！", "？", ";", "；"]
-
-    def split_recursive(block, level=0):
-        if len(block) <= chunk_size:
-            return [block]
-
-        if level < len(delimiters):
-            delim = delimiters[level]
-            parts = block.split(delim)
-            if len(parts) > 1:
-                chunks = []
-                current = ""
-                for part in parts:
-                    piece = part if not current else f"{delim}{part}"
-                    if not current:
-                        candidate = part
-                    else:
-                        candidate = current + piece
 
-                    if len(candidate) <= chunk_size:
-                        current = candidate
-                    else:
-                        if current:
-                            chunks.extend(split_recursive(current, level + 1))
-                        current = part
-                if current:
-                    chunks.extend(split_recursive(current, level + 1))
-                return [c for c in chunks if c]
+async def iter_channel_messages(channel, limit, after_message_id=None):
+    """
+    逐頁讀取頻道訊息，不會一次把整段歷史放進記憶體。
 
-        return [block[i:i + chunk_size] for i in range(0, len(block), chunk_size)]
+    沒有 `after_message_id` 時由新到舊讀最近的訊息；有的話改由舊到新，
+    只讀該訊息之後的增量。
+    """
+    if after_message_id is None:
+        history = channel.history(limit=limit)
+    else:
+        history = channel.history(limit=limit, after=discord.Object(id=after_message_id), oldest_first=True)
+    async for msg in history:
+        yield msg
 
-    return [c for c in split_recursive(str(text)) if c and c.strip()]
 
+def format_summary_line(msg):
+    """
+    沒有文字的訊息（只有附件、embed、貼圖）也保留一行佔位，模型才知道當時有人分享了東西；
+    什麼都沒有的訊息回傳 None。
+    """
+    parts = [msg.content] if msg.content else []
+    if msg.attachments:
+        parts.append("[附件]")
+    if msg.embeds:
+        parts.append("[嵌入內容]")
+    if getattr(msg, "stickers", None):
+        parts.append("[貼圖]")
+    if not parts:
+        return None
+    return f"{msg.author.display_name}: {' '.join(parts)}"
+
+
+async def reduce_partial_summaries(partials, usage_totals):
+    """把依時間排列的片段摘要合併；太長時先分組合併，直到能放進單次請求。"""
+    while len(partials) > 1 and sum(estimate_tokens(p) for p in partials) > SUMMARY_CHUNK_TOKENS:
+        groups = pack_texts_by_tokens(partials, SUMMARY_CHUNK_TOKENS)
+        if len(groups) == len(partials):
+            break
+        partials = await asyncio.gather(*(
+            summarize_text_block(SUMMARY_REDUCE_SYSTEM_PROMPT, "\n\n---\n\n".join(group), usage_totals)
+            for group in groups
+        ))
 
-daily_news_task = None
+    if len(partials) == 1:
+        return partials[0]
+    return await summarize_text_block(SUMMARY_REDUCE_SYSTEM_PROMPT, "\n\n---\n\n".join(partials), usage_totals)
 
 
-async def resolve_daily_news_channel():
-    if not DAILY_NEWS_CHANNEL_ID:
-        print("⚠️ 已略過每日國際新聞彙整：未設定 DAILY_NEWS_CHANNEL_ID。")
-        return None
+async def summarize_channel_history(source_channel, message_limit, on_progress=None,
+                                    after_message_id=None, previous_summary=None):
+    """
+    串流讀取頻道歷史並做 map-reduce 摘要。
 
-    channel = client.get_channel(DAILY_NEWS_CHANNEL_ID)
-    if channel is None:
-        try:
-            channel = await client.fetch_channel(DAILY_NEWS_CHANNEL_ID)
-        except Exception as e:
-            print(f"[DAILY_NEWS_ERR] 無法取得頻道 {DAILY_NEWS_CHANNEL_ID}: {e}")
-            return None
+    讀取時依 `SUMMARY_CHUNK_TOKENS` 把訊息打包成片段，每滿一段就立刻丟給模型摘要（map，
+    併發數受 `SUMMARY_MAP_CONCURRENCY` 限制），讀完後再把各段摘要合併（reduce）。
+    內容只有一段時維持單次呼叫。
 
-    if not isinstance(channel, discord.TextChannel):
-        print(f"[DAILY_NEWS_ERR] 頻道 {DAILY_NEWS_CHANNEL_ID} 不是文字頻道。")
-        return None
+    帶入 `after_message_id` 與 `previous_summary` 時只讀取該訊息之後的增量，
+    並把新內容合併進先前的摘要。
 
-    return channel
+    Returns
+    -------
+    tuple[str | None, int, dict, int | None]
+        摘要文字（沒有訊息時為先前摘要或 None）、實際讀取的訊息數、
+        累計的 token 使用量，以及目前看過最新的訊息 ID。
+    """
+    usage_totals = new_usage_totals()
+    map_semaphore = asyncio.Semaphore(SUMMARY_MAP_CONCURRENCY)
+    newest_first = after_message_id is None
+    newest_message_id = after_message_id
+    chunk_tasks = []
+    current_lines = []
+    current_tokens = 0
+    fetched = 0
+
+    def chronological(items):
+        return list(reversed(items)) if newest_first else list(items)
+
+    async def summarize_chunk(lines):
+        async with map_semaphore:
+            text = "\n".join(chronological(lines))
+            return await summarize_text_block(SUMMARY_CHUNK_SYSTEM_PROMPT, text, usage_totals)
 
+    try:
+        async for msg in iter_channel_messages(source_channel, message_limit, after_message_id):
+            if newest_message_id is None or msg.id > newest_message_id:
+                newest_message_id = msg.id
+            line = format_summary_line(msg)
+            if line is None:
+                continue
+            tokens = estimate_tokens(line)
+            if current_lines and current_tokens + tokens > SUMMARY_CHUNK_TOKENS:
+                chunk_tasks.append(asyncio.create_task(summarize_chunk(current_lines)))
+                current_lines, current_tokens = [], 0
+            current_lines.append(line)
+            current_tokens += tokens
+            fetched += 1
+            if on_progress and fetched % 100 == 0:
+                await on_progress(f"🧹 已讀取 {fetched} 則訊息，已切成 {len(chunk_tasks) + 1} 段...")
+
+        if fetched == 0:
+            return previous_summary, 0, usage_totals, newest_message_id
+
+        if not chunk_tasks:
+            text = "\n".join(chronological(current_lines))
+            if previous_summary:
+                text = f"【先前摘要】\n{previous_summary}\n\n【新增訊息】\n{text}"
+                summary = await summarize_text_block(SUMMARY_INCREMENTAL_SYSTEM_PROMPT, text, usage_totals)
+            else:
+                summary = await summarize_text_block(SUMMARY_SYSTEM_PROMPT, text, usage_totals)
+            return summary, fetched, usage_totals, newest_message_id
+
+        if current_lines:
+            chunk_tasks.append(asyncio.create_task(summarize_chunk(current_lines)))
+
+        if on_progress:
+            await on_progress(f"🧹 已讀取 {fetched} 則訊息，正在摘要 {len(chunk_tasks)} 個片段...")
+        partials = await asyncio.gather(*chunk_tasks)
+    except BaseException:
+        for task in chunk_tasks:
+            task.cancel()
+        raise
 
-async def run_auto_news_push(trigger_label):
-    if not client_grok:
-        print("⚠️ 已略過每日國際新聞彙整：未設定 XAI_API_KEY。")
-        return False
+    if on_progress:
+        await on_progress(f"🧹 {len(partials)} 個片段摘要完成，正在合併...")
+    partials = chronological(partials)
+    if previous_summary:
+        partials.insert(0, previous_summary)
+    summary = await reduce_partial_summaries(partials, usage_totals)
+    return summary, fetched, usage_totals, newest_message_id
 
-    channel = await resolve_daily_news_channel()
-    if channel is None:
+
+def make_progress_editor(progress_message):
+    last_edit = 0.0
+
+    async def on_progress(text):
+        nonlocal last_edit
+        now = asyncio.get_running_loop().time()
+        if now - last_edit < SUMMARY_PROGRESS_INTERVAL_SECONDS:
+            return
+        last_edit = now
+        with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
+            await progress_message.edit(content=text)
+
+    return on_progress
+
+
+### 📎 圖片附件前處理（併發下載、縮圖、以內容 hash 去重，改用 data URL 內嵌）
+ATTACHMENT_MAX_IMAGES = 10
+ATTACHMENT_MAX_SIDE = max(256, parse_int_env("ATTACHMENT_MAX_SIDE", 1536))
+ATTACHMENT_JPEG_QUALITY = max(30, min(95, parse_int_env("ATTACHMENT_JPEG_QUALITY", 85)))
+ATTACHMENT_IMAGE_DETAIL = os.getenv("ATTACHMENT_IMAGE_DETAIL", "auto").strip() or "auto"
+ATTACHMENT_CACHE_SIZE = max(0, parse_int_env("ATTACHMENT_CACHE_SIZE", 128))
+ATTACHMENT_FETCH_TIMEOUT_SECONDS = 15
+THREAD_IMAGE_HASHES_MAX_USERS = 1000
+processed_image_cache = OrderedDict()
+thread_image_hashes = OrderedDict()
+
+
+def downscale_image_to_data_url(raw):
+    """把圖片縮到長邊不超過 `ATTACHMENT_MAX_SIDE` 並轉成 JPEG data URL；CPU 密集，要在 thread 裡執行。"""
+    image = Image.open(io.BytesIO(raw))
+    image.thumbnail((ATTACHMENT_MAX_SIDE, ATTACHMENT_MAX_SIDE))
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=ATTACHMENT_JPEG_QUALITY, optimize=True)
+    return "data:image/jpeg;base64," + base64.b64encode(out.getvalue()).decode("ascii")
+
+
+async def fetch_image_input(attachment):
+    """下載附件並回傳 (sha256, data URL)；相同內容的圖片直接取用 LRU 裡處理好的結果。"""
+    raw = await asyncio.wait_for(attachment.read(), timeout=ATTACHMENT_FETCH_TIMEOUT_SECONDS)
+    digest = hashlib.sha256(raw).hexdigest()
+    data_url = processed_image_cache.get(digest)
+    if data_url is not None:
+        processed_image_cache.move_to_end(digest)
+        metrics.inc("dcbot_attachment_cache_total", result="hit")
+        return digest, data_url
+
+    metrics.inc("dcbot_attachment_cache_total", result="miss")
+    data_url = await asyncio.to_thread(downscale_image_to_data_url, raw)
+    if ATTACHMENT_CACHE_SIZE:
+        processed_image_cache[digest] = data_url
+        while len(processed_image_cache) > ATTACHMENT_CACHE_SIZE:
+            processed_image_cache.popitem(last=False)
+    return digest, data_url
+
+
+async def build_image_inputs(message, seen_hashes=None):
+    """
+    把訊息裡的圖片附件轉成 Responses API 的 input_image blocks，回傳 (blocks, 這次新圖片的 hash)。
+
+    同一則訊息內重複的圖片、以及 `seen_hashes`（同一段對話先前已送過的）會被略過。
+    沒有安裝 Pillow 或某張下載失敗時，退回原本直接傳 proxy_url 的做法。
+    """
+    attachments = [attachment for attachment in message.attachments if is_image_attachment(attachment)]
+    attachments = attachments[:ATTACHMENT_MAX_IMAGES]
+    if Image is None:
+        return [{"type": "input_image", "image_url": attachment.proxy_url, "detail": "auto"}
+                for attachment in attachments], []
+
+    results = await asyncio.gather(*(fetch_image_input(attachment) for attachment in attachments),
+                                   return_exceptions=True)
+    blocks, hashes = [], []
+    for attachment, result in zip(attachments, results):
+        if isinstance(result, BaseException):
+            print(f"[ATTACH_ERR] {attachment.filename} {type(result).__name__}: {result}")
+            blocks.append({"type": "input_image", "image_url": attachment.proxy_url, "detail": "auto"})
+            continue
+        digest, data_url = result
+        if digest in hashes or (seen_hashes and digest in seen_hashes):
+            continue
+        hashes.append(digest)
+        blocks.append({"type": "input_image", "image_url": data_url, "detail": ATTACHMENT_IMAGE_DETAIL})
+    return blocks, hashes
+
+
+def remember_thread_images(user_id, hashes, thread_active):
+    """記錄這段對話已送過的圖片；對話重新開始（沒有 last_response_id）時清掉。"""
+    seen = thread_image_hashes.pop(user_id, set())
+    if not thread_active:
+        return
+    seen.update(hashes)
+    thread_image_hashes[user_id] = seen
+    while len(thread_image_hashes) > THREAD_IMAGE_HASHES_MAX_USERS:
+        thread_image_hashes.popitem(last=False)
+
+
+### 🧠 背景記憶整理（回覆送出後才摘要，不讓任何一次提問等待摘要）
+MEMORY_COMPACT_TURNS = max(1, parse_int_env("MEMORY_COMPACT_TURNS", 10))
+MEMORY_COMPACT_TOKENS = max(0, parse_int_env("MEMORY_COMPACT_TOKENS", 60_000))
+# 對話串 token 上限：送出前估算超過就不再接續 previous_response_id，改以摘要重開
+THREAD_TOKEN_BUDGET = max(MEMORY_COMPACT_TOKENS, 4000, parse_int_env("THREAD_TOKEN_BUDGET", 120_000))
+IMAGE_INPUT_TOKEN_ESTIMATE = 800
+MEMORY_SUMMARY_PROMPT = (
+    "請根據整段對話，濃縮為一段幫助 AI 延續對話的記憶摘要，控制在100字以內，"
+    "摘要中應包含使用者的主要目標、問題類型、語氣特徵與重要背景知識，"
+    "讓 AI 能以此為基礎繼續與使用者溝通。"
+)
+pending_memory_compactions = {}
+# 各 provider 對話串在 state 裡的欄位：(response id, 累積 token, 輪數)；Grok 對話串沒有記輪數
+MEMORY_THREAD_FIELDS = {
+    "openai": ("last_response_id", "token_accum", "thread_count"),
+    "xai": ("grok_response_id", "grok_token_accum", None),
+}
+
+
+def needs_memory_compaction(state, provider="openai"):
+    """對話串達到 `MEMORY_COMPACT_TURNS` 輪，或累積 token 超過 `MEMORY_COMPACT_TOKENS` 時需要整理。"""
+    id_field, tokens_field, turns_field = MEMORY_THREAD_FIELDS[provider]
+    if not state.get(id_field):
         return False
+    if turns_field and (state.get(turns_field) or 0) >= MEMORY_COMPACT_TURNS:
+        return True
+    return bool(MEMORY_COMPACT_TOKENS) and (state.get(tokens_field) or 0) >= MEMORY_COMPACT_TOKENS
 
-    current_time = datetime.now(TAIPEI_TZ)
-    user_text = build_ask_user_text(DAILY_NEWS_PROMPT, current_time, "", False)
-    user_content = [{"type": "input_text", "text": user_text}]
 
-    response, active_tools = run_grok_with_tools(user_content)
-    summary_text = extract_grok_reply_text(response) or "（今日未取得可顯示的國際新聞摘要）"
-    input_tokens, output_tokens, total_tokens = get_grok_usage(getattr(response, "usage", None))
-    usage_count = record_usage(AUTO_NEWS_FEATURE_NAME)
+def estimate_ask_input_tokens(user_text, message):
+    """送出前估算這一輪新增的輸入量（文字 + 每張圖片固定估值）。"""
+    image_count = min(sum(1 for attachment in message.attachments if is_image_attachment(attachment)), ATTACHMENT_MAX_IMAGES)
+    return estimate_tokens(user_text) + image_count * IMAGE_INPUT_TOKEN_ESTIMATE
 
-    prefix = "🧪 **自動推播測試**\n" if trigger_label == "manual_test" else ""
-    header = f"🌏 **每日國際新聞彙整（台北時間 {current_time:%Y-%m-%d %H:%M}）**"
-    await send_channel_chunks(channel, f"{prefix}{header}\n\n{summary_text}")
 
-    tool_types = ", ".join(t.get("type", "?") for t in active_tools)
-    await channel.send(
-        f"📊 今天所有人總共使用「{AUTO_NEWS_FEATURE_NAME}」功能 {usage_count} 次，本次使用的模型：{GROK_MODEL}\n"
-        f"🧰 啟用工具：{tool_types}\n"
-        f"📊 token 使用量：\n"
-        f"- 輸入 tokens: {input_tokens}\n"
-        f"- 回應 tokens: {output_tokens}\n"
-        f"- 總 token: {total_tokens}"
-    )
-    return True
+def schedule_memory_compaction(message, user_id, response_id, provider="openai"):
+    """同一使用者的同一條對話串同時只會有一個整理工作。"""
+    key = user_id if provider == "openai" else f"{user_id}:grok"
+    if key in pending_memory_compactions:
+        return
+    task = spawn_background(compact_user_memory(message, user_id, response_id, provider))
+    pending_memory_compactions[key] = task
+    task.add_done_callback(lambda _task: pending_memory_compactions.pop(key, None))
 
 
-async def handle_auto_news_test_command(message):
-    testing_message = await message.reply("🧪 正在執行自動推播測試，請稍候...")
+async def compact_user_memory(message, user_id, response_id, provider="openai"):
+    """
+    把到 `response_id` 為止的對話濃縮成摘要。
+
+    寫回前確認這段期間使用者沒有再問下一輪（對話串的 response id 沒變），才一次換上新摘要
+    並重新開始該對話串；否則丟棄結果，下一輪結束後會再觸發一次。
+    !問 與 !問2 共用同一份摘要，兩邊各自整理時以後寫入的為準。
+    """
+    id_field, tokens_field, turns_field = MEMORY_THREAD_FIELDS[provider]
     try:
-        executed = await run_auto_news_push(trigger_label="manual_test")
-        if executed:
-            await message.reply(f"✅ 已完成測試推播，請到 <#{DAILY_NEWS_CHANNEL_ID}> 查看。")
+        with metrics.span("問" if provider == "openai" else "問2", "memory_compaction"):
+            response = await create_model_response(
+                provider,
+                model=OPENAI_SUMMARY_MODEL if provider == "openai" else GROK_MODEL,
+                previous_response_id=response_id,
+                input=[{"role": "user", "content": MEMORY_SUMMARY_PROMPT}],
+                store=False
+            )
+        if provider == "openai":
+            summary = response.output_text
+            total_tokens = getattr(response.usage, "total_tokens", 0)
         else:
-            await message.reply("⚠️ 測試推播未執行，請確認 XAI_API_KEY 與 DAILY_NEWS_CHANNEL_ID 設定。")
+            summary = extract_grok_reply_text(response)
+            total_tokens = get_grok_usage(getattr(response, "usage", None))[2]
+        record_model_tokens(message, total_tokens)
+        if not summary:
+            metrics.inc("dcbot_memory_compactions_total", result="error")
+            return
+
+        state = await load_user_memory(user_id)
+        if state.get(id_field) != response_id:
+            metrics.inc("dcbot_memory_compactions_total", result="stale")
+            return
+        state["summary"] = summary
+        state[id_field] = None
+        state[tokens_field] = 0
+        if turns_field:
+            state[turns_field] = 0
+        await save_user_memory(user_id, state)
+        metrics.inc("dcbot_memory_compactions_total", result="applied")
     except Exception as e:
-        print(f"[DAILY_NEWS_TEST_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {type(e).__name__}: {e}")
-        await message.reply("❌ 自動推播測試失敗，請稍後再試。")
-    finally:
-        with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
-            await testing_message.delete()
+        metrics.inc("dcbot_memory_compactions_total", result="error")
+        print(f"[MEMORY_COMPACT_ERR] user={user_id} {type(e).__name__}: {e}")
 
 
-async def daily_news_scheduler():
-    await client.wait_until_ready()
+pending_reset_confirmations = {}
 
-    schedule_slots = [
-        {"hour": 8, "minute": 0, "job_name": "daily_news_ask2_0800"},
-        {"hour": 21, "minute": 0, "job_name": "daily_news_ask2_2100"},
-    ]
 
-    while not client.is_closed():
-        now = datetime.now(TAIPEI_TZ)
-        today = now.date()
+# --- 功能 1：問答（含圖片） ---
+async def handle_ask_command(message, cmd):
+    prompt = cmd[2:].strip()
+    if not await enforce_rate_limit(message, "問"):
+        return
+    thinking_message = await message.reply("🧠 Thinking...")
+    stream_reply = StreamingReply(message, thinking_message)
 
-        for slot in schedule_slots:
-            if now.hour == slot["hour"] and now.minute == slot["minute"]:
-                if has_job_run_on_date(slot["job_name"], today):
-                    continue
+    try:
+        user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
+        with metrics.span("問", "db_load"):
+            state = await load_user_memory(user_id)
+
+        # 快取是所有人共用的：只有沒有進行中對話、沒有個人記憶摘要、也沒有圖片時，答案才不依賴個人上下文
+        use_response_cache = (response_cache.enabled and not state["last_response_id"] and not state.get("summary")
+                              and not has_image_attachments(message))
+        cache_embedding = None
+        if use_response_cache:
+            with metrics.span("問", "cache_lookup"):
+                served, cache_embedding = await reply_from_response_cache(stream_reply, "問", prompt)
+            if served:
+                return
+
+        if "thread_count" not in state:
+            state["thread_count"] = 0
+        previous_thread_count = state["thread_count"]
+        state["thread_count"] += 1
+        is_first_turn = state["thread_count"] == 1 and not state["last_response_id"]
+
+        # ✅ 準備 input_prompt
+        Time = datetime.now(ZoneInfo("Asia/Taipei"))
+        input_prompt = []
+        user_text = build_ask_user_text(prompt, Time, state["summary"], is_first_turn)
+
+        # ✅ 送出前先估算：token_accum 是對話串目前的長度，加上這一輪超過預算就改以摘要重開
+        estimated_tokens = estimate_ask_input_tokens(user_text, message)
+        if estimated_tokens > THREAD_TOKEN_BUDGET:
+            await stream_reply.finish(f"⚠️ 指揮官，這次的內容太長了（估計約 {estimated_tokens} tokens，上限 {THREAD_TOKEN_BUDGET}），請精簡後再問。")
+            return
+        rolled_over = bool(state["last_response_id"]) and (state.get("token_accum") or 0) + estimated_tokens > THREAD_TOKEN_BUDGET
+        if rolled_over:
+            metrics.inc("dcbot_thread_rollovers_total")
+            state["last_response_id"] = None
+            previous_thread_count = 0
+            state["thread_count"] = 1
+            state["token_accum"] = 0
+            is_first_turn = True
+            user_text = build_ask_user_text(prompt, Time, state["summary"], is_first_turn)
+        multimodal = [{"type": "input_text", "text": user_text}]
+        with metrics.span("問", "attachments"):
+            seen_hashes = thread_image_hashes.get(user_id) if state["last_response_id"] else None
+            image_blocks, image_hashes = await build_image_inputs(message, seen_hashes)
+        multimodal.extend(image_blocks)
+        input_prompt.append({
+            "role": "user",
+            "content": multimodal
+        })
+        count = await record_usage("問")  # 這裡同時也會累加一次使用次數
+        routes = [("openai", {
+            "model": OPENAI_PRIMARY_MODEL,
+            "tools": [OPENAI_WEB_SEARCH_TOOL],
+            "instructions": ASK_INSTRUCTIONS,
+            "input": input_prompt,
+            "previous_response_id": state["last_response_id"],
+            # 所有使用者共用同一段系統提示與工具前綴，用固定的 key 讓請求落在同一批快取上
+            "prompt_cache_key": "dcbot-ask",
+            "reasoning": {"effort": "high"},
+            "text": {"verbosity": "high"},
+            "store": True,
+        })]
+        if client_grok:
+            # 備援的 Grok 讀不到 OpenAI 的對話串，改用摘要補上前文
+            fallback_text = build_ask_user_text(prompt, Time, state["summary"], True)
+            routes.append(("xai", build_grok_request(
+                [
+                    {"role": "system", "content": ASK_INSTRUCTIONS},
+                    {"role": "user", "content": [{"type": "input_text", "text": fallback_text}] + multimodal[1:]},
+                ],
+                GROK_BUILTIN_TOOLS,
+            )))
+        with metrics.span("問", "model_call"):
+            response, provider_used = await model_router.create(
+                "問",
+                routes,
+                on_text_delta=stream_reply.push if STREAM_REPLIES else None,
+            )
+        model_used = OPENAI_PRIMARY_MODEL if provider_used == "openai" else GROK_MODEL
+
+        replytext = response.output_text
+        if use_response_cache:
+            response_cache.store("問", prompt, replytext, model_used, cache_embedding)
+
+        # 備援回答的 response id 無法接回 OpenAI 的對話串，下一輪從摘要重新開始；
+        # 這一輪也不算進 OpenAI 對話串的輪數，first_turn 與記憶整理的門檻才不會跑掉
+        state["last_response_id"] = response.id if provider_used == "openai" else None
+        if provider_used != "openai":
+            state["thread_count"] = previous_thread_count
+        remember_thread_images(user_id, image_hashes, bool(state["last_response_id"]))
+        input_tokens = response.usage.input_tokens
+        output_tokens = response.usage.output_tokens
+        total_tokens = response.usage.total_tokens
+        record_model_tokens(message, total_tokens)
+        # 接續對話時模型要重新讀入整段上下文：這一輪的輸入加上回應，就是下一輪的起點
+        state["token_accum"] = input_tokens + output_tokens if state["last_response_id"] else 0
+        with metrics.span("問", "db_save"):
+            await update_user_memory(user_id, last_response_id=state["last_response_id"],
+                                     thread_count=state["thread_count"], token_accum=state["token_accum"])
+
+        # 注意：output_tokens_details 可能不存在，要用 getattr 保險
+        details = getattr(response.usage, "output_tokens_details", {})
+        reasoning_tokens = getattr(details, "reasoning_tokens", 0)
+        visible_tokens = output_tokens - reasoning_tokens
+        cached_tokens = get_cached_input_tokens(response.usage)
+        failover_line = "" if provider_used == "openai" else "🔀 主模型暫時異常，本次改由備援模型回答\n"
+        search_tools = ("web_search_preview" if provider_used == "openai"
+                        else ", ".join(tool["type"] for tool in GROK_BUILTIN_TOOLS))
+        compact_memory = needs_memory_compaction(state)
+        compaction_line = (f"📝 對話已累積 {state['thread_count']} 輪、約 {state['token_accum']} tokens，正在背景整理記憶，下一輪會以摘要接續\n"
+                           if compact_memory else "")
+        if rolled_over:
+            compaction_line += f"🔄 對話串已超過 {THREAD_TOKEN_BUDGET} tokens 上限，本輪改以記憶摘要重新開始\n"
+        footer = (f"📊 今天所有人總共使用「問」功能 {count} 次，本次使用的模型：{model_used}（摘要：{OPENAI_SUMMARY_MODEL}）\n"
+                  f"✅ 已啟用網路查證功能（{search_tools}）\n"
+                  f"{failover_line}"
+                  f"{compaction_line}"
+                  f"{response_cache.hit_rate_line()}"
+                  f"📊 token 使用量：\n"
+                  f"- 輸入 tokens: {input_tokens}（快取命中 {cached_tokens}）\n"
+                  f"- 回應 tokens: {visible_tokens}\n"
+                  f"- 總 token: {total_tokens}"
+                  )
+        with metrics.span("問", "send"):
+            await stream_reply.finish(replytext, footer)
+        if compact_memory:
+            # 回覆已送出才開始摘要，使用者不必等這次模型呼叫
+            schedule_memory_compaction(message, user_id, state["last_response_id"])
+    except Exception as e:
+        print(f"[ASK_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {type(e).__name__}: {e}")
+        await message.reply("❌ 問功能發生錯誤（錯誤代碼：ASK-001），請稍後再試。")
+    finally:
+        await stream_reply.cancel()
+        if not stream_reply.started:
+            with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
+                await thinking_message.delete()
 
-                try:
-                    executed = await run_auto_news_push(trigger_label="scheduled")
-                    if executed:
-                        mark_job_run(slot["job_name"], today)
-                        print(f"✅ 每日國際新聞彙整完成：{today} {slot['hour']:02d}:{slot['minute']:02d}")
-                except Exception as e:
-                    print(f"[DAILY_NEWS_ERR] slot={slot['job_name']} {type(e).__name__}: {e}")
 
-        await asyncio.sleep(20)
+# --- 功能 1-2：問答（改用 Grok） ---
+async def handle_ask_grok_command(message, cmd):
+    prompt = cmd[3:].strip()
+    if not await enforce_rate_limit(message, "問2"):
+        return
+    thinking_message = await message.reply("🧠 Grok 思考中...")
+    stream_reply = StreamingReply(message, thinking_message)
 
+    try:
+        if not client_grok:
+            await message.reply("⚠️ 未設定 XAI_API_KEY，暫時無法使用 !問2。")
+            return
+
+        user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
+        with metrics.span("問2", "db_load"):
+            state = await load_user_memory(user_id)
+
+        # 問2 有自己的 Grok 對話串，與 !問 共用摘要；沒有進行中對話、沒有摘要也沒有圖片時才查快取
+        grok_response_id = state.get("grok_response_id")
+        use_response_cache = (response_cache.enabled and not grok_response_id and not state.get("summary")
+                              and not has_image_attachments(message))
+        cache_embedding = None
+        if use_response_cache:
+            with metrics.span("問2", "cache_lookup"):
+                served, cache_embedding = await reply_from_response_cache(stream_reply, "問2", prompt)
+            if served:
+                return
+        time_now = datetime.now(ZoneInfo("Asia/Taipei"))
+        user_text = build_ask_user_text(prompt, time_now, state.get("summary", ""), False)
+
+        estimated_tokens = estimate_ask_input_tokens(user_text, message)
+        if estimated_tokens > THREAD_TOKEN_BUDGET:
+            await stream_reply.finish(f"⚠️ 指揮官，這次的內容太長了（估計約 {estimated_tokens} tokens，上限 {THREAD_TOKEN_BUDGET}），請精簡後再問。")
+            return
+        rolled_over = bool(grok_response_id) and (state.get("grok_token_accum") or 0) + estimated_tokens > THREAD_TOKEN_BUDGET
+        if rolled_over:
+            metrics.inc("dcbot_thread_rollovers_total")
+            grok_response_id = None
+            user_text = build_ask_user_text(prompt, time_now, state.get("summary", ""), False)
+
+        user_content = [{"type": "input_text", "text": user_text}]
+        thread_key = f"{user_id}:grok"
+        with metrics.span("問2", "attachments"):
+            seen_hashes = thread_image_hashes.get(thread_key) if grok_response_id else None
+            image_blocks, image_hashes = await build_image_inputs(message, seen_hashes)
+        user_content.extend(image_blocks)
+
+        count = await record_usage("問2")
+        with metrics.span("問2", "model_call"):
+            response, active_tools, provider_used = await run_grok_with_tools(
+                user_content,
+                on_text_delta=stream_reply.push if STREAM_REPLIES else None,
+                feature="問2",
+                previous_response_id=grok_response_id,
+            )
+        model_used = getattr(response, "model", None) or GROK_MODEL
+
+        replytext = extract_grok_reply_text(response) or "（Grok 沒有回傳可顯示內容）"
+        if use_response_cache and extract_grok_reply_text(response):
+            response_cache.store("問2", prompt, replytext, model_used, cache_embedding)
+        input_tokens, output_tokens, total_tokens = get_grok_usage(getattr(response, "usage", None))
+        record_model_tokens(message, total_tokens)
+
+        # 備援的 OpenAI 回應接不回 Grok 的對話串，下一輪重新開始
+        state["grok_response_id"] = getattr(response, "id", None) if provider_used == "xai" else None
+        state["grok_token_accum"] = input_tokens + output_tokens if state["grok_response_id"] else 0
+        remember_thread_images(thread_key, image_hashes, bool(state["grok_response_id"]))
+        with metrics.span("問2", "db_save"):
+            await update_user_memory(user_id, grok_response_id=state["grok_response_id"],
+                                     grok_token_accum=state["grok_token_accum"])
+
+        tool_types = ", ".join(t.get("type", "?") for t in active_tools)
+        thread_line = "🔗 接續先前的 Grok 對話\n" if grok_response_id else ""
+        if rolled_over:
+            thread_line = f"🔄 Grok 對話串已超過 {THREAD_TOKEN_BUDGET} tokens 上限，本輪改以記憶摘要重新開始\n"
+        compact_memory = needs_memory_compaction(state, "xai")
+        if compact_memory:
+            thread_line += f"📝 Grok 對話已累積約 {state['grok_token_accum']} tokens，正在背景整理記憶，下一輪會以摘要接續\n"
+        footer = (
+            f"📊 今天所有人總共使用「問2」功能 {count} 次，本次使用的模型：{model_used}\n"
+            f"🧰 啟用工具：{tool_types}\n"
+            f"{thread_line}"
+            f"{response_cache.hit_rate_line()}"
+            f"📊 token 使用量：\n"
+            f"- 輸入 tokens: {input_tokens}（快取命中 {get_cached_input_tokens(getattr(response, 'usage', None))}）\n"
+            f"- 回應 tokens: {output_tokens}\n"
+            f"- 總 token: {total_tokens}"
+        )
+        with metrics.span("問2", "send"):
+            await stream_reply.finish(replytext, footer)
+        if compact_memory:
+            schedule_memory_compaction(message, user_id, state["grok_response_id"], "xai")
+    except Exception as e:
+        error_msg = f"{type(e).__name__}: {str(e)}"
+        print(f"[ASK2_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {error_msg}")
+        await message.reply(f"❌ 問2 功能發生錯誤\n```python\n{error_msg}\n```")
+    finally:
+        await stream_reply.cancel()
+        if not stream_reply.started:
+            with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
+                await thinking_message.delete()
+
+
+# --- 功能 2：內容整理摘要 ---
+async def handle_summary_command(message, cmd):
+    parts = cmd.split()
+    force_rebuild = len(parts) > 3 and parts[-1] == "重新"
+    if force_rebuild:
+        parts = parts[:-1]
+    if len(parts) not in (3, 4) or not all(part.isdigit() for part in parts[1:]):
+        await message.reply(f"⚠️ 使用方法：`!整理 <來源頻道/討論串ID> <摘要要送到的頻道ID> [訊息數，預設 {SUMMARY_DEFAULT_MESSAGES}，上限 {SUMMARY_MAX_MESSAGES}] [重新]`")
+        return
 
-pending_reset_confirmations = {}
-@client.event
-async def on_message(message):
-    if message.author == client.user:
+    if not await enforce_rate_limit(message, "整理"):
         return
 
-    commands = message.content.split("!")
-    for cmd in commands:
-        if not cmd.strip():
-            continue
+    source_id = int(parts[1])
+    summary_channel_id = int(parts[2])
+    message_limit = min(int(parts[3]), SUMMARY_MAX_MESSAGES) if len(parts) == 4 else SUMMARY_DEFAULT_MESSAGES
+    await message.reply(f"🔍 正在搜尋來源 ID `{source_id}` 與目標頻道 ID `{summary_channel_id}`...")
 
-        # --- 功能 1：問答（含圖片） ---
-        if cmd.startswith("問 "):
-            prompt = cmd[2:].strip()
-            thinking_message = await message.reply("🧠 Thinking...")
+    source_channel = client.get_channel(source_id)
+    summary_channel = client.get_channel(summary_channel_id)
+    if not isinstance(source_channel, (discord.Thread, discord.TextChannel)) or not isinstance(summary_channel, discord.TextChannel):
+        await message.reply("⚠️ 找不到來源或目標頻道，請確認 bot 權限與 ID 是否正確。")
+        return
 
-            try:
-                user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
-                state = load_user_memory(user_id)
-
-                if "thread_count" not in state:
-                    state["thread_count"] = 0
-                state["thread_count"] += 1
-                is_first_turn = state["thread_count"] == 1 and not state["last_response_id"]
-
-                # ✅ 每第 10 輪觸發摘要
-                if state["thread_count"] >= 10 and state["last_response_id"]:
-                    response = client_ai.responses.create(
-                        model=OPENAI_SUMMARY_MODEL,
-                        previous_response_id=state["last_response_id"],
-                        input=[{
-                            "role": "user",
-                            "content": (
-                                "請根據整段對話，濃縮為一段幫助 AI 延續對話的記憶摘要，控制在100字以內，"
-                                "摘要中應包含使用者的主要目標、問題類型、語氣特徵與重要背景知識，"
-                                "讓 AI 能以此為基礎繼續與使用者溝通。"
+    progress_message = await message.reply("🧹 正在整理內容，請稍後...")
+    try:
+        source_type = f"討論串：{source_channel.name}" if isinstance(source_channel, discord.Thread) else f"頻道：{source_channel.name}"
+        model_used=OPENAI_PRIMARY_MODEL
+        with metrics.span("整理", "db_load"):
+            cached_summary = None if force_rebuild else await load_channel_summary(source_id)
+        with metrics.span("整理", "summarize"):
+            summary, fetched_count, usage_totals, newest_message_id = await summarize_channel_history(
+                source_channel,
+                message_limit,
+                on_progress=make_progress_editor(progress_message),
+                after_message_id=cached_summary["last_message_id"] if cached_summary else None,
+                previous_summary=cached_summary["summary"] if cached_summary else None,
+            )
+        record_model_tokens(message, usage_totals["total_tokens"])
+        if summary is None:
+            await message.reply("⚠️ 來源頻道沒有可整理的文字訊息。")
+            return
+
+        total_message_count = fetched_count + (cached_summary["message_count"] if cached_summary else 0)
+        if newest_message_id is not None:
+            with metrics.span("整理", "db_save"):
+                await save_channel_summary(source_id, newest_message_id, summary, total_message_count)
+
+        input_tokens = usage_totals["input_tokens"]
+        total_tokens = usage_totals["total_tokens"]
+        visible_tokens = usage_totals["output_tokens"] - usage_totals["reasoning_tokens"]
+        embed_description = summary if len(summary) <= 4096 else summary[:4093] + "..."
+        embed = discord.Embed(title=f"內容摘要：{source_type}", description=embed_description, color=discord.Color.blue())
+        embed.set_footer(text=f"來源ID: {source_id}")
+        with metrics.span("整理", "send"):
+            await summary_channel.send(embed=embed)
+        await message.reply("✅ 內容摘要已經發送！")
+
+        count = await record_usage("整理")
+        if cached_summary:
+            scope_line = f"♻️ 沿用先前摘要（累計 {total_message_count} 則），本次只整理新增的 {fetched_count} 則訊息，模型呼叫 {usage_totals['calls']} 次\n"
+        else:
+            scope_line = f"🧹 共整理 {fetched_count} 則訊息，模型呼叫 {usage_totals['calls']} 次\n"
+        await message.reply(f"📊 今天所有人總共使用「整理」功能 {count} 次，本次使用的模型：{model_used}\n"
+                            + scope_line + "注意沒有網路查詢功能，資料可能有誤\n"
+                            f"📊 token 使用量：\n"
+                            f"- 輸入 tokens: {input_tokens}（快取命中 {usage_totals['cached_tokens']}）\n"
+                            f"- 回應 tokens: {visible_tokens}\n"
+                            f"- 總 token: {total_tokens}"
                             )
-                        }],
-                        store=False
-                    )
-                    state["summary"] = response.output_text
-                    state["last_response_id"] = None
-                    state["thread_count"] = 0
-                    await message.reply("📝 對話已達 10 輪，已自動總結並重新開始。")
-
-                # ✅ 準備 input_prompt
-                Time = datetime.now(ZoneInfo("Asia/Taipei"))
-                input_prompt = []
-                user_text = build_ask_user_text(prompt, Time, state["summary"], is_first_turn)
-                multimodal = [{"type": "input_text", "text": user_text}]
-                for attachment in message.attachments[:10]:
-                    if attachment.content_type and attachment.content_type.startswith("image/"):
-                        image_url = attachment.proxy_url  # 使用 proxy_url 替代 attachment.url
-                        multimodal.append({
-                            "type": "input_image",
-                            "image_url": image_url,
-                            "detail": "auto"
-                        }) 
-                input_prompt.append({
-                    "role": "user",
-                    "content": multimodal
-                })
-                count = record_usage("問")  # 這裡同時也會累加一次使用次數
-                model_used = OPENAI_PRIMARY_MODEL
-                response = client_ai.responses.create(
-                    model=model_used,  # 使用動態決定的模型
-                    tools=[
-                        {
-                        "type": "web_search_preview",
-                        "user_location": {
-                            "type": "approximate",
-                            "country": "TW",
-                            "timezone": "Asia/Taipei"
-                        },
-                        },
-                    ],
-                    instructions=ASK_INSTRUCTIONS,
-                    input=input_prompt,
-                    previous_response_id=state["last_response_id"],
-                    reasoning={"effort": "high"},
-                    text={"verbosity": "high"},
-                    store=True
-                )
-                
-                replytext = response.output_text
-
-                state["last_response_id"] = response.id
-                save_user_memory(user_id, state)
-                input_tokens = response.usage.input_tokens
-                output_tokens = response.usage.output_tokens
-                total_tokens = response.usage.total_tokens
-
-                # 注意：output_tokens_details 可能不存在，要用 getattr 保險
-                details = getattr(response.usage, "output_tokens_details", {})
-                reasoning_tokens = getattr(details, "reasoning_tokens", 0)
-                visible_tokens = output_tokens - reasoning_tokens
-                await send_chunks(message, replytext)
-                await message.reply(f"📊 今天所有人總共使用「問」功能 {count} 次，本次使用的模型：{model_used}（摘要：{OPENAI_SUMMARY_MODEL}）\n"+"✅ 已啟用網路查證功能（web_search_preview）\n"
-                                    f"📊 token 使用量：\n"
-                                    f"- 輸入 tokens: {input_tokens}\n"
-                                    f"- 回應 tokens: {visible_tokens}\n"
-                                    f"- 總 token: {total_tokens}"
-                                    )
-            except Exception as e:
-                print(f"[ASK_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {type(e).__name__}: {e}")
-                await message.reply("❌ 問功能發生錯誤（錯誤代碼：ASK-001），請稍後再試。")
-            finally:
-                with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
-                    await thinking_message.delete()
+    except Exception as e:
+        print(f"[SUM_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} source={source_id} target={summary_channel_id} {type(e).__name__}: {e}")
+        await message.reply("❌ 整理功能發生錯誤（錯誤代碼：SUM-001），請確認權限或稍後再試。")
 
-        # --- 功能 1-2：問答（改用 Grok） ---
-        elif cmd.startswith("問2 "):
-            prompt = cmd[3:].strip()
-            thinking_message = await message.reply("🧠 Grok 思考中...")
 
-            try:
-                if not client_grok:
-                    await message.reply("⚠️ 未設定 XAI_API_KEY，暫時無法使用 !問2。")
-                    continue
+### 🖼️ 生成圖片的解碼、壓縮與上傳
+IMAGE_DAILY_LIMIT = 15
+IMAGE_MAX_VARIANTS = max(1, min(10, parse_int_env("IMAGE_MAX_VARIANTS", 4)))
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "webp").strip().lower()
+IMAGE_UPLOAD_LIMIT_BYTES = max(256 * 1024, parse_int_env("IMAGE_UPLOAD_LIMIT_BYTES", 8 * 1024 * 1024))
+DISCORD_MAX_FILES_PER_MESSAGE = 10
+IMAGE_ENCODE_QUALITIES = (90, 80, 70, 60)
 
-                user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
-                state = load_user_memory(user_id)
-                time_now = datetime.now(ZoneInfo("Asia/Taipei"))
-                user_text = build_ask_user_text(prompt, time_now, state.get("summary", ""), False)
-
-                user_content = [{"type": "input_text", "text": user_text}]
-                for attachment in message.attachments[:10]:
-                    if attachment.content_type and attachment.content_type.startswith("image/"):
-                        user_content.append({
-                            "type": "input_image",
-                            "image_url": attachment.proxy_url,
-                            "detail": "auto",
-                        })
-
-                count = record_usage("問2")
-                model_used = GROK_MODEL
-                response, active_tools = run_grok_with_tools(user_content)
-
-                replytext = extract_grok_reply_text(response) or "（Grok 沒有回傳可顯示內容）"
-                input_tokens, output_tokens, total_tokens = get_grok_usage(getattr(response, "usage", None))
-
-                tool_types = ", ".join(t.get("type", "?") for t in active_tools)
-                await send_chunks(message, replytext)
-                await message.reply(
-                    f"📊 今天所有人總共使用「問2」功能 {count} 次，本次使用的模型：{model_used}\n"
-                    f"🧰 啟用工具：{tool_types}\n"
-                    f"📊 token 使用量：\n"
-                    f"- 輸入 tokens: {input_tokens}\n"
-                    f"- 回應 tokens: {output_tokens}\n"
-                    f"- 總 token: {total_tokens}"
-                )
-            except Exception as e:
-                error_msg = f"{type(e).__name__}: {str(e)}"
-                print(f"[ASK2_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {error_msg}")
-                await message.reply(f"❌ 問2 功能發生錯誤\n```python\n{error_msg}\n```")
-            finally:
-                with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
-                    await thinking_message.delete()
-
-        # --- 功能 1-3：自動推播測試 ---
-        elif cmd.strip() == "自動推播測試":
-            await handle_auto_news_test_command(message)
-
-        # --- 功能 2：內容整理摘要 ---
-        elif cmd.startswith("整理 "):
-            parts = cmd.split()
-            if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
-                await message.reply("⚠️ 使用方法：`!整理 <來源頻道/討論串ID> <摘要要送到的頻道ID>`")
-                continue
 
-            source_id = int(parts[1])
-            summary_channel_id = int(parts[2])
-            await message.reply(f"🔍 正在搜尋來源 ID `{source_id}` 與目標頻道 ID `{summary_channel_id}`...")
+def encode_generated_image(b64, index):
+    """
+    把 base64 圖片解碼並（可選）轉成 WebP / JPEG，回傳 (bytes, 檔名)。
+    CPU 密集，要在 thread 裡執行。沒有 Pillow 或 `IMAGE_OUTPUT_FORMAT=png` 時保留原始 PNG；
+    轉檔時依序降低品質，仍超過 `IMAGE_UPLOAD_LIMIT_BYTES` 就縮小尺寸。
+    """
+    raw = base64.b64decode(b64)
+    if Image is None or IMAGE_OUTPUT_FORMAT not in ("webp", "jpeg"):
+        return raw, f"ai_image_{index}.png"
+
+    image = Image.open(io.BytesIO(raw))
+    if IMAGE_OUTPUT_FORMAT == "jpeg" and image.mode != "RGB":
+        image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    extension = "jpg" if IMAGE_OUTPUT_FORMAT == "jpeg" else "webp"
+
+    data = raw
+    while True:
+        for quality in IMAGE_ENCODE_QUALITIES:
+            out = io.BytesIO()
+            image.save(out, format=IMAGE_OUTPUT_FORMAT.upper(), quality=quality)
+            data = out.getvalue()
+            if len(data) <= IMAGE_UPLOAD_LIMIT_BYTES:
+                return data, f"ai_image_{index}.{extension}"
+        if min(image.size) <= 256:
+            return data, f"ai_image_{index}.{extension}"
+        image = image.resize((image.width * 3 // 4, image.height * 3 // 4))
+
+
+def extract_generated_images(response):
+    return [
+        blk["result"] if isinstance(blk, dict) else blk.result
+        for blk in response.output
+        if (blk["type"] if isinstance(blk, dict) else blk.type) == "image_generation_call"
+    ]
 
-            source_channel = client.get_channel(source_id)
-            summary_channel = client.get_channel(summary_channel_id)
-            if not isinstance(source_channel, (discord.Thread, discord.TextChannel)) or not isinstance(summary_channel, discord.TextChannel):
-                await message.reply("⚠️ 找不到來源或目標頻道，請確認 bot 權限與 ID 是否正確。")
-                continue
 
-            await message.reply("🧹 正在整理內容，請稍後...")
-            try:
-                messages_history = [msg async for msg in source_channel.history(limit=1000)]
-                conversation = "\n".join(f"{msg.author.display_name}: {msg.content}" for msg in reversed(messages_history))
-                source_type = f"討論串：{source_channel.name}" if isinstance(source_channel, discord.Thread) else f"頻道：{source_channel.name}"
-                model_used=OPENAI_PRIMARY_MODEL
-                response = client_ai.responses.create(
-                    model=model_used,
-                    input=[
-                        {"role": "system", "content": "你是一位擅長內容摘要的助理，請整理以下 Discord 訊息成為條理清楚、詳細完整的摘要。你在說明時，盡量用具體實際的狀況來說明，不要用籠統的敘述簡單帶過。"},
-                        {"role": "user", "content": conversation}
-                    ]
-                )
-                input_tokens = response.usage.input_tokens
-                output_tokens = response.usage.output_tokens
-                total_tokens = response.usage.total_tokens
-
-                # 注意：output_tokens_details 可能不存在，要用 getattr 保險
-                details = getattr(response.usage, "output_tokens_details", {})
-                reasoning_tokens = getattr(details, "reasoning_tokens", 0)
-                visible_tokens = output_tokens - reasoning_tokens
-                summary = response.output_text
-                embed_description = summary if len(summary) <= 4096 else summary[:4093] + "..."
-                embed = discord.Embed(title=f"內容摘要：{source_type}", description=embed_description, color=discord.Color.blue())
-                embed.set_footer(text=f"來源ID: {source_id}")
-                await summary_channel.send(embed=embed)
-                await message.reply("✅ 內容摘要已經發送！")
-
-                count = record_usage("整理")
-                await message.reply(f"📊 今天所有人總共使用「整理」功能 {count} 次，本次使用的模型：{model_used}\n"+"注意沒有網路查詢功能，資料可能有誤\n"
-                                    f"📊 token 使用量：\n"
-                                    f"- 輸入 tokens: {input_tokens}\n"
-                                    f"- 回應 tokens: {visible_tokens}\n"
-                                    f"- 總 token: {total_tokens}"
-                                    )
-            except Exception as e:
-                print(f"[SUM_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} source={source_id} target={summary_channel_id} {type(e).__name__}: {e}")
-                await message.reply("❌ 整理功能發生錯誤（錯誤代碼：SUM-001），請確認權限或稍後再試。")
-        
-        # --- 功能 3：生成圖像 ---
-        elif cmd.startswith("圖片 "):
-            if is_usage_exceeded("圖片", limit=15):
-                await message.reply("⚠️ 指揮官，今日圖片功能已達 15 次上限，請明日再試。")
-                return  # 直接收子離場
-            query = cmd[2:].strip()
-            thinking = await message.reply("生成中…")
-            try:
-                multimodal = [{"type": "input_text", "text": query+"我的語言是繁體"}]
-                for attachment in message.attachments[:10]:
-                    if attachment.content_type and attachment.content_type.startswith("image/"):
-                        image_url = attachment.proxy_url  # 使用 proxy_url 替代 attachment.url
-                        multimodal.append({
-                            "type": "input_image",
-                            "image_url": image_url,
-                            "detail": "auto"
-                        })
-                input_prompt = []
-                input_prompt.append({
-                    "role": "user",
-                    "content": multimodal
-                })
-                count = record_usage("圖片")  # 這裡同時也會累加一次使用次數
-                model_used = OPENAI_IMAGE_MODEL
-                response = client_ai.responses.create(
+async def encode_generated_images(images_b64):
+    """所有圖片在 thread 裡平行解碼 / 壓縮，回傳 [(bytes, 檔名), ...]。"""
+    return await asyncio.gather(*(
+        asyncio.to_thread(encode_generated_image, b64, idx + 1)
+        for idx, b64 in enumerate(images_b64)
+    ))
+
+
+async def send_generated_images(message, encoded, content=None):
+    """合併成一則（超過 10 張才分批）多檔案訊息上傳，`content` 附在最後一則。"""
+    batches = [encoded[start:start + DISCORD_MAX_FILES_PER_MESSAGE]
+               for start in range(0, len(encoded), DISCORD_MAX_FILES_PER_MESSAGE)] or [[]]
+    for idx, batch in enumerate(batches):
+        await message.reply(
+            content=content if idx == len(batches) - 1 else None,
+            files=[discord.File(io.BytesIO(data), filename) for data, filename in batch],
+        )
+
+
+IMAGE_VARIANTS_RE = re.compile(r"^[xX×](\d+)$")
+
+
+def parse_image_command(cmd):
+    """
+    `!圖片 [x張數] <描述>`：描述前加 x2、x3…（1~IMAGE_MAX_VARIANTS）一次平行生成多張。
+
+    一定要帶 x，描述開頭的一般數字（例如「2025 年的煙火」）才不會被當成張數；範圍外的值也原樣留在描述裡。
+    """
+    query = cmd[2:].strip()
+    head, _, rest = query.partition(" ")
+    match = IMAGE_VARIANTS_RE.match(head)
+    if match and rest.strip() and 1 <= int(match.group(1)) <= IMAGE_MAX_VARIANTS:
+        return int(match.group(1)), rest.strip()
+    return 1, query
+
+
+# --- 功能 3：生成圖像 ---
+async def handle_image_command(message, cmd):
+    variants, query = parse_image_command(cmd)
+    # 每張圖各算一次使用次數；生成前先佔用額度，同時進來的請求才不會一起超過上限
+    reservation = await usage_counters.reserve("圖片", variants, IMAGE_DAILY_LIMIT)
+    if reservation is None:
+        await message.reply(f"⚠️ 指揮官，今日圖片功能已達 {IMAGE_DAILY_LIMIT} 次上限，請明日再試。")
+        return  # 直接收子離場
+    count, usage_day = reservation
+    unused_variants = variants
+    if not await enforce_rate_limit(message, "圖片"):
+        usage_counters.release("圖片", unused_variants, usage_day)
+        return
+    try:
+        thinking = await message.reply("生成中…" if variants == 1 else f"生成中…（{variants} 張）")
+    except discord.HTTPException:
+        usage_counters.release("圖片", unused_variants, usage_day)
+        raise
+    text_reply = StreamingReply(message, thinking)
+    try:
+        multimodal = [{"type": "input_text", "text": query+"我的語言是繁體"}]
+        with metrics.span("圖片", "attachments"):
+            image_blocks, _ = await build_image_inputs(message)
+        multimodal.extend(image_blocks)
+        input_prompt = []
+        input_prompt.append({
+            "role": "user",
+            "content": multimodal
+        })
+        model_used = OPENAI_IMAGE_MODEL
+        with metrics.span("圖片", "model_call"):
+            # 每個變體是獨立的一次生成，平行送出；部分失敗時仍送出成功的圖片
+            results = await asyncio.gather(*(
+                create_model_response(
+                    "openai",
                     model=model_used,  # 使用動態決定的模型
                     tools=[
-                        {
-                        "type": "web_search_preview",
-                        "user_location": {
-                            "type": "approximate",
-                            "country": "TW",
-                            "timezone": "Asia/Taipei"
-                        },
-                        },
+                        OPENAI_WEB_SEARCH_TOOL,
                         {"type": "image_generation",
                          "quality": "high",
                         }
@@ -911,115 +3547,511 @@ async def on_message(message):
                     tool_choice={"type": "image_generation"},
                     input=input_prompt,
                 )
-                replytext = response.output_text
-                await send_chunks(message, replytext)
-                replyimages = [
-                    blk["result"] if isinstance(blk, dict) else blk.result
-                    for blk in response.output
-                    if (blk["type"] if isinstance(blk, dict) else blk.type) == "image_generation_call"
-                ]
-                for idx, b64 in enumerate(replyimages):
-                    # 1. 先解碼
-                    buf = io.BytesIO(base64.b64decode(b64))
-                    buf.seek(0)
-                    # 2. 回傳到 Discord
-                    await message.reply(file=discord.File(buf, f"ai_image_{idx+1}.png"))
-
-                input_tokens = response.usage.input_tokens
-                output_tokens = response.usage.output_tokens
-                total_tokens = response.usage.total_tokens
-                await message.reply(f"📊 今天所有人總共使用「圖片」功能 {count} 次，本次使用的模型：{model_used}+gpt-image-1"
-                                    f"\n📊 token 使用量：\n"
-                                    f"- 輸入 tokens: {input_tokens}\n"
-                                    f"- 回應 tokens: {output_tokens}\n"
-                                    f"- 總 token: {total_tokens}"
-                                    )
-            except Exception as e:
-                print(f"[IMG_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {type(e).__name__}: {e}")
-                await message.reply("❌ 圖片功能發生錯誤（錯誤代碼：IMG-001），請稍後再試。")
-            finally:
-                with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
-                    await thinking.delete()
-        elif cmd.startswith("重置記憶"):
-            user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
-            await message.reply("⚠️ 你確定要重置記憶嗎？建議利用【顯示記憶】指令備份目前記憶。若要重置，請回覆「確定重置」；若要取消，請回覆「取消重置」。")
-            pending_reset_confirmations[user_id] = True
-
-        elif cmd.startswith("確定重置"):
-            user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
-            if pending_reset_confirmations.get(user_id):
-                pending_reset_confirmations.pop(user_id)
-                state = {
-                    "summary": "",
-                    "token_accum": 0,
-                    "last_response_id": None,
-                    "thread_count": 0
-                }
-                save_user_memory(user_id, state)
-                await message.reply("✅ 記憶已重置")
-            else:
-                await message.reply("⚠️ 沒有待確認的重置請求。")
+                for _ in range(variants)
+            ), return_exceptions=True)
+        responses = [result for result in results if not isinstance(result, BaseException)]
+        failures = [result for result in results if isinstance(result, BaseException)]
+        # 失敗的張數把額度還回去
+        unused_variants = len(failures)
+        if not responses:
+            raise failures[0]
+        for error in failures:
+            print(f"[IMG_ERR] variant user={message.author.id} {type(error).__name__}: {error}")
+
+        replytext = responses[0].output_text
+        with metrics.span("圖片", "encode"):
+            replyimages = [b64 for response in responses for b64 in extract_generated_images(response)]
+            encoded = await encode_generated_images(replyimages)
+        uploaded_bytes = sum(len(data) for data, _ in encoded)
+
+        input_tokens = sum(response.usage.input_tokens for response in responses)
+        output_tokens = sum(response.usage.output_tokens for response in responses)
+        total_tokens = sum(response.usage.total_tokens for response in responses)
+        record_model_tokens(message, total_tokens)
+        failure_line = f"\n⚠️ 有 {len(failures)} 張生成失敗" if failures else ""
+        footer = (f"📊 今天所有人總共使用「圖片」功能 {count - len(failures)} 次，本次使用的模型：{model_used}+gpt-image-1"
+                  f"{failure_line}"
+                  f"\n🖼️ 共 {len(replyimages)} 張，上傳 {uploaded_bytes / 1024 / 1024:.1f} MB"
+                  f"\n📊 token 使用量：\n"
+                  f"- 輸入 tokens: {input_tokens}\n"
+                  f"- 回應 tokens: {output_tokens}\n"
+                  f"- 總 token: {total_tokens}"
+                  )
+        with metrics.span("圖片", "send"):
+            # 說明文字改寫在「生成中」訊息上，圖片與使用量合併成一則
+            await text_reply.finish(replytext)
+            await send_generated_images(message, encoded, content=footer)
+    except Exception as e:
+        print(f"[IMG_ERR] user={message.author.id} guild={message.guild.id if message.guild else 'dm'} {type(e).__name__}: {e}")
+        await message.reply("❌ 圖片功能發生錯誤（錯誤代碼：IMG-001），請稍後再試。")
+    finally:
+        usage_counters.release("圖片", unused_variants, usage_day)
+        await text_reply.cancel()
+        if not text_reply.started:
+            with suppress(discord.HTTPException, discord.Forbidden, discord.NotFound):
+                await thinking.delete()
+
+
+async def handle_reset_memory_command(message, cmd):
+    user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
+    await message.reply("⚠️ 你確定要重置記憶嗎？建議利用【顯示記憶】指令備份目前記憶。若要重置，請回覆「確定重置」；若要取消，請回覆「取消重置」。")
+    pending_reset_confirmations[user_id] = True
+
+
+async def handle_confirm_reset_command(message, cmd):
+    user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
+    if pending_reset_confirmations.get(user_id):
+        pending_reset_confirmations.pop(user_id)
+        state = {
+            "summary": "",
+            "token_accum": 0,
+            "last_response_id": None,
+            "thread_count": 0,
+            "grok_response_id": None,
+            "grok_token_accum": 0,
+        }
+        await save_user_memory(user_id, state)
+        await message.reply("✅ 記憶已重置")
+    else:
+        await message.reply("⚠️ 沒有待確認的重置請求。")
+
+
+async def handle_cancel_reset_command(message, cmd):
+    user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
+    if pending_reset_confirmations.get(user_id):
+        pending_reset_confirmations.pop(user_id)
+        await message.reply("已取消記憶重置。")
+    else:
+        await message.reply("⚠️ 沒有待確認的重置請求。")
+
+
+async def handle_show_memory_command(message, cmd):
+    user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
+    state = await load_user_memory(user_id)
+    summary = state.get("summary", "")
+    if summary:
+        await message.reply(f"📖 目前長期記憶摘要：\n{summary}")
+    else:
+        await message.reply("目前尚無長期記憶摘要。")
+
+
+async def handle_help_command(message, cmd):
+    embed = discord.Embed(title="📜 Discord Bot 指令選單", color=discord.Color.blue())
+    embed.add_field(
+        name="❓ 問",
+        value=f"`!問 <內容>`\n支援圖片附件問答；主模型 `{OPENAI_PRIMARY_MODEL}`，每 10 輪以 `{OPENAI_SUMMARY_MODEL}` 做記憶摘要，並啟用網路查證。",
+        inline=False
+    )
+    embed.add_field(
+        name="🧠 問2（Grok）",
+        value="`!問2 <內容>`\n支援圖片附件問答，會接續你上一輪的 Grok 對話並共用「問」的記憶摘要；使用 xAI `grok-4-1-fast-reasoning`，並啟用 function calling / web_search / x_search（需設定 `XAI_API_KEY`）。",
+        inline=False
+    )
+    embed.add_field(
+        name="🧹 整理",
+        value=f"`!整理 <來源頻道/討論串ID> <摘要送出頻道ID> [訊息數] [重新]`\n使用 `{OPENAI_PRIMARY_MODEL}` 整理近 {SUMMARY_DEFAULT_MESSAGES} 則訊息（可指定，上限 {SUMMARY_MAX_MESSAGES}）並發送至指定頻道；再次整理同一來源時只摘要新增訊息，加上 `重新` 可從頭整理。",
+        inline=False
+    )
+    embed.add_field(
+        name="🎨 圖片",
+        value=f"`!圖片 [x張數] <描述>`\n使用 `{OPENAI_IMAGE_MODEL} + gpt-image-1` 生成圖片（含網路查證），可加 x2、x3 一次平行生成最多 {IMAGE_MAX_VARIANTS} 張。",
+        inline=False
+    )
+    embed.add_field(
+        name="🧠 顯示記憶",
+        value="`!顯示記憶`\n顯示目前的長期記憶摘要。",
+        inline=False
+    )
+    embed.add_field(
+        name="♻️ 重置記憶",
+        value="`!重置記憶` → 開始記憶清除流程\n`!確定重置` / `!取消重置` → 確認或取消重置",
+        inline=False
+    )
+    embed.add_field(
+        name="🧪 自動推播測試",
+        value="`!自動推播測試 [強制]`\n立刻測試獨立的「自動推播」功能，發送一次每日國際新聞；預設沿用最近產生的摘要，加上 `強制` 則重新產生。",
+        inline=False
+    )
+    embed.add_field(
+        name="⚡ 斜線指令",
+        value="`/問`、`/問2`、`/整理`、`/圖片`、`/記憶` 與上面的 `!` 指令功能相同；`/記憶` 的結果只有你看得到。",
+        inline=False
+    )
+    embed.add_field(
+        name="📖 指令選單",
+        value="`!指令選單`\n顯示本說明選單。",
+        inline=False
+    )
+    await message.reply(embed=embed)
 
-        elif cmd.startswith("取消重置"):
-            user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
-            if pending_reset_confirmations.get(user_id):
-                pending_reset_confirmations.pop(user_id)
-                await message.reply("已取消記憶重置。")
-            else:
-                await message.reply("⚠️ 沒有待確認的重置請求。")
-        elif cmd.startswith("顯示記憶"):
-            user_id = f"{message.guild.id}-{message.author.id}" if message.guild else f"dm-{message.author.id}"
-            state = load_user_memory(user_id)
-            summary = state.get("summary", "")
-            if summary:
-                await message.reply(f"📖 目前長期記憶摘要：\n{summary}")
+
+### 🧵 指令排程（各指令獨立的 worker pool、排隊上限與使用者公平性）
+DEFAULT_COMMAND_POOLS = {
+    # pool 名稱: [worker 數, 排隊上限]
+    "問": [4, 20],
+    "問2": [4, 20],
+    "整理": [2, 5],
+    "圖片": [2, 10],
+    "自動推播": [1, 2],
+    "輕量": [4, 50],
+}
+# 每位使用者在同一個 pool 最多能排隊幾個工作（不含正在執行的），避免一個人洗版佔滿整個排隊
+COMMAND_USER_MAX_QUEUE = max(1, parse_int_env("COMMAND_USER_MAX_QUEUE", 2))
+
+
+def load_command_pools():
+    pools = {name: list(config) for name, config in DEFAULT_COMMAND_POOLS.items()}
+    for name, config in (parse_json_env("COMMAND_POOLS") or {}).items():
+        pools[name] = list(config)
+    return pools
+
+
+class CommandJob:
+    def __init__(self, message_id, user_key, handler):
+        self.message_id = message_id
+        self.user_key = user_key
+        self.handler = handler
+        self.task = None
+        self.enqueued_at = time.perf_counter()
+
+
+class CommandWorkerPool:
+    """
+    單一指令類型的 worker pool。
+
+    排隊中的工作依使用者分組，worker 以輪詢方式挑選「目前沒有工作在執行」的使用者，
+    所以同一位使用者的指令依序執行，也無法一個人佔滿所有 worker；
+    每位使用者的排隊數另有 `max_user_queue` 上限，也無法一個人佔滿整個排隊。
+    """
+
+    def __init__(self, name, workers, max_queue, max_user_queue=COMMAND_USER_MAX_QUEUE):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.max_user_queue = max(1, max_user_queue)
+        self.pending = OrderedDict()
+        self.queued = 0
+        self.running = {}
+        self.wakeup = asyncio.Event()
+        self.worker_tasks = []
+
+    def start(self):
+        self.worker_tasks = [task for task in self.worker_tasks if not task.done()]
+        while len(self.worker_tasks) < self.workers:
+            self.worker_tasks.append(asyncio.create_task(self._worker()))
+
+    def user_queue_full(self, user_key):
+        return len(self.pending.get(user_key, ())) >= self.max_user_queue
+
+    def submit(self, job):
+        """加入排隊；回傳前面還有幾個工作（0 代表馬上執行），排隊已滿或該使用者排隊已達上限則回傳 None。"""
+        if self.queued >= self.max_queue or self.user_queue_full(job.user_key):
+            return None
+
+        user_jobs = self.pending.setdefault(job.user_key, deque())
+        same_user_ahead = len(user_jobs) + (1 if job.user_key in self.running else 0)
+        user_jobs.append(job)
+        self.queued += 1
+        self.wakeup.set()
+        idle_workers = self.workers - len(self.running)
+        return max(self.queued - idle_workers, same_user_ahead, 0)
+
+    def _next_job(self):
+        for user_key in list(self.pending):
+            if user_key in self.running:
+                continue
+            jobs = self.pending.pop(user_key)
+            job = jobs.popleft()
+            if jobs:
+                self.pending[user_key] = jobs
+            self.queued -= 1
+            return job
+        return None
+
+    def cancel_message(self, message_id):
+        cancelled = 0
+        for user_key in list(self.pending):
+            jobs = self.pending[user_key]
+            kept = deque(job for job in jobs if job.message_id != message_id)
+            cancelled += len(jobs) - len(kept)
+            if kept:
+                self.pending[user_key] = kept
             else:
-                await message.reply("目前尚無長期記憶摘要。")
-        elif cmd.startswith("指令選單"):
-            embed = discord.Embed(title="📜 Discord Bot 指令選單", color=discord.Color.blue())
-            embed.add_field(
-                name="❓ 問",
-                value=f"`!問 <內容>`\n支援圖片附件問答；主模型 `{OPENAI_PRIMARY_MODEL}`，每 10 輪以 `{OPENAI_SUMMARY_MODEL}` 做記憶摘要，並啟用網路查證。",
-                inline=False
-            )
-            embed.add_field(
-                name="🧠 問2（Grok）",
-                value="`!問2 <內容>`\n支援圖片附件問答；使用 xAI `grok-4-1-fast-reasoning`，並啟用 function calling / web_search / x_search（需設定 `XAI_API_KEY`）。",
-                inline=False
-            )
-            embed.add_field(
-                name="🧹 整理",
-                value=f"`!整理 <來源頻道/討論串ID> <摘要送出頻道ID>`\n使用 `{OPENAI_PRIMARY_MODEL}` 整理近 1000 則訊息並發送至指定頻道。",
-                inline=False
-            )
-            embed.add_field(
-                name="🎨 圖片",
-                value=f"`!圖片 <描述>`\n使用 `{OPENAI_IMAGE_MODEL} + gpt-image-1` 生成圖片（含網路查證）。",
-                inline=False
-            )
-            embed.add_field(
-                name="🧠 顯示記憶",
-                value="`!顯示記憶`\n顯示目前的長期記憶摘要。",
-                inline=False
-            )
-            embed.add_field(
-                name="♻️ 重置記憶",
-                value="`!重置記憶` → 開始記憶清除流程\n`!確定重置` / `!取消重置` → 確認或取消重置",
-                inline=False
-            )
-            embed.add_field(
-                name="🧪 自動推播測試",
-                value="`!自動推播測試`\n立刻測試獨立的「自動推播」功能，立即發送一次每日國際新聞。",
-                inline=False
-            )
-            embed.add_field(
-                name="📖 指令選單",
-                value="`!指令選單`\n顯示本說明選單。",
-                inline=False
-            )
-            await message.reply(embed=embed)
+                del self.pending[user_key]
+        self.queued -= cancelled
+
+        for job in self.running.values():
+            if job.message_id == message_id and job.task and not job.task.done():
+                job.task.cancel()
+                cancelled += 1
+        return cancelled
+
+    async def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            self.running[job.user_key] = job
+            started = time.perf_counter()
+            metrics.observe("dcbot_queue_wait_seconds", started - job.enqueued_at, pool=self.name)
+            job.task = asyncio.create_task(job.handler())
+            try:
+                # 用 asyncio.wait 而不是直接 await，worker 才分得出是工作被取消還是自己被取消
+                await asyncio.wait({job.task})
+            finally:
+                self.running.pop(job.user_key, None)
+                self.wakeup.set()
+
+            outcome = "ok"
+            if job.task.cancelled():
+                outcome = "cancelled"
+                print(f"[JOB_CANCELLED] pool={self.name} message={job.message_id}")
+            elif job.task.exception():
+                outcome = "error"
+                e = job.task.exception()
+                print(f"[JOB_ERR] pool={self.name} message={job.message_id} {type(e).__name__}: {e}")
+            metrics.observe("dcbot_command_seconds", time.perf_counter() - started, pool=self.name)
+            metrics.inc("dcbot_commands_total", pool=self.name, outcome=outcome)
+
+
+class CommandScheduler:
+    def __init__(self, pool_config):
+        self.pools = {
+            name: CommandWorkerPool(name, workers, max_queue)
+            for name, (workers, max_queue) in pool_config.items()
+        }
+
+    def start(self):
+        for worker_pool in self.pools.values():
+            worker_pool.start()
+
+    async def submit(self, pool_name, message, handler):
+        worker_pool = self.pools[pool_name]
+        user_key = str(message.author.id)
+        if worker_pool.user_queue_full(user_key):
+            metrics.inc("dcbot_commands_rejected_total", pool=pool_name, reason="user_queue")
+            await message.reply(f"⚠️ 指揮官，你已經有 {worker_pool.max_user_queue} 個「{pool_name}」指令在排隊，請等前面的完成再送出。")
+            return None
+        position = worker_pool.submit(CommandJob(message.id, user_key, handler))
+        if position is None:
+            metrics.inc("dcbot_commands_rejected_total", pool=pool_name, reason="queue_full")
+            await message.reply(f"⚠️ 指揮官，目前「{pool_name}」排隊已滿，請稍後再試。")
+        elif position > 0:
+            await message.reply(f"⏳ 目前「{pool_name}」忙碌中，你排在第 {position} 位，輪到你時會自動開始。")
+        return position
+
+    def cancel_message(self, message_id):
+        return sum(worker_pool.cancel_message(message_id) for worker_pool in self.pools.values())
+
+
+command_scheduler = CommandScheduler(load_command_pools())
+
+
+def collect_runtime_gauges():
+    gauges = [("dcbot_db_pool_" + key, {}, value) for key, value in db_pool_stats.items()]
+    gauges.extend(("dcbot_memory_cache_" + key, {}, value) for key, value in memory_cache.stats.items())
+    gauges.append(("dcbot_memory_cache_dirty", {}, len(memory_cache.dirty)))
+    for name, worker_pool in command_scheduler.pools.items():
+        gauges.append(("dcbot_queue_depth", {"pool": name}, worker_pool.queued))
+        gauges.append(("dcbot_running_jobs", {"pool": name}, len(worker_pool.running)))
+    gauges.extend(model_router.gauges())
+    return gauges
+
+
+metrics.register_gauges(collect_runtime_gauges)
+
+
+def route_command(cmd):
+    """依指令前綴決定要交給哪個 worker pool 與 handler；無法辨識的指令回傳 None。"""
+    if cmd.startswith("問 "):
+        return "問", handle_ask_command
+    if cmd.startswith("問2 "):
+        return "問2", handle_ask_grok_command
+    if cmd.strip() in ("自動推播測試", "自動推播測試 強制"):
+        return "自動推播", handle_auto_news_test_command
+    if cmd.startswith("整理 "):
+        return "整理", handle_summary_command
+    if cmd.startswith("圖片 "):
+        return "圖片", handle_image_command
+    if cmd.startswith("重置記憶"):
+        return "輕量", handle_reset_memory_command
+    if cmd.startswith("確定重置"):
+        return "輕量", handle_confirm_reset_command
+    if cmd.startswith("取消重置"):
+        return "輕量", handle_cancel_reset_command
+    if cmd.startswith("顯示記憶"):
+        return "輕量", handle_show_memory_command
+    if cmd.startswith("指令選單"):
+        return "輕量", handle_help_command
+    return None
+
+
+@client.event
+async def on_message(message):
+    if message.author == client.user:
+        return
+    # 絕大多數訊息只是一般聊天，沒有 `!` 就不必再切分比對
+    if not PREFIX_COMMANDS or "!" not in message.content:
+        return
+
+    commands = message.content.split("!")
+    for cmd in commands:
+        if not cmd.strip():
+            continue
+
+        route = route_command(cmd)
+        if route is None:
+            continue
+
+        pool_name, handler = route
+        await command_scheduler.submit(pool_name, message, functools.partial(handler, message, cmd))
+
+
+@client.event
+async def on_raw_message_delete(payload):
+    command_scheduler.cancel_message(payload.message_id)
+
+
+### ⚡ 斜線指令（Discord 依指令名稱直接派送；模型呼叫耗時，一律先 defer 再用 followup 回覆）
+SLASH_COMMANDS = os.getenv("SLASH_COMMANDS", "1").strip() != "0"
+SLASH_COMMAND_GUILD_ID = parse_int_env("SLASH_COMMAND_GUILD_ID", 0)
+INTERACTION_FOLLOWUP_TTL_SECONDS = 14 * 60
+
+command_tree = app_commands.CommandTree(client)
+
+
+class InteractionReply:
+    """followup 送出的 webhook 訊息；它的 edit 不支援 `suppress`，其餘照原樣轉過去。"""
+
+    def __init__(self, message):
+        self.message = message
+        self.id = message.id
+
+    async def edit(self, **kwargs):
+        kwargs.pop("suppress", None)
+        return await self.message.edit(**kwargs)
+
+    async def delete(self):
+        await self.message.delete()
+
+
+class InteractionMessage:
+    """
+    讓斜線指令沿用既有的 handler：提供 handler 會用到的 Message 介面（author、guild、attachments、reply）。
+
+    reply 改走 interaction 的 followup，第一則會取代 defer 時顯示的「思考中」。
+    interaction token 只有 15 分鐘效期，超過後改直接送到頻道。
+    """
+
+    def __init__(self, interaction, content, attachments=(), ephemeral=False):
+        self.interaction = interaction
+        self.id = interaction.id
+        self.author = interaction.user
+        self.guild = interaction.guild
+        self.channel = interaction.channel
+        self.content = content
+        self.attachments = [attachment for attachment in attachments if attachment is not None]
+        self.ephemeral = ephemeral
+        self.created_at = time.monotonic()
+
+    async def reply(self, content=None, **kwargs):
+        kwargs.pop("mention_author", None)
+        if time.monotonic() - self.created_at < INTERACTION_FOLLOWUP_TTL_SECONDS:
+            sent = await self.interaction.followup.send(content, wait=True, ephemeral=self.ephemeral, **kwargs)
+            return InteractionReply(sent)
+        return await self.channel.send(content, **kwargs)
+
+
+async def submit_interaction_command(interaction, pool_name, handler, cmd, attachments=(), ephemeral=False):
+    """先 defer（3 秒內必須回應），再把指令交給與 `!` 指令相同的 worker pool。"""
+    await interaction.response.defer(thinking=True, ephemeral=ephemeral)
+    metrics.inc("dcbot_slash_commands_total", command=interaction.command.name if interaction.command else pool_name)
+    message = InteractionMessage(interaction, cmd, attachments, ephemeral)
+    await command_scheduler.submit(pool_name, message, functools.partial(handler, message, cmd))
+
+
+@command_tree.command(name="問", description="向鎮海提問（OpenAI，會接續對話並記憶，支援圖片）")
+@app_commands.rename(prompt="內容", image="圖片")
+@app_commands.describe(prompt="想問的問題", image="附加的圖片（選填）")
+async def slash_ask(interaction: discord.Interaction, prompt: str, image: Optional[discord.Attachment] = None):
+    await submit_interaction_command(interaction, "問", handle_ask_command, f"問 {prompt}", [image])
+
+
+@command_tree.command(name="問2", description="向 Grok 提問（會接續 Grok 對話並共用記憶摘要，支援圖片）")
+@app_commands.rename(prompt="內容", image="圖片")
+@app_commands.describe(prompt="想問的問題", image="附加的圖片（選填）")
+async def slash_ask_grok(interaction: discord.Interaction, prompt: str, image: Optional[discord.Attachment] = None):
+    await submit_interaction_command(interaction, "問2", handle_ask_grok_command, f"問2 {prompt}", [image])
+
+
+@command_tree.command(name="整理", description="整理頻道或討論串的訊息，摘要送到指定頻道")
+@app_commands.rename(source="來源", target="目標頻道", limit="訊息數", rebuild="重新整理")
+@app_commands.describe(
+    source="要整理的頻道或討論串",
+    target="摘要要送到的頻道",
+    limit=f"訊息數，預設 {SUMMARY_DEFAULT_MESSAGES}",
+    rebuild="不沿用先前的摘要，從頭整理",
+)
+async def slash_summary(interaction: discord.Interaction, source: Union[discord.TextChannel, discord.Thread],
+                        target: discord.TextChannel,
+                        limit: Optional[app_commands.Range[int, 1, SUMMARY_MAX_MESSAGES]] = None,
+                        rebuild: bool = False):
+    cmd = f"整理 {source.id} {target.id}" + (f" {limit}" if limit else "") + (" 重新" if rebuild else "")
+    await submit_interaction_command(interaction, "整理", handle_summary_command, cmd)
+
+
+@command_tree.command(name="圖片", description="生成圖片（含網路查證）")
+@app_commands.rename(description="描述", count="張數", image="參考圖片")
+@app_commands.describe(description="想生成的畫面", count=f"一次生成幾張，最多 {IMAGE_MAX_VARIANTS} 張", image="附加的參考圖片（選填）")
+async def slash_image(interaction: discord.Interaction, description: str,
+                      count: Optional[app_commands.Range[int, 1, IMAGE_MAX_VARIANTS]] = None,
+                      image: Optional[discord.Attachment] = None):
+    # 張數一律明確帶上，避免描述開頭的數字被當成張數
+    await submit_interaction_command(interaction, "圖片", handle_image_command, f"圖片 x{count or 1} {description}", [image])
+
+
+MEMORY_SLASH_ACTIONS = {
+    "顯示記憶": handle_show_memory_command,
+    "重置記憶": handle_reset_memory_command,
+    "確定重置": handle_confirm_reset_command,
+    "取消重置": handle_cancel_reset_command,
+}
+
+
+@command_tree.command(name="記憶", description="顯示或重置你的長期記憶（只有你看得到）")
+@app_commands.rename(action="動作")
+@app_commands.choices(action=[app_commands.Choice(name=name, value=name) for name in MEMORY_SLASH_ACTIONS])
+async def slash_memory(interaction: discord.Interaction, action: app_commands.Choice[str]):
+    await submit_interaction_command(interaction, "輕量", MEMORY_SLASH_ACTIONS[action.value], action.value, ephemeral=True)
+
+
+@command_tree.error
+async def on_slash_command_error(interaction, error):
+    print(f"[SLASH_ERR] user={interaction.user.id} guild={interaction.guild.id if interaction.guild else 'dm'} {type(error).__name__}: {error}")
+    with suppress(discord.HTTPException):
+        if interaction.response.is_done():
+            await interaction.followup.send("❌ 指令執行失敗，請稍後再試。", ephemeral=True)
+        else:
+            await interaction.response.send_message("❌ 指令執行失敗，請稍後再試。", ephemeral=True)
+
+
+async def sync_slash_commands():
+    """設定 `SLASH_COMMAND_GUILD_ID` 時只同步到該伺服器（立即生效），否則全域同步。"""
+    try:
+        if SLASH_COMMAND_GUILD_ID:
+            guild = discord.Object(id=SLASH_COMMAND_GUILD_ID)
+            command_tree.copy_global_to(guild=guild)
+            synced = await command_tree.sync(guild=guild)
+        else:
+            synced = await command_tree.sync()
+        print(f"✅ 已同步 {len(synced)} 個斜線指令")
+    except Exception as e:
+        print(f"[SLASH_SYNC_ERR] {type(e).__name__}: {e}")
 
 
-                
 # ===== 7. 啟動 Bot =====
-client.run(DISCORD_TOKEN)
+if __name__ == "__main__":
+    client.run(DISCORD_TOKEN)